@@ -3,11 +3,12 @@ AI Rate Limiter Application Factory
 """
 import os
 import time
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
 from celery import Celery
+from kombu import Queue as BrokerQueue
 import psycopg2
 from psycopg2 import OperationalError
 
@@ -49,42 +50,101 @@ def create_app():
     app.config.from_object('app.config.config.Config')
     
     # Wait for database to be ready (only in production/container environment)
-    if os.getenv('FLASK_ENV') != 'development':
+    if os.getenv('FLASK_ENV') != 'development' and app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
         if not wait_for_database():
             print("⚠️  Continuing without database connection...")
     
+    # Initialize tracing before anything opens connections
+    from app.utils import tracing
+    tracing.init_tracing(app.config.get('TRACING_SERVICE_NAME'))
+    
     # Initialize extensions
     db.init_app(app)
     migrate.init_app(app, db)
     CORS(app)
     
     # Initialize Celery
+    from app.utils.serialization import register_celery_serializer
+    register_celery_serializer()
+    
     celery.conf.update(
         broker_url=app.config.get('CELERY_BROKER_URL'),
         result_backend=app.config.get('CELERY_RESULT_BACKEND'),
-        task_serializer='json',
-        accept_content=['json'],
-        result_serializer='json',
+        task_serializer=app.config.get('CELERY_TASK_SERIALIZER'),
+        accept_content=app.config.get('CELERY_ACCEPT_CONTENT'),
+        result_serializer=app.config.get('CELERY_RESULT_SERIALIZER'),
+        result_accept_content=app.config.get('CELERY_ACCEPT_CONTENT'),
         timezone='UTC',
         enable_utc=True,
         task_track_started=True,
         task_time_limit=30 * 60,  # 30 minutes
+        # One priority queue, so interactive and urgent messages overtake bulk work
+        task_queues=[BrokerQueue(app.config.get('CELERY_TASK_QUEUE'), queue_arguments={'x-max-priority': 9}),
+                     BrokerQueue(app.config.get('CELERY_TIMER_QUEUE'))],
+        task_default_queue=app.config.get('CELERY_TASK_QUEUE'),
+        # The deferred release runs every second, so it gets a queue and worker of its own
+        task_routes={
+            'app.tasks.worker_tasks.release_deferred_messages': {'queue': app.config.get('CELERY_TIMER_QUEUE')}
+        },
+        task_default_priority=app.config.get('DEFAULT_MESSAGE_PRIORITY'),
+        worker_prefetch_multiplier=app.config.get('CELERY_WORKER_PREFETCH_MULTIPLIER'),
+        beat_schedule={
+            'flush-usage': {
+                'task': 'app.tasks.worker_tasks.flush_usage',
+                'schedule': app.config.get('USAGE_FLUSH_INTERVAL')
+            },
+            'reconcile-gateway-routes': {
+                'task': 'app.tasks.worker_tasks.reconcile_gateway_routes',
+                'schedule': app.config.get('APISIX_RECONCILE_INTERVAL')
+            },
+            'prune-idempotency-keys': {
+                'task': 'app.tasks.worker_tasks.prune_idempotency_keys',
+                'schedule': 3600
+            },
+            'release-deferred-messages': {
+                'task': 'app.tasks.worker_tasks.release_deferred_messages',
+                'schedule': app.config.get('DEFERRED_POLL_INTERVAL'),
+                # A round the worker did not get to in time is covered by the next one
+                'options': {'expires': app.config.get('DEFERRED_POLL_INTERVAL') * 5}
+            },
+            'sync-worker-registry': {
+                'task': 'app.tasks.worker_tasks.sync_worker_registry',
+                'schedule': app.config.get('WORKER_SYNC_INTERVAL')
+            }
+        },
     )
     
     # Import tasks to register them with Celery
     # This is crucial - it registers the tasks with Celery
     from app.tasks import worker_tasks
+    from app.tasks import signals
     
     # Register blueprints
     from app.routes.queue_routes import queue_bp
     from app.routes.provider_routes import provider_bp
     from app.routes.worker_routes import worker_bp
     from app.routes.message_routes import message_bp
+    from app.routes.usage_routes import usage_bp
 
     app.register_blueprint(queue_bp, url_prefix='/api/v1')
     app.register_blueprint(provider_bp, url_prefix='/api/v1')
     app.register_blueprint(worker_bp, url_prefix='/api/v1')
     app.register_blueprint(message_bp, url_prefix='/api/v1')
+    app.register_blueprint(usage_bp, url_prefix='/api/v1')
+    
+    # Trace every API request, continuing any incoming trace context
+    if tracing.enabled():
+        @app.before_request
+        def start_request_span():
+            request.environ['ai_rate_limiter.span'] = tracing.start_span(
+                f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+                carrier={key.lower(): value for key, value in request.headers.items()},
+                attributes={'http.method': request.method, 'http.target': request.path}
+            )
+        
+        @app.teardown_request
+        def end_request_span(error=None):
+            tracing.end_span(request.environ.pop('ai_rate_limiter.span', None), error)
     
     # Health check endpoint
     @app.route('/health')
@@ -95,8 +155,25 @@ def create_app():
             'version': '1.0.0'
         })
     
+    # Prometheus metrics endpoint
+    @app.route('/metrics')
+    def metrics_endpoint():
+        from app.utils import metrics
+        try:
+            metrics.refresh_queue_backlog()
+        except Exception as e:
+            print(f"⚠️  Could not refresh queue backlog metrics: {e}")
+        body, content_type = metrics.render_latest()
+        return Response(body, mimetype=content_type)
+    
     # Create database tables (with error handling)
     with app.app_context():
+        from app.utils.metrics import instrument_engine
+        instrument_engine(db.engine)
+        tracing.instrument_engine(db.engine)
+        if db.engine.dialect.name == 'sqlite':
+            from app.embedded import configure_sqlite
+            configure_sqlite(db.engine)
         try:
             db.create_all()
             print("✅ Database tables created successfully")
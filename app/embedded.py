@@ -0,0 +1,110 @@
+"""
+Embedded mode: the API, workers, broker and limiter in one process
+
+With EMBEDDED_MODE=true the Celery broker is in memory, Redis is replaced by
+an in-process fakeredis, the database defaults to SQLite and providers are
+called directly. The Celery worker runs as a thread pool inside the API
+process, so messages go through the same MessageService and process_message
+code as a full deployment without any broker round trips.
+
+Run with: python run_embedded.py
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from celery.app.trace import setup_worker_optimizations
+from sqlalchemy import event
+from app import celery
+from app.config.config import Config
+from app.utils.celery_context import set_app
+
+EMBEDDED_HOSTNAME = 'embedded@localhost'
+
+_aggregator = None
+_aggregator_lock = threading.Lock()
+
+def configure_sqlite(engine) -> None:
+    """WAL journal so API reads are not blocked by worker writes"""
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, _):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+def _aggregate(batch_id: str) -> None:
+    from app.tasks.aggregator_consumer import handle_batch_complete
+    try:
+        handle_batch_complete({'batch_id': batch_id, 'event': 'batch_complete'})
+    except Exception as e:
+        print(f"❌ Aggregating batch {batch_id} failed: {e}")
+
+def aggregate_batch(batch_id: str) -> None:
+    """Aggregate a completed batch on a local thread instead of the batch_aggregator queue"""
+    global _aggregator
+    if _aggregator is None:
+        with _aggregator_lock:
+            if _aggregator is None:
+                _aggregator = ThreadPoolExecutor(max_workers=Config.EMBEDDED_AGGREGATOR_WORKERS,
+                                                 thread_name_prefix='aggregator')
+    _aggregator.submit(_aggregate, batch_id)
+
+class EmbeddedRuntime:
+    """Celery worker, beat and dispatcher running as threads of the API process"""
+
+    def __init__(self, app):
+        self.app = app
+        self.worker = None
+        self.beat = None
+        self.dispatcher = None
+
+    def start(self) -> None:
+        set_app(self.app)
+        celery.conf.update(
+            broker_transport_options={'polling_interval': Config.EMBEDDED_BROKER_POLL_INTERVAL},
+            worker_hijack_root_logger=False
+        )
+
+        # Pool threads have no current Celery app, point them at ours as the celery CLI does
+        setup_worker_optimizations(celery, EMBEDDED_HOSTNAME)
+        self.worker = celery.WorkController(
+            hostname=EMBEDDED_HOSTNAME,
+            pool_cls='threads',
+            concurrency=Config.EMBEDDED_WORKER_CONCURRENCY,
+            queues=[Config.CELERY_TASK_QUEUE, Config.CELERY_TIMER_QUEUE],
+            without_heartbeat=True,
+            without_mingle=True,
+            without_gossip=True
+        )
+        threading.Thread(target=self.worker.start, name='celery-worker', daemon=True).start()
+        # The worker runs without worker_ready, so register it in the worker registry here
+        from app.services.worker_registry import WorkerRegistry
+        WorkerRegistry.start(name=EMBEDDED_HOSTNAME)
+
+        # In-memory schedule, the beat has to share this process's broker
+        from celery.beat import EmbeddedService
+        self.beat = EmbeddedService(celery, thread=True, scheduler_cls='celery.beat:Scheduler')
+        self.beat.start()
+
+        if Config.SCHEDULER_ENABLED:
+            from app.tasks.scheduler import MessageDispatcher
+            self.dispatcher = MessageDispatcher()
+            threading.Thread(target=self._run_dispatcher, name='dispatcher', daemon=True).start()
+
+        print(f"✅ Embedded runtime started ({Config.EMBEDDED_WORKER_CONCURRENCY} worker threads, "
+              f"database {self.app.config['SQLALCHEMY_DATABASE_URI']})")
+
+    def _run_dispatcher(self) -> None:
+        with self.app.app_context():
+            self.dispatcher.run()
+
+    def stop(self) -> None:
+        if self.dispatcher:
+            self.dispatcher.stop()
+        if self.beat:
+            self.beat.stop()
+        if self.worker:
+            self.worker.stop(in_sighandler=False)
+            from app.services.worker_registry import WorkerRegistry
+            WorkerRegistry.stop()
+        if _aggregator:
+            _aggregator.shutdown(wait=True)
@@ -3,7 +3,7 @@ Batch model for managing batch processing
 """
 from datetime import datetime
 from app import db
-from sqlalchemy.dialects.postgresql import UUID
+from app.models.types import UUID
 import uuid
 
 class Batch(db.Model):
@@ -0,0 +1,32 @@
+"""
+Blob model for content-addressed storage of large texts
+"""
+from datetime import datetime
+from app import db
+
+class Blob(db.Model):
+    """Blob model storing large texts once, keyed by content hash"""
+    
+    __tablename__ = 'blobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    blob_hash = db.Column(db.String(64), unique=True, nullable=False)  # sha256 of the uncompressed text
+    compression = db.Column(db.String(10), default='none', nullable=False)  # zstd, zlib, none
+    size = db.Column(db.Integer, nullable=False)  # uncompressed size in bytes
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_referenced_at = db.Column(db.DateTime, default=datetime.utcnow)  # last put of this text, kept by cleanup
+    
+    def __repr__(self):
+        return f'<Blob {self.blob_hash}>'
+    
+    def to_dict(self):
+        """Convert to dictionary"""
+        return {
+            'blob_hash': self.blob_hash,
+            'compression': self.compression,
+            'size': self.size,
+            'stored_size': len(self.data) if self.data is not None else 0,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'last_referenced_at': self.last_referenced_at.isoformat() if self.last_referenced_at else None
+        }
@@ -0,0 +1,27 @@
+"""
+Idempotency key model backing Idempotency-Key headers on create requests
+"""
+from datetime import datetime
+from app import db
+from sqlalchemy.dialects.postgresql import JSON
+from app.models.types import UUID
+
+class IdempotencyKey(db.Model):
+    """A client's Idempotency-Key and the response its first request got"""
+    
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        db.UniqueConstraint('queue_id', 'key', name='uq_idempotency_key'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    queue_id = db.Column(db.String(64), nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)  # sha256 of the request body
+    batch_id = db.Column(UUID(as_uuid=True), nullable=False, index=True)
+    response = db.Column(JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    dispatched_at = db.Column(db.DateTime, nullable=True)  # set once the batch's messages were enqueued
+    
+    def __repr__(self):
+        return f'<IdempotencyKey {self.queue_id} {self.key}>'
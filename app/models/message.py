@@ -3,7 +3,8 @@ Message model for processing AI requests
 """
 from datetime import datetime
 from app import db
-from sqlalchemy.dialects.postgresql import UUID, JSON
+from sqlalchemy.dialects.postgresql import JSON
+from app.models.types import UUID
 import uuid
 import json
 
@@ -11,6 +12,12 @@ class Message(db.Model):
     """Message model for processing AI requests"""
     
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Backlog counts: pending messages per queue for /metrics, a queue's pending and processing for admission
+        db.Index('ix_messages_status_queue_id', 'status', 'queue_id'),
+        # The prompt is stored inline or as a blob, but always stored
+        db.CheckConstraint('prompt IS NOT NULL OR prompt_hash IS NOT NULL', name='ck_messages_prompt'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(UUID(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
@@ -18,12 +25,21 @@ class Message(db.Model):
     queue_id = db.Column(UUID(as_uuid=True), db.ForeignKey('queues.queue_id'), nullable=False)
     provider_id = db.Column(UUID(as_uuid=True), db.ForeignKey('providers.provider_id'), nullable=True)
     status = db.Column(db.String(50), default='pending', nullable=False)
-    prompt = db.Column(db.Text, nullable=False)
-    system_prompt = db.Column(db.Text, nullable=True)
-    result = db.Column(db.Text, nullable=True)
-    supportive_variable = db.Column(JSON, nullable=True)
+    priority = db.Column(db.SmallInteger, default=5, nullable=False)  # 0 lowest .. 9 highest
+    deadline = db.Column(db.DateTime, nullable=True)  # UTC
+    run_after = db.Column(db.DateTime, nullable=True)  # UTC, deferred until then
+    # Large text columns are deferred so status queries only load the small columns
+    prompt = db.deferred(db.Column(db.Text, nullable=True), group='content')
+    prompt_hash = db.Column(db.String(64), db.ForeignKey('blobs.blob_hash'), nullable=True)
+    system_prompt = db.deferred(db.Column(db.Text, nullable=True), group='content')
+    system_prompt_hash = db.Column(db.String(64), db.ForeignKey('blobs.blob_hash'), nullable=True)
+    result = db.deferred(db.Column(db.Text, nullable=True), group='content')
+    result_hash = db.Column(db.String(64), db.ForeignKey('blobs.blob_hash'), nullable=True)
+    supportive_variable = db.deferred(db.Column(JSON, nullable=True), group='content')
     error_message = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)  # UTC, last time a worker or provider batch took it
+    finished_at = db.Column(db.DateTime, nullable=True)  # UTC, when it was completed or failed
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def __repr__(self):
@@ -37,15 +53,80 @@ class Message(db.Model):
             'queue_id': str(self.queue_id),
             'provider_id': str(self.provider_id) if self.provider_id else None,
             'status': self.status,
-            'prompt': self.prompt,
-            'system_prompt': self.system_prompt,
-            'result': self.result,
+            'prompt': self.prompt_text,
+            'system_prompt': self.system_prompt_text,
+            'result': self.result_text,
             'supportive_variable': self.supportive_variable,
+            'priority': self.priority,
+            'deadline': self.deadline.isoformat() if self.deadline else None,
+            'run_after': self.run_after.isoformat() if self.run_after else None,
             'error_message': self.error_message,
             'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
     
+    def to_status_dict(self):
+        """Convert to dictionary without the large text columns"""
+        return {
+            'message_id': str(self.message_id),
+            'batch_id': str(self.batch_id) if self.batch_id else None,
+            'queue_id': str(self.queue_id),
+            'provider_id': str(self.provider_id) if self.provider_id else None,
+            'status': self.status,
+            'priority': self.priority,
+            'deadline': self.deadline.isoformat() if self.deadline else None,
+            'run_after': self.run_after.isoformat() if self.run_after else None,
+            'error_message': self.error_message,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+    
+    @property
+    def prompt_text(self):
+        """Get prompt, loading it from blob storage when externalized"""
+        from app.services.blob_service import BlobService
+        if self.prompt_hash:
+            return BlobService.get(self.prompt_hash, getattr(self, 'loaded_blobs', None))
+        return self.prompt
+    
+    @prompt_text.setter
+    def prompt_text(self, value):
+        """Set prompt, moving large values to blob storage"""
+        from app.services.blob_service import BlobService
+        self.prompt, self.prompt_hash = BlobService.externalize(value)
+    
+    @property
+    def system_prompt_text(self):
+        """Get system_prompt, loading it from blob storage when externalized"""
+        from app.services.blob_service import BlobService
+        if self.system_prompt_hash:
+            return BlobService.get(self.system_prompt_hash, getattr(self, 'loaded_blobs', None))
+        return self.system_prompt
+    
+    @system_prompt_text.setter
+    def system_prompt_text(self, value):
+        """Set system_prompt, moving large values to blob storage"""
+        from app.services.blob_service import BlobService
+        self.system_prompt, self.system_prompt_hash = BlobService.externalize(value)
+    
+    @property
+    def result_text(self):
+        """Get result, loading it from blob storage when externalized"""
+        from app.services.blob_service import BlobService
+        if self.result_hash:
+            return BlobService.get(self.result_hash, getattr(self, 'loaded_blobs', None))
+        return self.result
+    
+    @result_text.setter
+    def result_text(self, value):
+        """Set result, moving large values to blob storage"""
+        from app.services.blob_service import BlobService
+        self.result, self.result_hash = BlobService.externalize(value)
+    
     @property
     def supportive_variable_dict(self):
         """Get supportive_variable as dictionary"""
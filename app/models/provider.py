@@ -3,7 +3,8 @@ Provider model for AI service providers
 """
 from datetime import datetime
 from app import db
-from sqlalchemy.dialects.postgresql import UUID, JSON
+from sqlalchemy.dialects.postgresql import JSON
+from app.models.types import UUID
 import uuid
 import json
 
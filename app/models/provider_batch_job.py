@@ -0,0 +1,45 @@
+"""
+Provider batch job model for batches offloaded to a provider's Batch API
+"""
+from datetime import datetime
+from app import db
+from app.models.types import UUID
+import uuid
+
+class ProviderBatchJob(db.Model):
+    """One provider-side batch job covering some or all messages of a batch"""
+    
+    __tablename__ = 'provider_batch_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(UUID(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
+    batch_id = db.Column(UUID(as_uuid=True), db.ForeignKey('batches.batch_id'), nullable=False, index=True)
+    provider_id = db.Column(UUID(as_uuid=True), db.ForeignKey('providers.provider_id'), nullable=False)
+    external_batch_id = db.Column(db.String(255), nullable=True)  # the provider's batch id
+    input_file_id = db.Column(db.String(255), nullable=True)
+    output_file_id = db.Column(db.String(255), nullable=True)
+    error_file_id = db.Column(db.String(255), nullable=True)
+    status = db.Column(db.String(50), default='pending', nullable=False)  # the provider's job status
+    message_count = db.Column(db.Integer, default=0, nullable=False)
+    error_message = db.Column(db.Text, nullable=True)
+    applied_at = db.Column(db.DateTime, nullable=True)  # results written back to the messages
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ProviderBatchJob {self.external_batch_id}>'
+    
+    def to_dict(self):
+        """Convert to dictionary"""
+        return {
+            'job_id': str(self.job_id),
+            'batch_id': str(self.batch_id),
+            'provider_id': str(self.provider_id),
+            'external_batch_id': self.external_batch_id,
+            'status': self.status,
+            'message_count': self.message_count,
+            'error_message': self.error_message,
+            'applied_at': self.applied_at.isoformat() if self.applied_at else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
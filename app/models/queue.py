@@ -3,9 +3,13 @@ Queue model for managing message queues
 """
 from datetime import datetime
 from app import db
-from sqlalchemy.dialects.postgresql import UUID
+from app.models.types import UUID
 import uuid
 
+# realtime sends every message through the gateway, provider_batch offloads
+# large batches to the provider's Batch API
+PROCESSING_MODES = ('realtime', 'provider_batch')
+
 class Queue(db.Model):
     """Queue model for managing message queues"""
     
@@ -14,6 +18,9 @@ class Queue(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     queue_id = db.Column(UUID(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
     queue_name = db.Column(db.String(255), nullable=True)
+    processing_mode = db.Column(db.String(50), default='realtime', nullable=False)  # realtime, provider_batch
+    hedging = db.Column(db.Boolean, default=False, nullable=False)  # duplicate slow requests to a second provider
+    weight = db.Column(db.Integer, default=1, nullable=False)  # share of workers when queues compete
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -30,6 +37,9 @@ class Queue(db.Model):
         return {
             'queue_id': str(self.queue_id),
             'queue_name': self.queue_name,
+            'processing_mode': self.processing_mode,
+            'hedging': self.hedging,
+            'weight': self.weight,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         } 
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""
+Column types shared by the models
+"""
+import uuid
+from sqlalchemy.types import TypeDecorator, Uuid
+
+class UUID(TypeDecorator):
+    """UUID column, native on Postgres and CHAR(32) on SQLite, that also binds str ids"""
+
+    impl = Uuid
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return uuid.UUID(value)
+        return value
@@ -0,0 +1,42 @@
+"""
+Usage rollup model for aggregated provider usage and cost
+"""
+from datetime import datetime
+from app import db
+
+class UsageRollup(db.Model):
+    """Usage of one provider, queue or batch over one minute or hour"""
+
+    __tablename__ = 'usage_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'scope_id', 'granularity', 'bucket_start', name='uq_usage_rollup_bucket'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(20), nullable=False)  # provider, queue, batch
+    scope_id = db.Column(db.String(64), nullable=False)
+    granularity = db.Column(db.String(10), nullable=False)  # minute, hour
+    bucket_start = db.Column(db.DateTime, nullable=False, index=True)
+    requests = db.Column(db.Integer, default=0, nullable=False)
+    errors = db.Column(db.Integer, default=0, nullable=False)
+    prompt_tokens = db.Column(db.BigInteger, default=0, nullable=False)
+    completion_tokens = db.Column(db.BigInteger, default=0, nullable=False)
+    latency_ms = db.Column(db.BigInteger, default=0, nullable=False)  # sum over all requests
+    cost_microusd = db.Column(db.BigInteger, default=0, nullable=False)  # millionths of a dollar
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<UsageRollup {self.scope} {self.scope_id} {self.granularity} {self.bucket_start}>'
+
+    def to_dict(self):
+        """Convert to dictionary"""
+        return {
+            'bucket_start': self.bucket_start.isoformat(),
+            'requests': self.requests,
+            'errors': self.errors,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'total_tokens': self.prompt_tokens + self.completion_tokens,
+            'avg_latency_ms': round(self.latency_ms / self.requests, 1) if self.requests else None,
+            'cost': self.cost_microusd / 1000000
+        }
@@ -3,7 +3,7 @@ Worker model for managing Celery workers
 """
 from datetime import datetime
 from app import db
-from sqlalchemy.dialects.postgresql import UUID
+from app.models.types import UUID
 import uuid
 
 class Worker(db.Model):
@@ -19,6 +19,12 @@ class Worker(db.Model):
     log_file = db.Column(db.String(255), nullable=True)
     started_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_heartbeat = db.Column(db.DateTime, default=datetime.utcnow)
+    hostname = db.Column(db.String(255), nullable=True, index=True)  # host:pid of the Celery main process
+    in_flight = db.Column(db.Integer, default=0)
+    processed_count = db.Column(db.Integer, default=0)
+    failed_count = db.Column(db.Integer, default=0)
+    throughput = db.Column(db.Float, default=0.0)  # messages per second over WORKER_STATS_WINDOW
+    error_rate = db.Column(db.Float, default=0.0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -35,6 +41,12 @@ class Worker(db.Model):
             'log_file': self.log_file,
             'started_at': self.started_at.isoformat() if self.started_at else None,
             'last_heartbeat': self.last_heartbeat.isoformat() if self.last_heartbeat else None,
+            'hostname': self.hostname,
+            'in_flight': self.in_flight,
+            'processed_count': self.processed_count,
+            'failed_count': self.failed_count,
+            'throughput': self.throughput,
+            'error_rate': self.error_rate,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         } 
\ No newline at end of file
@@ -1,12 +1,38 @@
 """
 Message routes for processing AI requests
 """
-from flask import Blueprint, request, jsonify
+import json
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from app.config.config import Config
+from app.services.batch_progress_service import BatchProgressService
+from app.services.idempotency_service import IdempotencyService
+from app.services.ingest_service import IngestService
 from app.services.message_service import MessageService
-from app.utils.exceptions import QueueNotFoundError, MessageNotFoundError
+from app.services.stream_service import StreamService
+from app.utils.exceptions import (
+    AdmissionRejectedError, BatchNotFoundError, IdempotencyConflictError, QueueNotFoundError, MessageNotFoundError, UploadError
+)
 
 message_bp = Blueprint('message', __name__)
 
+def _created(result, replayed: bool, status: int = 201):
+    """Response for a create request, marked when it replays an earlier one"""
+    response = jsonify(result)
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response, status
+
+def _rejected(error: AdmissionRejectedError):
+    """429 for work the queue cannot take yet, with when to retry"""
+    response = jsonify({
+        'message': str(error),
+        'retry_after': error.retry_after,
+        'estimated_start': error.estimated_start.isoformat() if error.estimated_start else None,
+        'success': False
+    })
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
 @message_bp.route('/message/create', methods=['POST'])
 def create_message():
     """Create messages with batch_id and message_id generation - supports single message or batch of messages"""
@@ -23,17 +49,79 @@ def create_message():
             if not data.get('prompt'):
                 return jsonify({'message': 'prompt is required', 'success': False}), 400
             
-            result = MessageService.create_message(data)
+            create = lambda before_commit: MessageService.create_message(data, before_commit)
         elif 'messages' in data:
             # Batch of messages
             if not data.get('messages'):
                 return jsonify({'message': 'messages list is required', 'success': False}), 400
+            if len(data['messages']) > Config.MAX_BATCH_SIZE:
+                return jsonify({
+                    'message': f"A batch can contain at most {Config.MAX_BATCH_SIZE} messages, "
+                               f"use /batch/upload for larger jobs",
+                    'success': False
+                }), 400
             
-            result = MessageService.create_batch_messages(data)
+            create = lambda before_commit: MessageService.create_batch_messages(data, before_commit)
         else:
             return jsonify({'message': 'Either prompt (single message) or messages (batch) is required', 'success': False}), 400
         
-        return jsonify(result), 201
+        # Retries carrying the same Idempotency-Key get the first response back
+        result, replayed = IdempotencyService.execute(
+            data['queue_id'], request.headers.get('Idempotency-Key'), data, create, MessageService.redispatch
+        )
+        return _created(result, replayed)
+    except IdempotencyConflictError as e:
+        return jsonify({'message': str(e), 'success': False}), 409
+    except AdmissionRejectedError as e:
+        return _rejected(e)
+    except QueueNotFoundError as e:
+        return jsonify({
+            'message': str(e),
+            'registration_required': True,
+            'success': False
+        }), 404
+    except ValueError as e:
+        return jsonify({'message': str(e), 'success': False}), 400
+    except Exception as e:
+        return jsonify({'message': str(e), 'success': False}), 500
+
+@message_bp.route('/batch/upload', methods=['POST'])
+def upload_batch():
+    """Create a batch from a streamed JSONL upload (raw or multipart, optionally gzip)"""
+    try:
+        # Raw bodies carry their options in the query string, multipart uploads in form fields
+        if request.mimetype == 'multipart/form-data':
+            params = request.form
+            upload = request.files.get('file')
+            if upload is None:
+                return jsonify({'message': 'file is required', 'success': False}), 400
+            stream = upload.stream
+        else:
+            params = request.args
+            stream = request.stream
+        
+        if not params.get('queue_id'):
+            return jsonify({'message': 'queue_id is required', 'success': False}), 400
+        
+        # The body is not read for a replay, so the key covers the upload's parameters
+        result, replayed = IdempotencyService.execute(
+            params.get('queue_id'), request.headers.get('Idempotency-Key'), params.to_dict(),
+            lambda before_commit: IngestService.create_upload_batch(
+                queue_id=params.get('queue_id'),
+                stream=stream,
+                webhook_url=params.get('webhook_url'),
+                webhook_event=params.get('webhook_event', 'on_complete'),
+                before_commit=before_commit
+            ),
+            lambda batch_id: IngestService.redispatch(batch_id, params.get('queue_id'))
+        )
+        return _created(result, replayed, 202)
+    except IdempotencyConflictError as e:
+        return jsonify({'message': str(e), 'success': False}), 409
+    except AdmissionRejectedError as e:
+        return _rejected(e)
+    except (UploadError, ValueError) as e:
+        return jsonify({'message': str(e), 'success': False}), 400
     except QueueNotFoundError as e:
         return jsonify({
             'message': str(e),
@@ -54,6 +142,53 @@ def read_message(message_id):
     except Exception as e:
         return jsonify({'message': str(e), 'success': False}), 500
 
+@message_bp.route('/message/status/<message_id>', methods=['GET'])
+def read_message_status(message_id):
+    """Read a message's status without prompt or result"""
+    try:
+        result = MessageService.get_message_status(message_id)
+        return jsonify(result), 200
+    except MessageNotFoundError as e:
+        return jsonify({'message': str(e), 'success': False}), 404
+    except Exception as e:
+        return jsonify({'message': str(e), 'success': False}), 500
+
+@message_bp.route('/message/stream/<message_id>', methods=['GET'])
+def stream_message(message_id):
+    """Stream a message's tokens as server-sent events"""
+    try:
+        if not StreamService.is_streamed(message_id):
+            # Not streamed, or the buffer expired: answer with the stored result if there is one
+            message = MessageService.get_message(message_id)['data']
+            if message['status'] not in ('completed', 'failed'):
+                return jsonify({
+                    'message': 'Message was not created with stream: true',
+                    'success': False
+                }), 400
+            if message['status'] == 'completed':
+                event = {'seq': 1, 'type': 'done', 'content': message['result']}
+            else:
+                event = {'seq': 1, 'type': 'error', 'error': message['error_message']}
+            return Response(_sse(event), mimetype='text/event-stream')
+        
+        def generate():
+            for event in StreamService.events(message_id):
+                yield _sse(event) if event is not None else ': keep-alive\n\n'
+        
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    except MessageNotFoundError as e:
+        return jsonify({'message': str(e), 'success': False}), 404
+    except Exception as e:
+        return jsonify({'message': str(e), 'success': False}), 500
+
+def _sse(event):
+    """Format one event as a server-sent event"""
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
 @message_bp.route('/message/delete/<message_id>', methods=['DELETE'])
 def delete_message(message_id):
     """Delete a message by message_id"""
@@ -74,6 +209,17 @@ def get_batch_messages(batch_id):
     except Exception as e:
         return jsonify({'message': str(e), 'success': False}), 500
 
+@message_bp.route('/batch/<batch_id>/progress', methods=['GET'])
+def get_batch_progress(batch_id):
+    """Get a batch's progress, completion rate and projected completion time"""
+    try:
+        result = BatchProgressService.get_progress(batch_id)
+        return jsonify(result), 200
+    except BatchNotFoundError as e:
+        return jsonify({'message': str(e), 'success': False}), 404
+    except Exception as e:
+        return jsonify({'message': str(e), 'success': False}), 500
+
 @message_bp.route('/batch/<batch_id>/results', methods=['GET'])
 def get_batch_results(batch_id):
     """Get batch results (CSV or JSON)"""
@@ -108,7 +254,6 @@ def get_batch_results(batch_id):
                     result.get('error_message', '')
                 ])
             
-            from flask import Response
             return Response(
                 output.getvalue(),
                 mimetype='text/csv',
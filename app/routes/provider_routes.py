@@ -5,6 +5,9 @@ from flask import Blueprint, request, jsonify
 from app import db
 from app.models.provider import Provider
 from app.models.queue import Queue
+from app.services.admission_service import AdmissionService
+from app.services.circuit_breaker import CircuitBreaker
+from app.tasks.worker_tasks import sync_gateway_route
 from app.utils.exceptions import ProviderNotFoundError, QueueNotFoundError
 
 provider_bp = Blueprint('provider', __name__)
@@ -57,6 +60,8 @@ def create_provider():
         
         db.session.add(provider)
         db.session.commit()
+        AdmissionService.forget_providers(provider.queue_id)
+        sync_gateway_route.delay(str(provider.provider_id))
         
         return jsonify({
             'success': True,
@@ -77,6 +82,8 @@ def update_provider(provider_id):
         if not provider:
             raise ProviderNotFoundError(f"Provider {provider_id} not found")
         
+        previous_queue_id = provider.queue_id
+        
         # Update fields
         if 'queue_id' in data:
             provider.queue_id = data['queue_id']
@@ -92,6 +99,8 @@ def update_provider(provider_id):
             provider.config = data['config']
         
         db.session.commit()
+        AdmissionService.forget_providers(previous_queue_id, provider.queue_id)
+        sync_gateway_route.delay(str(provider.provider_id))
         
         return jsonify({
             'success': True,
@@ -102,6 +111,23 @@ def update_provider(provider_id):
     except Exception as e:
         return jsonify({'message': str(e), 'success': False}), 500
 
+@provider_bp.route('/provider/health/<provider_id>', methods=['GET'])
+def get_provider_health(provider_id):
+    """Get a provider's circuit breaker state and recent error rate and latency"""
+    try:
+        provider = Provider.query.filter_by(provider_id=provider_id).first()
+        if not provider:
+            raise ProviderNotFoundError(f"Provider {provider_id} not found")
+        
+        return jsonify({
+            'success': True,
+            'data': CircuitBreaker.health(provider)
+        }), 200
+    except ProviderNotFoundError as e:
+        return jsonify({'message': str(e), 'success': False}), 404
+    except Exception as e:
+        return jsonify({'message': str(e), 'success': False}), 500
+
 @provider_bp.route('/provider/delete/<provider_id>', methods=['DELETE'])
 def delete_provider(provider_id):
     """Delete a provider"""
@@ -110,8 +136,11 @@ def delete_provider(provider_id):
         if not provider:
             raise ProviderNotFoundError(f"Provider {provider_id} not found")
         
+        queue_id = provider.queue_id
         db.session.delete(provider)
         db.session.commit()
+        AdmissionService.forget_providers(queue_id)
+        sync_gateway_route.delay(str(provider_id))
         
         return jsonify({
             'success': True,
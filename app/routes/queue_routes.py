@@ -2,6 +2,7 @@
 Queue routes for managing message queues
 """
 from flask import Blueprint, request, jsonify
+from app.models.queue import PROCESSING_MODES
 from app.services.queue_service import QueueService
 from app.utils.exceptions import QueueNotFoundError, QueueAlreadyExistsError
 
@@ -41,7 +42,19 @@ def create_queue():
         if not providers:
             return jsonify({'message': 'providers list is required', 'success': False}), 400
         
-        result = QueueService.create_queue(queue_id, providers)
+        processing_mode = data.get('processing_mode', 'realtime')
+        if processing_mode not in PROCESSING_MODES:
+            return jsonify({
+                'message': f"processing_mode must be one of {', '.join(PROCESSING_MODES)}",
+                'success': False
+            }), 400
+        
+        weight = data.get('weight', 1)
+        if isinstance(weight, bool) or not isinstance(weight, int) or weight < 1:
+            return jsonify({'message': 'weight must be a positive integer', 'success': False}), 400
+        
+        result = QueueService.create_queue(queue_id, providers, processing_mode,
+                                           bool(data.get('hedging', False)), weight)
         return jsonify(result), 201
     except QueueAlreadyExistsError as e:
         return jsonify({'message': str(e), 'success': False}), 400
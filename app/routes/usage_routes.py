@@ -0,0 +1,34 @@
+"""
+Usage routes for provider, queue and batch usage and cost
+"""
+from datetime import datetime
+from flask import Blueprint, request, jsonify
+from app.services.usage_service import UsageService
+
+usage_bp = Blueprint('usage', __name__)
+
+def _parse_time(value):
+    """Naive UTC datetime from an ISO 8601 query parameter"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = (parsed - parsed.utcoffset()).replace(tzinfo=None)
+    return parsed
+
+@usage_bp.route('/usage/<scope>/<scope_id>', methods=['GET'])
+def get_usage(scope, scope_id):
+    """Get usage of a provider, queue or batch from the rollups"""
+    try:
+        result = UsageService.get_usage(
+            scope,
+            scope_id,
+            granularity=request.args.get('granularity', 'hour'),
+            start=_parse_time(request.args.get('start')),
+            end=_parse_time(request.args.get('end'))
+        )
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({'message': str(e), 'success': False}), 400
+    except Exception as e:
+        return jsonify({'message': str(e), 'success': False}), 500
@@ -8,6 +8,7 @@ from flask import Blueprint, request, jsonify
 from app import db
 from app.models.worker import Worker
 from app.models.queue import Queue
+from app.services.worker_registry import WorkerRegistry
 from app.utils.exceptions import WorkerNotFoundError, QueueNotFoundError
 
 worker_bp = Blueprint('worker', __name__)
@@ -74,6 +75,14 @@ def create_worker(queue_id):
     except Exception as e:
         return jsonify({'message': str(e), 'success': False}), 500
 
+@worker_bp.route('/workers', methods=['GET'])
+def list_workers():
+    """List live workers with their throughput, from heartbeats"""
+    try:
+        return jsonify({'success': True, 'data': WorkerRegistry.fleet()}), 200
+    except Exception as e:
+        return jsonify({'message': str(e), 'success': False}), 500
+
 @worker_bp.route('/worker/logs/<worker_id>', methods=['GET'])
 def get_worker_logs(worker_id):
     """Get worker logs"""
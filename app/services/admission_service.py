@@ -0,0 +1,151 @@
+"""
+Admission control for message creation
+
+A queue drains at most as fast as its providers' limit per time_window
+allows. Work that would wait longer than ADMISSION_MAX_DRAIN_SECONDS behind
+the queue's backlog, or push the backlog past ADMISSION_MAX_BACKLOG messages,
+is turned away with a Retry-After instead of ageing in RabbitMQ and the
+database, which keeps latency predictable for the work that is accepted.
+
+The backlog is a Redis counter: accepted messages are added to it and
+finished ones taken off, so reading it costs no query. It is recounted from
+the database every ADMISSION_BACKLOG_REFRESH seconds, which corrects any
+drift from a worker that died between its commit and its count. The queue's
+provider limits, which give its drain rate, are cached in Redis for
+ADMISSION_PROVIDER_CACHE_TTL seconds or until a provider changes.
+"""
+import json
+import math
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import List
+from app.config.config import Config
+from app.models.message import Message
+from app.models.provider import Provider
+from app.services.provider_batch_service import ProviderBatchService
+from app.services.redis_service import RedisService
+from app.utils import metrics
+from app.utils.exceptions import AdmissionRejectedError
+
+BACKLOG_STATUSES = ('pending', 'processing')
+NO_RATE_RETRY_AFTER = 5  # seconds, when the queue's providers give no drain rate to estimate from
+
+class AdmissionService:
+    """Service for accepting or turning away new work by queue backlog"""
+
+    @staticmethod
+    def _backlog_key(queue_id) -> str:
+        return f"admission:{uuid.UUID(str(queue_id))}:backlog"
+
+    @staticmethod
+    def _providers_key(queue_id) -> str:
+        return f"admission:{uuid.UUID(str(queue_id))}:providers"
+
+    @classmethod
+    def providers(cls, queue_id) -> List[SimpleNamespace]:
+        """The queue's providers with their provider_id, limit and time_window, from the cache when it has them"""
+        client = RedisService.get_client()
+        cached = client.get(cls._providers_key(queue_id))
+        if cached is None:
+            rows = Provider.query.with_entities(
+                Provider.provider_id, Provider.limit, Provider.time_window
+            ).filter_by(queue_id=uuid.UUID(str(queue_id))).all()
+            cached = json.dumps([[str(row.provider_id), row.limit, row.time_window] for row in rows])
+            client.set(cls._providers_key(queue_id), cached, ex=Config.ADMISSION_PROVIDER_CACHE_TTL)
+        return [
+            SimpleNamespace(provider_id=provider_id, limit=limit, time_window=time_window)
+            for provider_id, limit, time_window in json.loads(cached)
+        ]
+
+    @classmethod
+    def forget_providers(cls, *queue_ids) -> None:
+        """Drop cached provider limits after a provider of these queues was added, changed or removed"""
+        RedisService.get_client().delete(*[cls._providers_key(queue_id) for queue_id in queue_ids if queue_id])
+
+    @classmethod
+    def drain_rate(cls, queue_id) -> float:
+        """Messages per second the queue's providers allow together"""
+        return sum(provider.limit / provider.time_window
+                   for provider in cls.providers(queue_id) if provider.time_window)
+
+    @classmethod
+    def backlog(cls, queue_id) -> int:
+        """Pending and processing messages of a queue"""
+        client = RedisService.get_client()
+        cached = client.get(cls._backlog_key(queue_id))
+        if cached is not None:
+            return int(cached)
+        count = Message.query.filter(
+            Message.queue_id == queue_id,
+            Message.status.in_(BACKLOG_STATUSES)
+        ).count()
+        if not client.set(cls._backlog_key(queue_id), count, ex=Config.ADMISSION_BACKLOG_REFRESH, nx=True):
+            # Another reader recounted first, and messages may have been counted into it since
+            return cls.backlog(queue_id)
+        return count
+
+    @classmethod
+    def admit(cls, queue, message_count: int) -> None:
+        """Check that a queue can take message_count more messages, raising AdmissionRejectedError if not"""
+        if not Config.ADMISSION_MAX_DRAIN_SECONDS and not Config.ADMISSION_MAX_BACKLOG:
+            return
+        # Provider Batch API jobs are not drained through the queue's rate limit
+        if ProviderBatchService.get_offload_provider(queue.queue_id, message_count):
+            return
+
+        queue_id = str(queue.queue_id)
+        rate = cls.drain_rate(queue_id)
+        max_drain = Config.ADMISSION_MAX_DRAIN_SECONDS if rate > 0 else 0
+        if Config.ADMISSION_MAX_BACKLOG and message_count > Config.ADMISSION_MAX_BACKLOG:
+            raise ValueError(f"Queue {queue_id} accepts at most {Config.ADMISSION_MAX_BACKLOG} "
+                             f"waiting messages, split the request")
+        if max_drain and message_count / rate > max_drain:
+            raise ValueError(f"{message_count} messages take longer than {max_drain}s to drain "
+                             f"at queue {queue_id}'s provider limits, split the request")
+
+        backlog = cls.backlog(queue_id)
+        total = backlog + message_count
+        waits = {}
+        if Config.ADMISSION_MAX_BACKLOG and total > Config.ADMISSION_MAX_BACKLOG:
+            waits['backlog'] = (total - Config.ADMISSION_MAX_BACKLOG) / rate if rate > 0 else NO_RATE_RETRY_AFTER
+        if max_drain and total / rate > max_drain:
+            waits['drain_time'] = total / rate - max_drain
+        if not waits:
+            return
+
+        reason = max(waits, key=waits.get)
+        retry_after = max(math.ceil(waits[reason]), 1)
+        metrics.ADMISSION_REJECTED.labels(queue=metrics.bounded('queue', queue_id), reason=reason).inc()
+        raise AdmissionRejectedError(
+            f"Queue {queue_id} has {backlog} messages waiting, retry in {retry_after}s",
+            retry_after,
+            datetime.utcnow() + timedelta(seconds=backlog / rate) if rate > 0 else None
+        )
+
+    @classmethod
+    def _count(cls, queue_id, change: int) -> None:
+        client = RedisService.get_client()
+        key = cls._backlog_key(queue_id)
+        if not client.exists(key):
+            return  # the next read counts them from the database
+        pipe = client.pipeline(transaction=True)
+        pipe.incrby(key, change)
+        # Should the count have lapsed meanwhile, the new one lapses just as soon
+        pipe.expire(key, Config.ADMISSION_BACKLOG_REFRESH, nx=True)
+        pipe.execute()
+
+    @classmethod
+    def accepted(cls, queue_id, message_count: int) -> None:
+        """Count newly created messages into the queue's backlog"""
+        cls._count(queue_id, message_count)
+
+    @classmethod
+    def finished(cls, queue_id, message_count: int = 1) -> None:
+        """Take completed, failed, deferred or deleted messages off the queue's backlog"""
+        cls._count(queue_id, -message_count)
+
+    @classmethod
+    def reset(cls, queue_id) -> None:
+        """Drop the queue's backlog count, after its messages were removed in bulk"""
+        RedisService.get_client().delete(cls._backlog_key(queue_id))
@@ -3,48 +3,288 @@ APISIX service for rate limiting and API gateway integration
 """
 import requests
 import json
-from typing import Dict, Any
+import time
+from typing import Callable, Dict, Any, List
 from app.config.config import Config
-from app.utils.exceptions import APISIXError
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.concurrency_limiter import ConcurrencyLimiter
+from app.services.provider_adapters import completion, get_adapter
+from app.services.redis_service import RedisService
+from app.utils.cancellation import Cancellation
+from app.utils.exceptions import (APISIXError, CircuitOpenError, ConcurrencyLimitError, RateLimitExceededError,
+                                  RequestCancelledError)
+from app.utils import metrics, tracing
+
+QUOTA_REMAINING_HEADERS = ('x-ratelimit-remaining-requests', 'x-ratelimit-remaining',
+                           'anthropic-ratelimit-requests-remaining')
+GATEWAY_FAILURE_STATUSES = (502, 503, 504)
+UPSTREAM_STATUS_HEADER = 'X-APISIX-Upstream-Status'  # set by APISIX when the 5xx came from the provider
 
 class APISIXService:
     """Service for APISIX operations"""
     
     @staticmethod
-    def send_request(provider, request_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Send request through APISIX gateway"""
+    def _is_gateway_failure(response) -> bool:
+        """True when the gateway itself failed or has no route for the provider yet"""
+        if response.status_code in GATEWAY_FAILURE_STATUSES:
+            # A provider's own 5xx is passed on with its upstream status, calling
+            # the same provider directly would not go any better
+            return UPSTREAM_STATUS_HEADER not in response.headers
+        # Until the route is reconciled APISIX answers 404 Route Not Found.
+        # Its 429s are the provider's own limit, so they are not a reason to go direct
+        return response.status_code == 404 and 'Route Not Found' in response.text
+    
+    @staticmethod
+    def _check_cancelled(provider, cancellation: Cancellation = None, response=None) -> None:
+        """Raise RequestCancelledError for a cancelled request, which records no outcome and is not retried"""
+        if cancellation is not None and cancellation.cancelled:
+            if response is not None:
+                response.close()
+            raise RequestCancelledError(f"Request to provider {provider.provider_id} was cancelled")
+    
+    @staticmethod
+    def _post(provider, adapter, body: Dict[str, Any], stream: bool = False, cancellation: Cancellation = None):
+        """POST through the gateway, or straight to the provider when the gateway is off or unusable"""
+        provider_label = metrics.bounded('provider', provider.provider_id)
+        timeout = CircuitBreaker.before_request(provider)
+        counted_at = time.time()
+        used = RedisService.count_provider_request(str(provider.provider_id), provider.time_window)
+        if cancellation is not None:
+            # A cancelled request's answer is thrown away, so it does not spend the provider's quota
+            cancellation.on_cancel(lambda: RedisService.refund_provider_request(
+                str(provider.provider_id), provider.time_window, counted_at
+            ))
+        
+        if Config.GATEWAY_ENABLED:
+            try:
+                response, started = APISIXService._timed_post(provider, provider_label, adapter.gateway_url(provider),
+                                                              adapter.headers(provider), body, stream, timeout,
+                                                              cancellation)
+                APISIXService._check_cancelled(provider, cancellation, response)
+                if not (Config.DIRECT_FALLBACK_ENABLED and APISIXService._is_gateway_failure(response)):
+                    APISIXService._record_outcome(provider, response, started)
+                    return response, provider_label, started
+                response.close()
+                reason = 'no_route' if response.status_code == 404 else 'unavailable'
+            except requests.exceptions.ReadTimeout:
+                APISIXService._check_cancelled(provider, cancellation)
+                # The gateway is up but the provider did not answer in time
+                CircuitBreaker.record(provider, succeeded=False, timeout=timeout)
+                raise
+            except requests.exceptions.RequestException:
+                APISIXService._check_cancelled(provider, cancellation)
+                if not Config.DIRECT_FALLBACK_ENABLED:
+                    raise
+                reason = 'unavailable'
+            print(f"⚠️  APISIX {reason} for {provider.provider_type} provider {provider.provider_id}, calling it directly")
+            metrics.PROVIDER_DIRECT_FALLBACK.labels(provider_type=provider.provider_type, reason=reason).inc()
+        
+        # Direct calls are held to the provider's own limit and time window
+        if used > provider.limit:
+            raise RateLimitExceededError(
+                f"Provider {provider.provider_id} used its {provider.limit} requests per {provider.time_window}s",
+                retry_after=provider.time_window - time.time() % provider.time_window
+            )
         try:
-            # For now, only support OpenAI through APISIX
-            if provider.provider_type == 'openai':
-                apisix_endpoint = f"{Config.APISIX_GATEWAY_URL}/v1/chat/completions/openai"
-            else:
-                # For other providers, we'll implement direct API calls later
-                raise APISIXError(f"Provider {provider.provider_type} not yet supported through APISIX")
-            
-            # Prepare headers with API key
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f"Bearer {provider.config_dict.get('api_key')}"
-            }
-            
-            # Send request to APISIX gateway
-            response = requests.post(
-                apisix_endpoint,
-                json=request_data,
-                headers=headers,
-                timeout=60
+            response, started = APISIXService._timed_post(provider, provider_label, adapter.direct_url(provider),
+                                                          adapter.headers(provider), body, stream, timeout,
+                                                          cancellation)
+        except requests.exceptions.ReadTimeout:
+            APISIXService._check_cancelled(provider, cancellation)
+            CircuitBreaker.record(provider, succeeded=False, timeout=timeout)
+            raise
+        except requests.exceptions.RequestException:
+            APISIXService._check_cancelled(provider, cancellation)
+            CircuitBreaker.record(provider, succeeded=False)
+            raise
+        APISIXService._check_cancelled(provider, cancellation, response)
+        APISIXService._record_outcome(provider, response, started)
+        return response, provider_label, started
+    
+    @staticmethod
+    def _retry_after(provider, response) -> float:
+        """Seconds before a 429 is worth retrying, from its headers or the provider's window"""
+        # Retry-After from the provider, X-RateLimit-Reset from the gateway's limit-count
+        for header in ('retry-after', 'x-ratelimit-reset'):
+            try:
+                return max(float(response.headers[header]), 1.0)
+            except (KeyError, ValueError):
+                continue
+        return provider.time_window - time.time() % provider.time_window
+    
+    @staticmethod
+    def _raise_rate_limited(provider, response) -> None:
+        """Turn a 429 into RateLimitExceededError, so the message waits instead of failing"""
+        if response.status_code == 429:
+            raise RateLimitExceededError(
+                f"Provider {provider.provider_id} is rate limited: {response.text}",
+                retry_after=APISIXService._retry_after(provider, response)
             )
+    
+    @staticmethod
+    def _record_outcome(provider, response, started: float) -> None:
+        """Feed a provider response to its circuit breaker, 429s say nothing about health"""
+        if response.status_code == 429:
+            return
+        CircuitBreaker.record(provider, succeeded=response.status_code < 500,
+                              latency=time.perf_counter() - started)
+    
+    @staticmethod
+    def _timed_post(provider, provider_label: str, url: str, headers: Dict[str, str],
+                    body: Dict[str, Any], stream: bool, timeout: float, cancellation: Cancellation = None):
+        """POST one provider request and return it with its start time"""
+        started = time.perf_counter()
+        try:
+            with tracing.span('http.post provider', kind='client', attributes={
+                'http.url': url.split('?')[0],
+                'provider.type': provider.provider_type
+            }):
+                # A cancellable request gets its own session, whose connection cancel can shut down
+                response = (cancellation.session if cancellation is not None else requests).post(
+                    url,
+                    json=body,
+                    headers=tracing.inject_headers(headers),
+                    stream=stream,
+                    timeout=timeout
+                )
+                tracing.set_attribute('http.status_code', response.status_code)
+        except requests.exceptions.RequestException:
+            if cancellation is None or not cancellation.cancelled:
+                metrics.PROVIDER_REQUEST_LATENCY.labels(
+                    provider_type=provider.provider_type, provider=provider_label, outcome='error'
+                ).observe(time.perf_counter() - started)
+            raise
+        return response, started
+    
+    @staticmethod
+    def send_request(provider, request_data: Dict[str, Any], cancellation: Cancellation = None) -> Dict[str, Any]:
+        """Send request through APISIX gateway, falling back to the provider's API
+        
+        A request with a cancellation stops as soon as it is cancelled, gives back
+        its concurrency slot and quota, and raises RequestCancelledError.
+        """
+        try:
+            adapter = get_adapter(provider.provider_type)
+            with ConcurrencyLimiter.slot(provider, cancellation):
+                response, provider_label, started = APISIXService._post(
+                    provider, adapter, adapter.build_request(provider, request_data), cancellation=cancellation
+                )
+                APISIXService._record_response_metrics(provider, provider_label, response, started)
+                APISIXService._raise_rate_limited(provider, response)
+                
+                if response.status_code != 200:
+                    raise APISIXError(f"APISIX request failed: {response.status_code} - {response.text}")
+                
+                return adapter.parse_response(response.json())
             
-            if response.status_code != 200:
-                raise APISIXError(f"APISIX request failed: {response.status_code} - {response.text}")
+        except requests.exceptions.RequestException as e:
+            APISIXService._check_cancelled(provider, cancellation)
+            raise APISIXError(f"Request to APISIX failed: {str(e)}")
+        except (APISIXError, CircuitOpenError, ConcurrencyLimitError, RateLimitExceededError, RequestCancelledError):
+            raise
+        except Exception as e:
+            APISIXService._check_cancelled(provider, cancellation)
+            raise APISIXError(f"APISIX service error: {str(e)}")
+        finally:
+            if cancellation is not None:
+                cancellation.close()
+    
+    @staticmethod
+    def send_streaming_request(provider, request_data: Dict[str, Any],
+                               on_delta: Callable[[str], None]) -> Dict[str, Any]:
+        """Send a streaming request through APISIX, calling on_delta for each content token
+        
+        Returns the assembled completion, with the full text under 'content'.
+        Providers without OpenAI-style streaming answer in one delta.
+        """
+        adapter = get_adapter(provider.provider_type)
+        if not adapter.streams_openai_chunks:
+            result = APISIXService.send_request(provider, request_data)
+            if result['content']:
+                on_delta(result['content'])
+            return result
+        
+        try:
+            body = {**adapter.build_request(provider, request_data),
+                    'stream': True, 'stream_options': {'include_usage': True}}
+            with tracing.span('provider stream', attributes={'provider.type': provider.provider_type}), \
+                    ConcurrencyLimiter.slot(provider) as keep_alive:
+                response, provider_label, started = APISIXService._post(provider, adapter, body, stream=True)
+                
+                if response.status_code != 200:
+                    APISIXService._record_response_metrics(provider, provider_label, response, started)
+                    APISIXService._raise_rate_limited(provider, response)
+                    raise APISIXError(f"APISIX request failed: {response.status_code} - {response.text}")
+                
+                parts = []
+                chunk_data = {}
+                with response:
+                    for line in response.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith('data:'):
+                            continue
+                        data = line[len('data:'):].strip()
+                        if data == '[DONE]':
+                            break
+                        chunk = json.loads(data)
+                        chunk_data.update({k: chunk[k] for k in ('id', 'model', 'usage') if chunk.get(k)})
+                        for choice in chunk.get('choices') or []:
+                            if choice.get('finish_reason'):
+                                chunk_data['finish_reason'] = choice['finish_reason']
+                            content = (choice.get('delta') or {}).get('content')
+                            if content:
+                                if not parts:
+                                    metrics.PROVIDER_TIME_TO_FIRST_TOKEN.labels(
+                                        provider_type=provider.provider_type, provider=provider_label
+                                    ).observe(time.perf_counter() - started)
+                                parts.append(content)
+                                on_delta(content)
+                        keep_alive()
             
-            return response.json()
+            APISIXService._record_response_metrics(provider, provider_label, response, started)
+            
+            return completion(
+                ''.join(parts),
+                model=chunk_data.get('model'),
+                completion_id=chunk_data.get('id'),
+                finish_reason=chunk_data.get('finish_reason'),
+                usage=chunk_data.get('usage')
+            )
             
         except requests.exceptions.RequestException as e:
             raise APISIXError(f"Request to APISIX failed: {str(e)}")
+        except (APISIXError, CircuitOpenError, ConcurrencyLimitError, RateLimitExceededError):
+            raise
         except Exception as e:
             raise APISIXError(f"APISIX service error: {str(e)}")
     
+    @staticmethod
+    def _record_response_metrics(provider, provider_label: str, response, started: float) -> None:
+        """Record latency, 429s and remaining quota for a provider response"""
+        if response.status_code == 200:
+            outcome = 'success'
+        elif response.status_code == 429:
+            outcome = 'rate_limited'
+            metrics.PROVIDER_RATE_LIMITED.labels(
+                provider_type=provider.provider_type, provider=provider_label
+            ).inc()
+        else:
+            outcome = 'error'
+        
+        metrics.PROVIDER_REQUEST_LATENCY.labels(
+            provider_type=provider.provider_type, provider=provider_label, outcome=outcome
+        ).observe(time.perf_counter() - started)
+        
+        for header in QUOTA_REMAINING_HEADERS:
+            remaining = response.headers.get(header)
+            if remaining is not None:
+                try:
+                    metrics.PROVIDER_QUOTA_REMAINING.labels(
+                        provider_type=provider.provider_type, provider=provider_label
+                    ).set(float(remaining))
+                except ValueError:
+                    pass
+                break
+    
     @staticmethod
     def create_route(route_data: Dict[str, Any]) -> bool:
         """Create a route in APISIX"""
@@ -52,7 +292,7 @@ class APISIXService:
             response = requests.put(
                 f"{Config.APISIX_ADMIN_URL}/apisix/admin/routes/{route_data['id']}",
                 json=route_data,
-                headers={'X-API-KEY': 'edd1c9f034335f136f87ad84b625c8f1'},
+                headers={'X-API-KEY': Config.APISIX_ADMIN_KEY},
                 timeout=30
             )
             
@@ -70,7 +310,7 @@ class APISIXService:
         try:
             response = requests.delete(
                 f"{Config.APISIX_ADMIN_URL}/apisix/admin/routes/{route_id}",
-                headers={'X-API-KEY': 'edd1c9f034335f136f87ad84b625c8f1'},
+                headers={'X-API-KEY': Config.APISIX_ADMIN_KEY},
                 timeout=30
             )
             
@@ -85,7 +325,7 @@ class APISIXService:
         try:
             response = requests.get(
                 f"{Config.APISIX_ADMIN_URL}/apisix/admin/routes/{route_id}",
-                headers={'X-API-KEY': 'edd1c9f034335f136f87ad84b625c8f1'},
+                headers={'X-API-KEY': Config.APISIX_ADMIN_KEY},
                 timeout=30
             )
             
@@ -95,4 +335,24 @@ class APISIXService:
                 raise APISIXError(f"Failed to get route: {response.status_code}")
                 
         except Exception as e:
-            raise APISIXError(f"Failed to get APISIX route: {str(e)}") 
\ No newline at end of file
+            raise APISIXError(f"Failed to get APISIX route: {str(e)}")
+    
+    @staticmethod
+    def list_routes() -> List[Dict[str, Any]]:
+        """List every route in APISIX"""
+        try:
+            response = requests.get(
+                f"{Config.APISIX_ADMIN_URL}/apisix/admin/routes",
+                headers={'X-API-KEY': Config.APISIX_ADMIN_KEY},
+                timeout=30
+            )
+            
+            if response.status_code != 200:
+                raise APISIXError(f"Failed to list routes: {response.status_code}")
+            
+            return [item['value'] for item in response.json().get('list') or []]
+            
+        except APISIXError:
+            raise
+        except Exception as e:
+            raise APISIXError(f"Failed to list APISIX routes: {str(e)}")
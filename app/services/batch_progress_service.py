@@ -0,0 +1,136 @@
+"""
+Batch progress service estimating when a batch will finish
+
+Everything comes from Redis counters and the queue's providers, never from
+the batch's messages, so clients can poll it as often as they like:
+
+- the batch:{id} hash holds the request count, the count of finished
+  messages (res.count, failed ones also under fail.count), the queue and the
+  backlog the queue had when the batch was created
+- batch_rate:{id}:{bucket} keys count responses per BATCH_RATE_BUCKET_SECONDS,
+  giving the rate over the last BATCH_RATE_WINDOW seconds
+- provider_requests:{provider_id}:{window} holds each provider's use of its
+  current time_window
+- the queue's backlog and provider limits come from AdmissionService's
+  Redis counter and cache
+
+The projection is the later of two estimates: the batch's remaining messages
+at its current rate, and the time the providers' quota, what is left of the
+current windows and then limit per time_window, takes to cover the backlog
+ahead of the batch plus the batch's remaining messages.
+"""
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from app.config.config import Config
+from app.models.batch import Batch
+from app.services.admission_service import AdmissionService
+from app.services.redis_service import RedisService
+from app.utils.exceptions import BatchNotFoundError
+from app.utils.metrics import redis_timed
+
+class BatchProgressService:
+    """Service for batch progress, completion rate and projected completion"""
+
+    @staticmethod
+    @redis_timed
+    def _read_counters(batch_id: str, now: float) -> Tuple[Dict[str, str], int]:
+        """The batch hash and its responses over the rate window"""
+        current = int(now // Config.BATCH_RATE_BUCKET_SECONDS)
+        buckets = range(current - Config.BATCH_RATE_WINDOW // Config.BATCH_RATE_BUCKET_SECONDS, current + 1)
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        pipe.hgetall(f"batch:{batch_id}")
+        pipe.mget([RedisService.batch_rate_key(batch_id, bucket) for bucket in buckets])
+        data, counts = pipe.execute()
+        return {key.decode(): value.decode() for key, value in data.items()}, sum(int(count) for count in counts if count)
+
+    @staticmethod
+    def quota_seconds(work: int, quota: List[Tuple[int, float, int, int]]) -> Optional[float]:
+        """Seconds until the providers' quota covers work requests, None without any quota"""
+        needed = work - sum(remaining for remaining, _, _, _ in quota)
+        if needed <= 0:
+            return 0.0
+
+        # Each provider's window resets with its full limit, then adds limit per time_window
+        elapsed, rate = 0.0, 0.0
+        for _, reset_in, limit, window in sorted(quota, key=lambda entry: entry[1]):
+            gained = rate * (reset_in - elapsed)
+            if gained >= needed:
+                return elapsed + needed / rate
+            needed -= gained + limit
+            if needed <= 0:
+                return reset_in
+            elapsed, rate = reset_in, rate + limit / window
+        return elapsed + needed / rate if rate > 0 else None
+
+    @classmethod
+    def get_progress(cls, batch_id: str) -> Dict[str, Any]:
+        """Live progress, completion rate and projected completion of a batch"""
+        now = time.time()
+        counters, recent = cls._read_counters(batch_id, now)
+        if not counters:
+            batch = Batch.query.filter_by(batch_id=batch_id).first()
+            if not batch:
+                raise BatchNotFoundError(f"Batch {batch_id} not found")
+            # The batch row only counts completed messages, the rest of a completed batch failed
+            finished = batch.request_count if batch.status == 'completed' else batch.response_count
+            counters = {
+                'req.count': batch.request_count,
+                'res.count': finished,
+                'fail.count': finished - batch.response_count,
+                'created.at': (batch.created_at - datetime(1970, 1, 1)).total_seconds()
+            }
+
+        request_count = int(counters.get('req.count', 0))
+        response_count = int(counters.get('res.count', 0))
+        failed_count = int(counters.get('fail.count', 0))
+        remaining = max(request_count - response_count, 0)
+        created_at = float(counters['created.at']) if counters.get('created.at') else None
+        age = now - created_at if created_at else None
+
+        # Responses over the rate window, or since creation for a younger batch
+        window = Config.BATCH_RATE_WINDOW + now % Config.BATCH_RATE_BUCKET_SECONDS
+        if age is not None:
+            window = min(window, age)
+        completion_rate = recent / window if window > 0 else 0.0
+
+        data = {
+            'batch_id': batch_id,
+            'status': 'completed' if request_count and not remaining else 'processing',
+            'request_count': request_count,
+            'response_count': response_count,
+            'failed_count': failed_count,
+            'remaining': remaining,
+            'progress': round(response_count / request_count * 100, 2) if request_count else 0.0,
+            'completion_rate': round(completion_rate, 3),
+            'average_rate': round(response_count / age, 3) if age else None,
+            'backlog_ahead': None,
+            'quota_remaining': None,
+            'estimated_seconds': 0.0 if request_count and not remaining else None,
+            'estimated_completion': None
+        }
+        if not remaining:
+            return {'success': True, 'data': data}
+
+        estimates = []
+        if completion_rate > 0:
+            estimates.append(remaining / completion_rate)
+
+        queue_id = counters.get('queue')
+        if queue_id:
+            # Whatever the queue holds beyond this batch came in before it or after it,
+            # so the backlog at creation bounds the part that is ahead
+            backlog_ahead = max(AdmissionService.backlog(queue_id) - remaining, 0)
+            if counters.get('ahead') is not None:
+                backlog_ahead = min(backlog_ahead, int(counters['ahead']))
+            quota = RedisService.get_provider_quota(AdmissionService.providers(queue_id), now)
+            data['backlog_ahead'] = backlog_ahead
+            data['quota_remaining'] = sum(entry[0] for entry in quota)
+            quota_estimate = cls.quota_seconds(backlog_ahead + remaining, quota)
+            if quota_estimate is not None:
+                estimates.append(quota_estimate)
+
+        if estimates:
+            data['estimated_seconds'] = round(max(estimates), 1)
+            data['estimated_completion'] = (datetime.utcnow() + timedelta(seconds=max(estimates))).isoformat()
+        return {'success': True, 'data': data}
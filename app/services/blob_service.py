@@ -0,0 +1,156 @@
+"""
+Blob service for content-addressed storage of prompts and results
+"""
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.config.config import Config
+from app.models.blob import Blob
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+# A reused blob's last_referenced_at is refreshed at most this often
+TOUCH_INTERVAL = timedelta(minutes=1)
+
+class BlobService:
+    """Service for storing large texts once and referencing them by hash"""
+    
+    _cache = OrderedDict()
+    _lock = threading.Lock()  # the LRU is shared by worker, hedge and request threads
+    
+    @staticmethod
+    def hash_text(text: str) -> str:
+        """Content hash used as the blob key"""
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def _compress(raw: bytes) -> Tuple[str, bytes]:
+        """Compress raw bytes with the best available codec"""
+        if zstandard is not None:
+            return 'zstd', zstandard.ZstdCompressor(level=Config.PAYLOAD_COMPRESSION_LEVEL).compress(raw)
+        return 'zlib', zlib.compress(raw)
+    
+    @staticmethod
+    def _decompress(compression: str, data: bytes) -> bytes:
+        """Reverse _compress"""
+        if compression == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data)
+        if compression == 'zlib':
+            return zlib.decompress(data)
+        return data
+    
+    @classmethod
+    def _remember(cls, blob_hash: str, text: str) -> None:
+        """Keep recently used blobs in a small in-process LRU"""
+        with cls._lock:
+            cls._cache[blob_hash] = text
+            cls._cache.move_to_end(blob_hash)
+            while len(cls._cache) > Config.BLOB_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+    
+    @classmethod
+    def put(cls, text: str) -> str:
+        """Store text if it is not stored yet and return its hash"""
+        blob_hash = cls.hash_text(text)
+        exists = db.session.query(Blob.id, Blob.last_referenced_at).filter_by(blob_hash=blob_hash).first()
+        if exists:
+            # Reuse counts as a fresh reference, so cleanup cannot delete the blob before the caller commits
+            now = datetime.utcnow()
+            if not exists.last_referenced_at or exists.last_referenced_at < now - TOUCH_INTERVAL:
+                Blob.query.filter_by(id=exists.id).update({'last_referenced_at': now}, synchronize_session=False)
+        else:
+            raw = text.encode('utf-8')
+            compression, data = cls._compress(raw)
+            try:
+                # Savepoint so a concurrent insert of the same blob doesn't roll back the caller
+                with db.session.begin_nested():
+                    db.session.add(Blob(
+                        blob_hash=blob_hash,
+                        compression=compression,
+                        size=len(raw),
+                        data=data
+                    ))
+            except IntegrityError:
+                pass
+        
+        cls._remember(blob_hash, text)
+        return blob_hash
+    
+    @classmethod
+    def externalize(cls, text: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+        """Split text into (inline_value, blob_hash) depending on its size"""
+        if text is None:
+            return None, None
+        if len(text.encode('utf-8')) < Config.BLOB_MIN_SIZE:
+            return text, None
+        return None, cls.put(text)
+    
+    @classmethod
+    def get(cls, blob_hash: Optional[str], loaded: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """Load a blob's text by hash, from loaded when it was prefetched there"""
+        if not blob_hash:
+            return None
+        if loaded and blob_hash in loaded:
+            return loaded[blob_hash]
+        return cls.get_many([blob_hash]).get(blob_hash)
+    
+    @classmethod
+    def get_many(cls, blob_hashes: Iterable[str]) -> Dict[str, str]:
+        """Load several blobs with one query"""
+        wanted = {h for h in blob_hashes if h}
+        with cls._lock:
+            found = {h: cls._cache[h] for h in wanted if h in cls._cache}
+        missing = wanted - found.keys()
+        
+        if missing:
+            for blob in Blob.query.filter(Blob.blob_hash.in_(missing)).all():
+                text = cls._decompress(blob.compression, blob.data).decode('utf-8')
+                found[blob.blob_hash] = text
+                cls._remember(blob.blob_hash, text)
+        
+        return found
+    
+    @classmethod
+    def prefetch(cls, messages) -> Dict[str, str]:
+        """Load every blob a list of messages references with one query and hand it to the messages
+        
+        The texts are kept on the messages themselves, so reading them never goes back
+        to the database however many more blobs there are than the LRU holds.
+        """
+        hashes = set()
+        for message in messages:
+            hashes.update((message.prompt_hash, message.system_prompt_hash, message.result_hash))
+        loaded = cls.get_many(hashes)
+        for message in messages:
+            message.loaded_blobs = loaded
+        return loaded
+    
+    @classmethod
+    def delete_unreferenced(cls, min_age: timedelta = timedelta(hours=1)) -> int:
+        """Delete blobs no message references any more"""
+        from app.models.message import Message
+        
+        # Skip recently stored or reused blobs so we don't race a message that is about to reference one
+        cutoff = datetime.utcnow() - min_age
+        referenced = db.session.query(Message.prompt_hash).filter(
+            Message.prompt_hash.isnot(None)
+        ).union(
+            db.session.query(Message.system_prompt_hash).filter(Message.system_prompt_hash.isnot(None)),
+            db.session.query(Message.result_hash).filter(Message.result_hash.isnot(None))
+        )
+        deleted = Blob.query.filter(
+            db.func.coalesce(Blob.last_referenced_at, Blob.created_at) < cutoff,
+            ~Blob.blob_hash.in_(referenced)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        with cls._lock:
+            cls._cache.clear()
+        return deleted
@@ -0,0 +1,234 @@
+"""
+Per-provider circuit breaker with state shared through Redis
+
+Every worker records each provider call's outcome and latency. A circuit
+opens after CIRCUIT_CONSECUTIVE_FAILURES failures in a row, or once the
+error rate over the last CIRCUIT_WINDOW seconds passes
+CIRCUIT_ERROR_THRESHOLD. While open, calls fail at once instead of tying up a
+worker. After CIRCUIT_OPEN_SECONDS a few half-open probes are let through:
+a successful probe closes the circuit, a failed one opens it again.
+
+Request timeouts follow the provider's observed p99 latency, so a degraded
+provider costs seconds per call instead of the full 60. A call that times out
+is kept as a censored sample at the timeout it hit: the provider would have
+taken at least that long. Once timeouts reach the p99 the next timeout is
+CIRCUIT_TIMEOUT_MULTIPLIER times longer, so a provider that slowed down for
+good gets a timeout it can meet instead of timing out forever.
+"""
+import time
+from typing import Dict, List, Optional
+from app.config.config import Config
+from app.services.redis_service import RedisService
+from app.utils import metrics
+from app.utils.exceptions import CircuitOpenError
+from app.utils.metrics import redis_timed
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+BUCKET_SECONDS = 10
+TIMEOUT_REFRESH_EVERY = 20  # latency samples between p99 recalculations
+
+def _decode(data: Dict[bytes, bytes]) -> Dict[str, str]:
+    return {key.decode(): value.decode() for key, value in data.items()}
+
+class CircuitBreaker:
+    """Service for per-provider circuit breaking"""
+
+    @staticmethod
+    def _key(provider_id: str) -> str:
+        return f"circuit:{provider_id}"
+
+    @staticmethod
+    def _calls_key(provider_id: str, bucket: int) -> str:
+        return f"circuit_calls:{provider_id}:{bucket}"
+
+    @staticmethod
+    def _latency_key(provider_id: str) -> str:
+        return f"circuit_latency:{provider_id}"
+
+    @staticmethod
+    def _set_state_metric(provider, state: str) -> None:
+        metrics.PROVIDER_CIRCUIT_STATE.labels(
+            provider_type=provider.provider_type, provider=metrics.bounded('provider', provider.provider_id)
+        ).set(STATE_VALUES[state])
+
+    @classmethod
+    @redis_timed
+    def before_request(cls, provider) -> float:
+        """Timeout for a call to the provider, raising CircuitOpenError while its circuit is open"""
+        provider_id = str(provider.provider_id)
+        client = RedisService.get_client()
+        data = _decode(client.hgetall(cls._key(provider_id)))
+        timeout = float(data.get('timeout') or Config.CIRCUIT_MAX_TIMEOUT)
+        state = data.get('state', CLOSED)
+        if state == CLOSED:
+            return timeout
+
+        opened_at = float(data.get('opened_at', 0))
+        now = time.time()
+        if now < opened_at + Config.CIRCUIT_OPEN_SECONDS:
+            cls._reject(provider, opened_at + Config.CIRCUIT_OPEN_SECONDS - now)
+
+        # Open long enough, let a few trial requests through
+        if client.hincrby(cls._key(provider_id), 'probes', 1) > Config.CIRCUIT_HALF_OPEN_PROBES:
+            if now > opened_at + Config.CIRCUIT_OPEN_SECONDS + Config.CIRCUIT_MAX_TIMEOUT:
+                # The probes never reported back, start another open period
+                cls._open(provider)
+            cls._reject(provider, Config.CIRCUIT_OPEN_SECONDS)
+        if state == OPEN:
+            client.hset(cls._key(provider_id), 'state', HALF_OPEN)
+            cls._set_state_metric(provider, HALF_OPEN)
+        return timeout
+
+    @staticmethod
+    def _reject(provider, retry_after: float) -> None:
+        metrics.PROVIDER_CIRCUIT_REJECTED.labels(provider_type=provider.provider_type).inc()
+        raise CircuitOpenError(
+            f"Circuit for provider {provider.provider_id} is open, retry in {retry_after:.0f}s"
+        )
+
+    @classmethod
+    @redis_timed
+    def record(cls, provider, succeeded: bool, latency: float = None, timeout: float = None) -> None:
+        """Record a call's outcome and open or close the circuit as needed
+
+        latency is kept for successful calls, and timeout, the timeout a failed
+        call ran into, as a censored latency sample.
+        """
+        provider_id = str(provider.provider_id)
+        key = cls._key(provider_id)
+        bucket = int(time.time() // BUCKET_SECONDS)
+        calls_key = cls._calls_key(provider_id, bucket)
+        sample = latency if succeeded else timeout
+
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        pipe.hget(key, 'state')
+        pipe.hincrby(calls_key, 'ok' if succeeded else 'err', 1)
+        pipe.expire(calls_key, Config.CIRCUIT_WINDOW + BUCKET_SECONDS)
+        if succeeded:
+            pipe.hset(key, 'consecutive', 0)
+        else:
+            pipe.hincrby(key, 'consecutive', 1)
+        if sample is not None:
+            pipe.lpush(cls._latency_key(provider_id), round(sample, 4))
+            pipe.ltrim(cls._latency_key(provider_id), 0, Config.CIRCUIT_LATENCY_SAMPLES - 1)
+            pipe.hincrby(key, 'samples', 1)
+        results = pipe.execute()
+        state = results[0].decode() if results[0] else CLOSED
+
+        if sample is not None and results[-1] % TIMEOUT_REFRESH_EVERY == 0:
+            cls._refresh_timeout(provider_id)
+
+        if succeeded:
+            if state == HALF_OPEN:
+                cls._close(provider)
+            return
+
+        if state == HALF_OPEN:
+            cls._open(provider)
+        elif state == CLOSED and (results[3] >= Config.CIRCUIT_CONSECUTIVE_FAILURES
+                                  or cls._error_rate_exceeded(provider_id, bucket)):
+            cls._open(provider)
+
+    @classmethod
+    def _window_calls(cls, provider_id: str, bucket: int):
+        """Successful and failed calls over the last CIRCUIT_WINDOW seconds"""
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        for previous in range(bucket - Config.CIRCUIT_WINDOW // BUCKET_SECONDS + 1, bucket + 1):
+            pipe.hgetall(cls._calls_key(provider_id, previous))
+        ok = err = 0
+        for calls in pipe.execute():
+            ok += int(calls.get(b'ok', 0))
+            err += int(calls.get(b'err', 0))
+        return ok, err
+
+    @classmethod
+    def _error_rate_exceeded(cls, provider_id: str, bucket: int) -> bool:
+        ok, err = cls._window_calls(provider_id, bucket)
+        total = ok + err
+        return total >= Config.CIRCUIT_MIN_CALLS and err / total >= Config.CIRCUIT_ERROR_THRESHOLD
+
+    @classmethod
+    def _open(cls, provider) -> None:
+        RedisService.get_client().hset(cls._key(str(provider.provider_id)), mapping={
+            'state': OPEN,
+            'opened_at': time.time(),
+            'probes': 0
+        })
+        cls._set_state_metric(provider, OPEN)
+        metrics.PROVIDER_CIRCUIT_OPENED.labels(provider_type=provider.provider_type).inc()
+        print(f"⚠️  Circuit opened for {provider.provider_type} provider {provider.provider_id}")
+
+    @classmethod
+    def _close(cls, provider) -> None:
+        RedisService.get_client().hset(cls._key(str(provider.provider_id)), mapping={
+            'state': CLOSED,
+            'probes': 0,
+            'consecutive': 0
+        })
+        cls._set_state_metric(provider, CLOSED)
+        print(f"✅ Circuit closed for {provider.provider_type} provider {provider.provider_id}")
+
+    @classmethod
+    def _refresh_timeout(cls, provider_id: str) -> None:
+        """Set the provider's timeout from the p99 of its recent latencies"""
+        client = RedisService.get_client()
+        samples = sorted(float(sample) for sample in client.lrange(cls._latency_key(provider_id), 0, -1))
+        if not samples:
+            return
+        p99 = samples[int(0.99 * (len(samples) - 1))]
+        timeout = min(max(p99 * Config.CIRCUIT_TIMEOUT_MULTIPLIER, Config.CIRCUIT_MIN_TIMEOUT),
+                      Config.CIRCUIT_MAX_TIMEOUT)
+        hedge_delay = max(samples[int(Config.HEDGE_PERCENTILE / 100 * (len(samples) - 1))], Config.HEDGE_MIN_DELAY)
+        client.hset(cls._key(provider_id), mapping={
+            'timeout': round(timeout, 3),
+            'p99': round(p99, 4),
+            'hedge_delay': round(hedge_delay, 4)
+        })
+
+    @classmethod
+    @redis_timed
+    def hedge_delay(cls, provider) -> Optional[float]:
+        """Seconds to wait for the provider before hedging, None until enough latencies are seen"""
+        delay = RedisService.get_client().hget(cls._key(str(provider.provider_id)), 'hedge_delay')
+        return float(delay) if delay else None
+
+    @classmethod
+    @redis_timed
+    def rank(cls, providers: List) -> List:
+        """Providers ordered healthiest first, open circuits last"""
+        if len(providers) < 2:
+            return list(providers)
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        for provider in providers:
+            pipe.hgetall(cls._key(str(provider.provider_id)))
+        health = {}
+        for provider, data in zip(providers, pipe.execute()):
+            data = _decode(data)
+            health[provider.provider_id] = (
+                STATE_VALUES[data.get('state', CLOSED)],
+                int(data.get('consecutive', 0)),
+                float(data.get('p99', 0))
+            )
+        return sorted(providers, key=lambda provider: health[provider.provider_id])
+
+    @classmethod
+    @redis_timed
+    def health(cls, provider) -> Dict:
+        """Circuit state, error rate and latency figures for a provider"""
+        provider_id = str(provider.provider_id)
+        client = RedisService.get_client()
+        data = _decode(client.hgetall(cls._key(provider_id)))
+        ok, err = cls._window_calls(provider_id, int(time.time() // BUCKET_SECONDS))
+        return {
+            'provider_id': provider_id,
+            'state': data.get('state', CLOSED),
+            'opened_at': float(data['opened_at']) if data.get('opened_at') else None,
+            'consecutive_failures': int(data.get('consecutive', 0)),
+            'calls': ok + err,
+            'error_rate': round(err / (ok + err), 4) if ok + err else 0.0,
+            'p99_latency': float(data['p99']) if data.get('p99') else None,
+            'timeout': float(data.get('timeout') or Config.CIRCUIT_MAX_TIMEOUT)
+        }
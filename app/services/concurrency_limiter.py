@@ -0,0 +1,140 @@
+"""
+Distributed per-provider concurrency limiter
+
+Providers cap concurrent requests as well as their rate. A provider with
+config.max_concurrency gets a Redis semaphore shared by every worker: a
+request takes a slot before it is sent and gives it back once the answer has
+been read.
+
+Slots are leases that expire CONCURRENCY_LEASE_SECONDS after they were taken
+or last renewed, so the slots of a crashed worker come back on their own.
+Waiting is first come, first served. Each request draws a ticket and keeps its
+place in line, and the live tickets with the lowest numbers hold the slots.
+"""
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+from app.config.config import Config
+from app.services.redis_service import RedisService
+from app.utils import metrics
+from app.utils.cancellation import Cancellation
+from app.utils.exceptions import ConcurrencyLimitError, RequestCancelledError
+from app.utils.metrics import redis_timed
+
+WAITER_LEASE_SECONDS = 5  # a crashed waiter loses its place in line after this
+
+class ConcurrencyLimiter:
+    """Service for per-provider concurrency slots"""
+
+    @staticmethod
+    def _leases_key(provider_id: str) -> str:
+        return f"conn:{provider_id}:leases"
+
+    @staticmethod
+    def _tickets_key(provider_id: str) -> str:
+        return f"conn:{provider_id}:tickets"
+
+    @staticmethod
+    def _counter_key(provider_id: str) -> str:
+        return f"conn:{provider_id}:counter"
+
+    @staticmethod
+    def max_concurrency(provider) -> int:
+        """The provider's concurrent request cap, 0 when it has none"""
+        return int(provider.config_dict.get('max_concurrency') or 0)
+
+    @classmethod
+    @redis_timed
+    def _take_place(cls, provider_id: str, token: str, ticket: int, lease: float) -> int:
+        """Refresh a ticket's lease, drop expired ones and return the ticket's place in line"""
+        leases_key = cls._leases_key(provider_id)
+        tickets_key = cls._tickets_key(provider_id)
+        now = time.time()
+        pipe = RedisService.get_client().pipeline(transaction=True)
+        pipe.zremrangebyscore(leases_key, '-inf', now)
+        pipe.zadd(leases_key, {token: now + lease})
+        pipe.zadd(tickets_key, {token: ticket})
+        # Keep only tickets that still have a lease, scored by ticket number
+        pipe.zinterstore(tickets_key, {tickets_key: 1, leases_key: 0})
+        pipe.zrank(tickets_key, token)
+        pipe.expire(leases_key, Config.CONCURRENCY_LEASE_SECONDS * 2)
+        pipe.expire(tickets_key, Config.CONCURRENCY_LEASE_SECONDS * 2)
+        return pipe.execute()[4]
+
+    @classmethod
+    def acquire(cls, provider, cancellation: Cancellation = None) -> Optional[str]:
+        """Wait in line for a slot and return its token, None when the provider has no cap"""
+        limit = cls.max_concurrency(provider)
+        if limit <= 0:
+            return None
+        provider_id = str(provider.provider_id)
+        token = uuid.uuid4().hex
+        ticket = RedisService.get_client().incr(cls._counter_key(provider_id))
+        started = time.perf_counter()
+        deadline = time.monotonic() + Config.CONCURRENCY_MAX_WAIT
+
+        while True:
+            place = cls._take_place(provider_id, token, ticket, WAITER_LEASE_SECONDS)
+            if place is not None and place < limit:
+                cls.renew(provider_id, token)
+                metrics.PROVIDER_CONCURRENCY_WAIT.labels(provider_type=provider.provider_type).observe(
+                    time.perf_counter() - started
+                )
+                return token
+            if cancellation is not None and cancellation.cancelled:
+                cls.release(provider_id, token)
+                raise RequestCancelledError(f"Request to provider {provider.provider_id} was cancelled")
+            if time.monotonic() >= deadline:
+                cls.release(provider_id, token)
+                metrics.PROVIDER_CONCURRENCY_REJECTED.labels(provider_type=provider.provider_type).inc()
+                raise ConcurrencyLimitError(
+                    f"Provider {provider.provider_id} has {limit} requests in flight, "
+                    f"no slot freed up in {Config.CONCURRENCY_MAX_WAIT:g}s"
+                )
+            time.sleep(Config.CONCURRENCY_POLL_INTERVAL)
+
+    @classmethod
+    @redis_timed
+    def renew(cls, provider_id: str, token: str) -> None:
+        """Extend a held slot's lease"""
+        RedisService.get_client().zadd(
+            cls._leases_key(provider_id), {token: time.time() + Config.CONCURRENCY_LEASE_SECONDS}, xx=True
+        )
+
+    @classmethod
+    @redis_timed
+    def release(cls, provider_id: str, token: str) -> None:
+        """Give a slot back, or leave the line"""
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        pipe.zrem(cls._leases_key(provider_id), token)
+        pipe.zrem(cls._tickets_key(provider_id), token)
+        pipe.execute()
+
+    @classmethod
+    @contextmanager
+    def slot(cls, provider, cancellation: Cancellation = None) -> Iterator[Callable[[], None]]:
+        """Hold a slot for the duration of a request, yielding a keep_alive for long streams
+
+        A cancelled request gives its slot back straight away, not when its thread gets to it.
+        """
+        token = cls.acquire(provider, cancellation)
+        if token is None:
+            yield lambda: None
+            return
+
+        provider_id = str(provider.provider_id)
+        if cancellation is not None:
+            cancellation.on_cancel(lambda: cls.release(provider_id, token))
+        renewed_at = time.monotonic()
+
+        def keep_alive():
+            nonlocal renewed_at
+            if time.monotonic() - renewed_at > Config.CONCURRENCY_LEASE_SECONDS / 3:
+                cls.renew(provider_id, token)
+                renewed_at = time.monotonic()
+
+        try:
+            yield keep_alive
+        finally:
+            cls.release(provider_id, token)
@@ -0,0 +1,208 @@
+"""
+Deferred service for run_after and fill-idle-quota messages
+
+Deferred messages stay in the database with status deferred and wait in
+Redis instead of the broker:
+
+- deferred:timers is a sorted set of message IDs scored by the time they may
+  run, the timer wheel the release_deferred_messages task turns every
+  DEFERRED_POLL_INTERVAL seconds
+- deferred:idle:{queue_id} holds fill-idle messages whose time has come,
+  ordered like the scheduler by deadline or priority, until the queue's
+  providers have quota their current windows would otherwise leave unused
+- deferred:entries keeps each message's queue, priority, deadline and mode
+
+Released messages go through SchedulerService.submit like new ones. A
+fill-idle message with a deadline is released URGENT_DEADLINE_SLACK seconds
+before it whether or not any quota is idle.
+"""
+import json
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from app import db
+from app.config.config import Config
+from app.models.message import Message
+from app.services.admission_service import AdmissionService
+from app.services.redis_service import RedisService
+from app.services.scheduler_service import SchedulerService
+from app.utils.metrics import redis_timed
+
+TIMERS_KEY = 'deferred:timers'
+ENTRIES_KEY = 'deferred:entries'
+IDLE_QUEUES_KEY = 'deferred:idle_queues'
+
+class DeferredService:
+    """Service for holding back messages until their time or idle provider quota"""
+
+    @staticmethod
+    def _idle_key(queue_id: str) -> str:
+        return f"deferred:idle:{queue_id}"
+
+    @staticmethod
+    def _epoch(value: Optional[datetime]) -> Optional[float]:
+        return (value - datetime(1970, 1, 1)).total_seconds() if value else None
+
+    @staticmethod
+    def parse_run_after(data: Dict) -> Optional[datetime]:
+        """UTC time from a request's run_after (or not_before) field"""
+        return SchedulerService.parse_time(data.get('run_after', data.get('not_before')), 'run_after')
+
+    @staticmethod
+    def parse_fill_idle(value) -> bool:
+        """fill_idle_quota flag from a request, raising ValueError when it is not a boolean"""
+        if value is None:
+            return False
+        if not isinstance(value, bool):
+            raise ValueError("fill_idle_quota must be true or false")
+        return value
+
+    @staticmethod
+    def is_deferred(run_after: Optional[datetime], fill_idle: bool) -> bool:
+        """Whether a message waits here rather than going straight to the scheduler"""
+        return fill_idle or (run_after is not None and run_after > datetime.utcnow())
+
+    @classmethod
+    @redis_timed
+    def defer(cls, queue_id: str, entries: Iterable[Tuple[str, int, Optional[datetime], Optional[datetime]]],
+              fill_idle: bool = False) -> None:
+        """Hold (message_id, priority, deadline, run_after) entries until they may be released"""
+        queue_id = str(queue_id)
+        now = time.time()
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        pooled = False
+        for message_id, priority, deadline, run_after in entries:
+            message_id = str(message_id)
+            run_at = cls._epoch(run_after)
+            waiting = run_at is not None and run_at > now
+            pipe.hset(ENTRIES_KEY, message_id, json.dumps({
+                'queue': queue_id,
+                'priority': priority,
+                'deadline': cls._epoch(deadline),
+                'fill_idle': fill_idle,
+                'pooled': fill_idle and not waiting
+            }))
+            if waiting:
+                pipe.zadd(TIMERS_KEY, {message_id: run_at})
+            else:
+                pipe.zadd(cls._idle_key(queue_id), {message_id: SchedulerService.virtual_deadline(priority, deadline)})
+                pooled = True
+                if deadline:
+                    pipe.zadd(TIMERS_KEY, {message_id: cls._epoch(deadline) - Config.URGENT_DEADLINE_SLACK})
+        if pooled:
+            pipe.sadd(IDLE_QUEUES_KEY, queue_id)
+        pipe.execute()
+
+    @classmethod
+    def _load(cls, message_ids: List[str]) -> Dict[str, dict]:
+        if not message_ids:
+            return {}
+        values = RedisService.get_client().hmget(ENTRIES_KEY, message_ids)
+        return {message_id: json.loads(value) for message_id, value in zip(message_ids, values) if value}
+
+    @classmethod
+    def _release(cls, entries: Dict[str, dict]) -> int:
+        """Send entries to the scheduler, grouped by queue"""
+        if not entries:
+            return 0
+        by_queue = {}
+        for message_id, entry in entries.items():
+            deadline = datetime.utcfromtimestamp(entry['deadline']) if entry['deadline'] else None
+            by_queue.setdefault(entry['queue'], []).append((message_id, entry['priority'], deadline))
+        # Submitted first, so a failed submit leaves the messages deferred and waiting again
+        submitted = []
+        try:
+            for queue_id, queued in by_queue.items():
+                SchedulerService.submit(queue_id, queued)
+                submitted.extend(message_id for message_id, _, _ in queued)
+                AdmissionService.accepted(queue_id, len(queued))
+        except Exception:
+            cls._restore({message_id: entry for message_id, entry in entries.items() if message_id not in submitted})
+            raise
+        finally:
+            if submitted:
+                Message.query.filter(Message.message_id.in_(submitted), Message.status == 'deferred').update(
+                    {'status': 'pending'}, synchronize_session=False
+                )
+                db.session.commit()
+                RedisService.get_client().hdel(ENTRIES_KEY, *submitted)
+        return len(submitted)
+
+    @classmethod
+    def _restore(cls, entries: Dict[str, dict]) -> None:
+        """Put claimed entries back where release_due and fill_idle_quota find them"""
+        if not entries:
+            return
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        for message_id, entry in entries.items():
+            if not entry['pooled']:
+                pipe.zadd(TIMERS_KEY, {message_id: time.time()})
+                continue
+            pipe.zadd(cls._idle_key(entry['queue']), {message_id: SchedulerService.virtual_deadline(
+                entry['priority'], datetime.utcfromtimestamp(entry['deadline']) if entry['deadline'] else None
+            )})
+            pipe.sadd(IDLE_QUEUES_KEY, entry['queue'])
+            if entry['deadline']:
+                pipe.zadd(TIMERS_KEY, {message_id: entry['deadline'] - Config.URGENT_DEADLINE_SLACK})
+        pipe.execute()
+
+    @classmethod
+    def release_due(cls) -> int:
+        """Turn the timer wheel: release due messages and pool due fill-idle ones"""
+        client = RedisService.get_client()
+        due = [member.decode() for member in client.zrangebyscore(
+            TIMERS_KEY, '-inf', time.time(), start=0, num=Config.DEFERRED_RELEASE_BATCH
+        )]
+        if not due:
+            return 0
+        # Whoever removes a timer owns it, so concurrent rounds never release twice
+        pipe = client.pipeline(transaction=False)
+        for message_id in due:
+            pipe.zrem(TIMERS_KEY, message_id)
+        claimed = [message_id for message_id, removed in zip(due, pipe.execute()) if removed]
+
+        release, pool = {}, {}
+        for message_id, entry in cls._load(claimed).items():
+            if entry['fill_idle'] and not entry['pooled']:
+                pool[message_id] = entry
+            elif not entry['fill_idle'] or client.zrem(cls._idle_key(entry['queue']), message_id):
+                # Plain messages are due, pooled ones are close to their deadline
+                release[message_id] = entry
+        if pool:
+            pipe = client.pipeline(transaction=False)
+            for message_id, entry in pool.items():
+                entry['pooled'] = True
+                pipe.hset(ENTRIES_KEY, message_id, json.dumps(entry))
+                pipe.zadd(cls._idle_key(entry['queue']), {message_id: SchedulerService.virtual_deadline(
+                    entry['priority'], datetime.utcfromtimestamp(entry['deadline']) if entry['deadline'] else None
+                )})
+                pipe.sadd(IDLE_QUEUES_KEY, entry['queue'])
+                if entry['deadline']:
+                    pipe.zadd(TIMERS_KEY, {message_id: entry['deadline'] - Config.URGENT_DEADLINE_SLACK})
+            pipe.execute()
+        return cls._release(release)
+
+    @classmethod
+    def idle_quota(cls, queue_id: str) -> int:
+        """Requests the queue's providers have left in their current windows beyond the queue's backlog"""
+        quota = RedisService.get_provider_quota(AdmissionService.providers(queue_id), time.time())
+        return sum(remaining for remaining, _, _, _ in quota) - AdmissionService.backlog(queue_id)
+
+    @classmethod
+    def fill_idle_quota(cls) -> int:
+        """Release fill-idle messages into the quota their queues would leave unused"""
+        client = RedisService.get_client()
+        released = 0
+        for queue_id in [queue_id.decode() for queue_id in client.smembers(IDLE_QUEUES_KEY)]:
+            idle = min(cls.idle_quota(queue_id), Config.DEFERRED_RELEASE_BATCH)
+            if idle <= 0:
+                continue
+            message_ids = [member.decode() for member, _ in client.zpopmin(cls._idle_key(queue_id), idle)]
+            if not message_ids:
+                client.srem(IDLE_QUEUES_KEY, queue_id)
+                # A message pooled between the read and the removal keeps the queue listed
+                if client.zcard(cls._idle_key(queue_id)):
+                    client.sadd(IDLE_QUEUES_KEY, queue_id)
+                continue
+            released += cls._release(cls._load(message_ids))
+        return released
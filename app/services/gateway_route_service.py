@@ -0,0 +1,165 @@
+"""
+Gateway route service keeping APISIX routes in step with the providers
+
+Every provider gets its own APISIX route, /v1/providers/{provider_id},
+proxying to the provider's API. The route's limit-count allows the
+provider's limit per time_window, config.rate (with config.burst) adds a
+limit-req and config.max_concurrency a limit-conn, so each provider is
+throttled at the gateway by its own quota.
+Routes are written whenever a provider changes, and a periodic reconcile
+repairs drift such as routes lost with etcd or edited by hand.
+"""
+import hashlib
+import json
+from typing import Any, Dict
+from urllib.parse import urlsplit
+from app.config.config import Config
+from app.models.provider import Provider
+from app.services.apisix_service import APISIXService
+from app.services.concurrency_limiter import ConcurrencyLimiter
+from app.services.provider_adapters import get_adapter
+from app.utils import metrics
+from app.utils.exceptions import APISIXError
+
+ROUTE_ID_PREFIX = 'provider-'
+MANAGED_BY = 'ai-rate-limiter'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+class GatewayRouteService:
+    """Service for generating and reconciling per-provider APISIX routes"""
+
+    @staticmethod
+    def route_id(provider_id) -> str:
+        return f"{ROUTE_ID_PREFIX}{provider_id}"
+
+    @staticmethod
+    def route_path(provider_id) -> str:
+        return f"/v1/providers/{provider_id}"
+
+    @classmethod
+    def build_route(cls, provider) -> Dict[str, Any]:
+        """APISIX route for a provider, labelled with a hash of its settings"""
+        provider_id = str(provider.provider_id)
+        target = urlsplit(get_adapter(provider.provider_type).direct_url(provider))
+        upstream_path = target.path + (f"?{target.query}" if target.query else '')
+
+        plugins = {
+            'limit-count': {
+                'count': provider.limit,
+                'time_window': provider.time_window,
+                'rejected_code': 429,
+                'key_type': 'constant',
+                'key': provider_id,
+                **cls._limit_policy()
+            },
+            'proxy-rewrite': {'uri': upstream_path},
+            'opentelemetry': {'sampler': {'name': 'parent_base', 'options': {'root': {'name': 'always_off'}}}}
+        }
+        config = provider.config_dict
+        if config.get('rate'):
+            # Requests within the burst are delayed to the rate, not rejected
+            plugins['limit-req'] = {
+                'rate': config['rate'],
+                'burst': config.get('burst', 0),
+                'nodelay': False,
+                'rejected_code': 429,
+                'key_type': 'constant',
+                'key': provider_id
+            }
+        max_concurrency = ConcurrencyLimiter.max_concurrency(provider)
+        if max_concurrency:
+            # Workers already wait for a slot, this holds back anything that bypasses them
+            plugins['limit-conn'] = {
+                'conn': max_concurrency,
+                'burst': max_concurrency,
+                'default_conn_delay': 0.1,
+                'rejected_code': 429,
+                'key_type': 'constant',
+                'key': provider_id
+            }
+
+        route = {
+            'id': cls.route_id(provider_id),
+            'uri': cls.route_path(provider_id),
+            'name': f"{provider.provider_type}_{provider_id}",
+            'desc': f"{provider.provider_name} ({provider.provider_type}), {provider.limit} requests per {provider.time_window}s",
+            'methods': ['POST'],
+            'plugins': plugins,
+            'upstream': {
+                'type': 'roundrobin',
+                'scheme': target.scheme,
+                'pass_host': 'node',
+                'nodes': {f"{target.hostname}:{target.port or DEFAULT_PORTS[target.scheme]}": 1},
+                'timeout': {
+                    'connect': Config.APISIX_UPSTREAM_TIMEOUT,
+                    'send': Config.APISIX_UPSTREAM_TIMEOUT,
+                    'read': Config.APISIX_UPSTREAM_TIMEOUT
+                }
+            }
+        }
+        config_hash = hashlib.sha256(json.dumps(route, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        route['labels'] = {'managed_by': MANAGED_BY, 'config_hash': config_hash}
+        return route
+
+    @staticmethod
+    def _limit_policy() -> Dict[str, Any]:
+        """Where limit-count keeps its counters, Redis when several gateways share a quota"""
+        if Config.APISIX_LIMIT_POLICY != 'redis':
+            return {'policy': 'local'}
+        return {
+            'policy': 'redis',
+            'redis_host': Config.APISIX_LIMIT_REDIS_HOST,
+            'redis_port': Config.APISIX_LIMIT_REDIS_PORT,
+            'redis_database': Config.APISIX_LIMIT_REDIS_DATABASE
+        }
+
+    @classmethod
+    def sync_provider(cls, provider_id: str) -> str:
+        """Write a provider's route, or delete it once the provider is gone"""
+        provider = Provider.query.filter_by(provider_id=provider_id).first()
+        if provider is None:
+            APISIXService.delete_route(cls.route_id(provider_id))
+            metrics.GATEWAY_ROUTE_CHANGES.labels(action='deleted').inc()
+            return 'deleted'
+        APISIXService.create_route(cls.build_route(provider))
+        metrics.GATEWAY_ROUTE_CHANGES.labels(action='updated').inc()
+        return 'updated'
+
+    @classmethod
+    def reconcile(cls) -> Dict[str, int]:
+        """Create, update and delete provider routes until APISIX matches the providers"""
+        desired = {}
+        for provider in Provider.query.all():
+            try:
+                route = cls.build_route(provider)
+            except APISIXError as e:
+                print(f"⚠️  No gateway route for provider {provider.provider_id}: {e}")
+                continue
+            desired[route['id']] = route
+
+        current = {
+            route['id']: route for route in APISIXService.list_routes()
+            if (route.get('labels') or {}).get('managed_by') == MANAGED_BY
+        }
+
+        changes = {'created': 0, 'updated': 0, 'deleted': 0}
+        for route_id, route in desired.items():
+            existing = current.get(route_id)
+            if existing is None:
+                action = 'created'
+            elif (existing.get('labels') or {}).get('config_hash') != route['labels']['config_hash']:
+                action = 'updated'
+            else:
+                continue
+            APISIXService.create_route(route)
+            changes[action] += 1
+        for route_id in current.keys() - desired.keys():
+            APISIXService.delete_route(route_id)
+            changes['deleted'] += 1
+
+        for action, count in changes.items():
+            if count:
+                metrics.GATEWAY_ROUTE_CHANGES.labels(action=action).inc(count)
+        if any(changes.values()):
+            print(f"🔁 Reconciled APISIX routes: {changes}")
+        return changes
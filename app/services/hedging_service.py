@@ -0,0 +1,140 @@
+"""
+Hedging service for cutting provider tail latency
+
+When a request to a queue's primary provider has not answered within that
+provider's HEDGE_PERCENTILE latency, the same request is sent to the next
+provider and the first successful answer wins. Hedges are capped at
+HEDGE_BUDGET of the queue's requests per window, so a slow provider cannot
+double the quota the queue spends. The request that loses the race is
+cancelled: its connection is shut down, its concurrency slot and quota are
+given back, and it records no outcome.
+"""
+import contextvars
+import threading
+import time
+from types import SimpleNamespace
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, Callable, Dict, Tuple
+from app.config.config import Config
+from app.services.apisix_service import APISIXService
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.redis_service import RedisService
+from app.utils import metrics
+from app.utils.cancellation import Cancellation
+from app.utils.metrics import redis_timed
+
+def _start(func, *args) -> Future:
+    """Run func on its own daemon thread, keeping the caller's trace context
+
+    Each call gets its own thread rather than one from a pool, so a loser that
+    takes a moment to wind down after being cancelled never delays a later hedge.
+    """
+    future = Future()
+    context = contextvars.copy_context()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(context.run(func, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True, name='hedged-request').start()
+    return future
+
+def _snapshot(provider) -> SimpleNamespace:
+    """Plain copy of a provider for a hedge thread
+
+    The copied context carries the task's app context and so its SQLAlchemy
+    session, which is not thread-safe. Hedge threads only get plain values,
+    so they never load or refresh through it, even while a cancelled loser is
+    still unwinding after the task has committed.
+    """
+    config = provider.config_dict
+    return SimpleNamespace(
+        provider_id=provider.provider_id,
+        provider_name=provider.provider_name,
+        provider_type=provider.provider_type,
+        api_key=provider.api_key,
+        limit=provider.limit,
+        time_window=provider.time_window,
+        config=config,
+        config_dict=config
+    )
+
+class HedgingService:
+    """Service for hedged provider requests"""
+
+    @staticmethod
+    def _budget_key(queue_id: str) -> str:
+        return f"hedge_budget:{queue_id}:{int(time.time() // Config.HEDGE_BUDGET_WINDOW)}"
+
+    @classmethod
+    @redis_timed
+    def count_request(cls, queue_id: str) -> None:
+        """Count a request towards the queue's hedge budget"""
+        key = cls._budget_key(queue_id)
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        pipe.hincrby(key, 'requests', 1)
+        pipe.expire(key, Config.HEDGE_BUDGET_WINDOW)
+        pipe.execute()
+
+    @classmethod
+    @redis_timed
+    def take_budget(cls, queue_id: str) -> bool:
+        """Reserve one hedge, False once the queue has hedged HEDGE_BUDGET of its requests"""
+        key = cls._budget_key(queue_id)
+        client = RedisService.get_client()
+        pipe = client.pipeline(transaction=False)
+        pipe.hincrby(key, 'hedges', 1)
+        pipe.hget(key, 'requests')
+        hedges, requests_seen = pipe.execute()
+        if hedges <= Config.HEDGE_BUDGET * int(requests_seen or 0):
+            return True
+        client.hincrby(key, 'hedges', -1)
+        return False
+
+    @staticmethod
+    def _send(cancellations: Dict[Future, Cancellation], provider,
+              build_request: Callable[[Any], Dict[str, Any]]) -> Future:
+        """Start a cancellable request to provider on its own thread"""
+        cancellation = Cancellation()
+        future = _start(APISIXService.send_request, _snapshot(provider), build_request(provider), cancellation)
+        cancellations[future] = cancellation
+        return future
+
+    @classmethod
+    def send_request(cls, queue_id: str, primary, backup,
+                     build_request: Callable[[Any], Dict[str, Any]]) -> Tuple[Dict[str, Any], Any]:
+        """Send to primary, hedge to backup if primary is slow, return (response, provider that answered)"""
+        cls.count_request(queue_id)
+        cancellations = {}
+        first = cls._send(cancellations, primary, build_request)
+
+        delay = CircuitBreaker.hedge_delay(primary)
+        if delay is None:
+            return first.result(), primary
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result(), primary
+        if not cls.take_budget(queue_id):
+            metrics.HEDGED_REQUESTS.labels(outcome='budget_exhausted').inc()
+            return first.result(), primary
+
+        second = cls._send(cancellations, backup, build_request)
+        pending = {first: primary, second: backup}
+        error = None
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                for loser in pending:
+                    cancellations[loser].cancel()
+                metrics.HEDGED_REQUESTS.labels(outcome='hedge_won' if future is second else 'primary_won').inc()
+                return response, provider
+        raise error
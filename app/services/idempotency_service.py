@@ -0,0 +1,163 @@
+"""
+Idempotency service for message and batch creation
+
+A create request with an Idempotency-Key header is carried out once per queue
+and key. Retries get the first request's response back, with the same
+batch_id and message_ids, and nothing is inserted or enqueued again.
+
+Redis holds recent keys for a fast answer and marks keys whose first request
+is still running. The idempotency_keys row is written in the same transaction
+as the batch, so its unique constraint stops duplicates even if Redis has lost
+the key. The row's dispatched_at is set once the messages are enqueued; a retry
+of a key whose first request committed but failed to enqueue enqueues them
+before replaying the response.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.config.config import Config
+from app.models.idempotency_key import IdempotencyKey
+from app.services.redis_service import RedisService
+from app.utils.exceptions import IdempotencyConflictError
+from app.utils.metrics import redis_timed
+
+PENDING = b'pending'
+MAX_KEY_LENGTH = 255
+
+class IdempotencyService:
+    """Service for replaying create requests that carry an Idempotency-Key"""
+
+    @staticmethod
+    def _key(queue_id, key: str) -> str:
+        return f"idempotency:{queue_id}:{key}"
+
+    @staticmethod
+    def fingerprint(request_data: Dict[str, Any]) -> str:
+        """Hash of a request body, to tell a retry from a different request reusing the key"""
+        return hashlib.sha256(json.dumps(request_data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _check(key: str, request_hash: str, stored_hash: str) -> None:
+        if stored_hash != request_hash:
+            raise IdempotencyConflictError(f"Idempotency-Key {key} was already used for a different request")
+
+    @classmethod
+    @redis_timed
+    def _remember(cls, queue_id, key: str, request_hash: str, response: Dict[str, Any]) -> None:
+        RedisService.get_client().set(
+            cls._key(queue_id, key),
+            json.dumps({'request_hash': request_hash, 'response': response}),
+            ex=Config.IDEMPOTENCY_TTL
+        )
+
+    @classmethod
+    def _load(cls, queue_id, key: str, request_hash: str,
+              redispatch: Optional[Callable[[str], None]] = None) -> Optional[Dict[str, Any]]:
+        """The stored response from the database, enqueueing its batch first if that never happened"""
+        record = IdempotencyKey.query.filter_by(queue_id=str(queue_id), key=key).first()
+        if record is None:
+            return None
+        cls._check(key, request_hash, record.request_hash)
+        if record.dispatched_at is None and redispatch:
+            # The first request committed its batch but failed before enqueueing it
+            redispatch(str(record.batch_id))
+            record.dispatched_at = datetime.utcnow()
+            db.session.commit()
+        return record.response
+
+    @classmethod
+    @redis_timed
+    def begin(cls, queue_id, key: str, request_hash: str,
+              redispatch: Optional[Callable[[str], None]] = None) -> Optional[Dict[str, Any]]:
+        """The response to replay for a used key, or None once this request has claimed the key"""
+        client = RedisService.get_client()
+        cached = client.get(cls._key(queue_id, key))
+        if cached == PENDING:
+            raise IdempotencyConflictError(f"A request with Idempotency-Key {key} is still being processed")
+        if cached:
+            entry = json.loads(cached)
+            cls._check(key, request_hash, entry['request_hash'])
+            return entry['response']
+
+        # Claimed before reading the database, so only one retry enqueues an undispatched batch
+        if not client.set(cls._key(queue_id, key), PENDING, nx=True, ex=Config.IDEMPOTENCY_LOCK_TTL):
+            raise IdempotencyConflictError(f"A request with Idempotency-Key {key} is still being processed")
+        try:
+            response = cls._load(queue_id, key, request_hash, redispatch)
+        except Exception:
+            client.delete(cls._key(queue_id, key))
+            raise
+        if response is not None:
+            cls._remember(queue_id, key, request_hash, response)
+        return response
+
+    @staticmethod
+    def stage(queue_id, key: str, request_hash: str, batch_id, response: Dict[str, Any]) -> None:
+        """Add the key's row to the session that creates the batch"""
+        db.session.add(IdempotencyKey(
+            queue_id=str(queue_id),
+            key=key,
+            request_hash=request_hash,
+            batch_id=batch_id,
+            response=response
+        ))
+
+    @staticmethod
+    def mark_dispatched(queue_id, key: str) -> None:
+        """Record that the key's messages were enqueued"""
+        IdempotencyKey.query.filter_by(queue_id=str(queue_id), key=key).update(
+            {'dispatched_at': datetime.utcnow()}, synchronize_session=False
+        )
+        db.session.commit()
+
+    @classmethod
+    def execute(cls, queue_id, key: Optional[str], request_data: Dict[str, Any],
+                create: Callable[[Optional[Callable[[Any, Dict[str, Any]], None]]], Dict[str, Any]],
+                redispatch: Optional[Callable[[str], None]] = None) -> Tuple[Dict[str, Any], bool]:
+        """Run create once per queue and key, returning (response, replayed)
+
+        create gets a before_commit(batch_id, response) callback to call just
+        before it commits the batch, or None when the request has no key.
+        redispatch(batch_id) enqueues a batch whose first request committed it
+        but failed before enqueueing.
+        """
+        if not key:
+            return create(None), False
+        if len(key) > MAX_KEY_LENGTH:
+            raise ValueError(f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+
+        request_hash = cls.fingerprint(request_data)
+        response = cls.begin(queue_id, key, request_hash, redispatch)
+        if response is not None:
+            return response, True
+
+        def before_commit(batch_id, response):
+            cls.stage(queue_id, key, request_hash, batch_id, response)
+
+        try:
+            response = create(before_commit)
+        except IntegrityError:
+            # Another request with the key committed first, while Redis did not know it
+            db.session.rollback()
+            RedisService.get_client().delete(cls._key(queue_id, key))
+            response = cls._load(queue_id, key, request_hash)
+            if response is None:
+                raise
+            return response, True
+        except Exception:
+            RedisService.get_client().delete(cls._key(queue_id, key))
+            raise
+        cls.mark_dispatched(queue_id, key)
+        cls._remember(queue_id, key, request_hash, response)
+        return response, False
+
+    @staticmethod
+    def prune() -> int:
+        """Delete keys older than IDEMPOTENCY_RETENTION hours"""
+        cutoff = datetime.utcnow() - timedelta(hours=Config.IDEMPOTENCY_RETENTION)
+        deleted = IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
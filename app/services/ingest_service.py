@@ -0,0 +1,239 @@
+"""
+Ingest service for streaming bulk JSONL uploads into a batch
+"""
+import json
+import os
+import uuid
+import zlib
+from typing import Any, Callable, Dict, Iterator, Optional
+from sqlalchemy import insert
+from app import db
+from app.config.config import Config
+from app.models.batch import Batch
+from app.models.message import Message
+from app.models.queue import Queue
+from app.services.admission_service import AdmissionService
+from app.services.blob_service import BlobService
+from app.services.provider_batch_service import ProviderBatchService
+from app.services.rabbitmq_service import RabbitMQService
+from app.services.redis_service import RedisService
+from app.services.scheduler_service import SchedulerService
+from app.utils import tracing
+from app.utils.exceptions import QueueNotFoundError, UploadError
+
+READ_CHUNK_SIZE = 64 * 1024
+MAX_INFLATE_SIZE = 1024 * 1024  # decompressed bytes produced per step
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+SYSTEM_PROMPT_CACHE_SIZE = 1024
+
+class IngestService:
+    """Service for ingesting JSONL uploads with constant memory"""
+
+    @staticmethod
+    def iter_upload(stream) -> Iterator[bytes]:
+        """Yield the upload's bytes, decompressing on the fly when it is gzip"""
+        chunk = stream.read(READ_CHUNK_SIZE)
+        if not chunk.startswith(GZIP_MAGIC):
+            while chunk:
+                yield chunk
+                chunk = stream.read(READ_CHUNK_SIZE)
+            return
+
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        try:
+            while chunk:
+                data = decompressor.decompress(chunk, MAX_INFLATE_SIZE)
+                if data:
+                    yield data
+                if decompressor.unconsumed_tail:
+                    chunk = decompressor.unconsumed_tail
+                elif decompressor.eof and decompressor.unused_data:
+                    # Concatenated gzip members, as written by `cat a.gz b.gz`
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                else:
+                    chunk = stream.read(READ_CHUNK_SIZE)
+        except zlib.error as e:
+            raise UploadError(f"Upload is not valid gzip: {e}")
+
+        if not decompressor.eof:
+            raise UploadError("Gzip upload is truncated")
+
+    @staticmethod
+    def spool_upload(stream, path: str, max_lines: int) -> int:
+        """Write an upload to path as plain JSONL and return its non-empty line count"""
+        line_count = 0
+        tail = b''
+        with open(path, 'wb') as spool:
+            for data in IngestService.iter_upload(stream):
+                spool.write(data)
+                lines = (tail + data).split(b'\n')
+                tail = lines.pop()
+                line_count += sum(1 for line in lines if line.strip())
+                if line_count > max_lines:
+                    raise UploadError(f"Upload exceeds the limit of {max_lines} messages")
+
+        if tail.strip():
+            line_count += 1
+        if line_count > max_lines:
+            raise UploadError(f"Upload exceeds the limit of {max_lines} messages")
+        return line_count
+
+    @staticmethod
+    def create_upload_batch(queue_id: str, stream, webhook_url: str = None, webhook_event: str = 'on_complete',
+                            before_commit: Optional[Callable[[Any, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """Spool a JSONL upload, create its batch and start ingesting in the background"""
+        queue = Queue.query.filter_by(queue_id=queue_id).first()
+        if not queue:
+            raise QueueNotFoundError(f"Queue {queue_id} not registered please register it first")
+        # Turn the upload away before reading it when the queue is already backed up
+        if queue.processing_mode != 'provider_batch':
+            AdmissionService.admit(queue, 0)
+        backlog_ahead = AdmissionService.backlog(queue_id)
+
+        batch_id = uuid.uuid4()
+        os.makedirs(Config.UPLOAD_DIR, exist_ok=True)
+        path = os.path.join(Config.UPLOAD_DIR, f"{batch_id}.jsonl")
+
+        try:
+            message_count = IngestService.spool_upload(stream, path, Config.MAX_UPLOAD_MESSAGES)
+            if message_count == 0:
+                raise UploadError("Upload contains no messages")
+            AdmissionService.admit(queue, message_count)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        # Every non-empty line is expected to become a message, invalid ones
+        # are subtracted once ingestion knows about them
+        batch = Batch(
+            batch_id=batch_id,
+            request_count=message_count,
+            response_count=0,
+            webhook_url=webhook_url,
+            webhook_event=webhook_event,
+            status='processing'
+        )
+        db.session.add(batch)
+        result = {
+            'success': True,
+            'message': 'Batch upload accepted, messages are being ingested',
+            'batch_id': str(batch_id),
+            'message_count': message_count
+        }
+        if before_commit:
+            before_commit(batch_id, result)
+        try:
+            db.session.commit()
+        except Exception:
+            os.remove(path)
+            raise
+
+        RedisService.init_batch_counters(str(batch_id), message_count, queue_id, backlog_ahead)
+
+        from app.tasks.worker_tasks import ingest_batch_upload
+        ingest_batch_upload.delay(str(batch_id), str(queue_id), path)
+
+        return result
+
+    @staticmethod
+    def redispatch(batch_id: str, queue_id: str) -> bool:
+        """Start ingesting a committed upload batch whose request failed to, if its spool file is still there"""
+        path = os.path.join(Config.UPLOAD_DIR, f"{batch_id}.jsonl")
+        if not os.path.exists(path):
+            return False
+        from app.tasks.worker_tasks import ingest_batch_upload
+        ingest_batch_upload.delay(str(batch_id), str(queue_id), path)
+        return True
+
+    @staticmethod
+    def ingest_file(batch_id: str, queue_id: str, path: str, chunk_size: int = None) -> Dict[str, int]:
+        """Insert and enqueue a spooled upload's messages one chunk at a time"""
+        from app.tasks.worker_tasks import submit_provider_batch
+
+        batch = Batch.query.filter_by(batch_id=batch_id).first()
+        offload_provider = ProviderBatchService.get_offload_provider(queue_id, batch.request_count)
+        chunk_size = chunk_size or Config.INGEST_CHUNK_SIZE
+        batch_uuid = uuid.UUID(batch_id)
+        queue_uuid = uuid.UUID(queue_id)
+        system_prompts = {}  # each distinct system prompt is hashed and stored once
+        rows = []
+        inserted = 0
+        invalid = 0
+
+        def flush_rows():
+            db.session.execute(insert(Message), rows)
+            db.session.commit()
+            AdmissionService.accepted(queue_id, len(rows))
+            if offload_provider:
+                # Submitted as provider batch jobs once the whole file is in
+                return
+            with tracing.span('broker.publish', kind='producer', attributes={'message.count': len(rows)}):
+                SchedulerService.submit(queue_id, [
+                    (row['message_id'], Config.DEFAULT_MESSAGE_PRIORITY, None) for row in rows
+                ])
+
+        with open(path, 'rb') as upload:
+            for line in upload:
+                if not line.strip():
+                    continue
+                try:
+                    msg_data = json.loads(line)
+                    prompt = msg_data.get('prompt')
+                except (ValueError, AttributeError):
+                    invalid += 1
+                    continue
+                if not prompt or not isinstance(prompt, str):
+                    invalid += 1
+                    continue
+
+                system_prompt = msg_data.get('system_prompt')
+                if system_prompt not in system_prompts:
+                    if len(system_prompts) >= SYSTEM_PROMPT_CACHE_SIZE:
+                        system_prompts.clear()
+                    system_prompts[system_prompt] = BlobService.externalize(system_prompt)
+                inline_system_prompt, system_prompt_hash = system_prompts[system_prompt]
+                inline_prompt, prompt_hash = BlobService.externalize(prompt)
+
+                rows.append({
+                    'message_id': uuid.uuid4(),
+                    'batch_id': batch_uuid,
+                    'queue_id': queue_uuid,
+                    'prompt': inline_prompt,
+                    'prompt_hash': prompt_hash,
+                    'system_prompt': inline_system_prompt,
+                    'system_prompt_hash': system_prompt_hash,
+                    'supportive_variable': msg_data.get('supportive_variable', {}),
+                    'status': 'pending'
+                })
+                if len(rows) >= chunk_size:
+                    flush_rows()
+                    inserted += len(rows)
+                    rows = []
+
+        if rows:
+            flush_rows()
+            inserted += len(rows)
+
+        if invalid:
+            print(f"⚠️  Skipped {invalid} invalid lines in upload for batch {batch_id}")
+            batch.request_count = inserted
+            db.session.commit()
+            RedisService.set_batch_request_count(batch_id, inserted)
+
+            # Workers may already have answered every valid message
+            counters = RedisService.get_batch_counters(batch_id)
+            if counters['response_count'] >= inserted:
+                RabbitMQService.publish_batch_complete(batch_id)
+
+        if offload_provider and inserted:
+            submit_provider_batch.delay(batch_id, str(offload_provider.provider_id))
+
+        os.remove(path)
+
+        return {
+            'inserted': inserted,
+            'invalid': invalid
+        }
@@ -3,21 +3,34 @@ Message service for processing AI requests
 """
 import uuid
 import json
-from typing import List, Dict, Any, Optional
+from typing import Callable, List, Dict, Any, Optional
+from sqlalchemy.orm import undefer_group
 from app import db
+from app.config.config import Config
 from app.models.message import Message
 from app.models.queue import Queue
 from app.models.provider import Provider
 from app.models.batch import Batch
 from app.utils.exceptions import QueueNotFoundError, MessageNotFoundError
+from app.utils import tracing
+from app.services.admission_service import BACKLOG_STATUSES, AdmissionService
 from app.services.redis_service import RedisService
+from app.services.blob_service import BlobService
+from app.services.deferred_service import DeferredService
+from app.services.provider_batch_service import ProviderBatchService
+from app.services.scheduler_service import SchedulerService
+from app.services.stream_service import StreamService
 from app.services.rabbitmq_service import RabbitMQService
 
+CONTENT_FIELDS = ('prompt', 'system_prompt', 'result', 'supportive_variable')
+CACHE_FILL_CHUNK = 1000  # message IDs per query when filling cache misses
+
 class MessageService:
     """Service for managing messages"""
     
     @staticmethod
-    def create_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
+    def create_message(message_data: Dict[str, Any],
+                       before_commit: Optional[Callable[[Any, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
         """Create a single message with individual batch_id and message_id"""
         queue_id = message_data.get('queue_id')
         
@@ -26,6 +39,20 @@ class MessageService:
         if not queue:
             raise QueueNotFoundError(f"Queue {queue_id} not registered please register it first")
         
+        priority = SchedulerService.parse_priority(message_data.get('priority'), Config.SINGLE_MESSAGE_PRIORITY)
+        deadline = SchedulerService.parse_deadline(message_data.get('deadline'))
+        run_after = DeferredService.parse_run_after(message_data)
+        fill_idle = DeferredService.parse_fill_idle(message_data.get('fill_idle_quota'))
+        deferred = DeferredService.is_deferred(run_after, fill_idle)
+        stream = bool(message_data.get('stream'))
+        if stream and deferred:
+            raise ValueError("Streamed messages cannot use run_after or fill_idle_quota")
+        
+        # Deferred work waits for its time or for idle quota, so a busy queue does not turn it away
+        if not deferred:
+            AdmissionService.admit(queue, 1)
+        backlog_ahead = AdmissionService.backlog(queue_id)
+        
         # Generate batch_id and message_id for single message
         batch_id = uuid.uuid4()
         message_id = uuid.uuid4()
@@ -44,31 +71,50 @@ class MessageService:
             message_id=message_id,
             batch_id=batch_id,
             queue_id=queue_id,
-            prompt=message_data.get('prompt'),
-            system_prompt=message_data.get('system_prompt'),
             supportive_variable=message_data.get('supportive_variable', {}),
-            status='pending'
+            priority=priority,
+            deadline=deadline,
+            run_after=run_after,
+            status='deferred' if deferred else 'pending'
         )
+        message.prompt_text = message_data.get('prompt')
+        message.system_prompt_text = message_data.get('system_prompt')
+        
+        result = {
+            'success': True,
+            'message': 'Message created successfully',
+            'batch_id': str(batch_id),
+            'message_id': str(message_id)
+        }
+        if stream:
+            result['stream_url'] = f"/api/v1/message/stream/{message_id}"
         
         db.session.add(message)
+        if before_commit:
+            before_commit(batch_id, result)
         db.session.commit()
         
         # Initialize Redis counters for this batch
-        RedisService.init_batch_counters(str(batch_id), 1)
+        RedisService.init_batch_counters(str(batch_id), 1, queue_id, backlog_ahead)
+        if deferred:
+            DeferredService.defer(queue_id, [(message_id, priority, deadline, run_after)], fill_idle)
+            return result
+        AdmissionService.accepted(queue_id, 1)
         
-        # Queue message for processing using Celery task
-        from app.tasks.worker_tasks import process_message
-        process_message.delay(str(message_id))
+        # Streamed messages get their event buffer before the worker can start
+        if stream:
+            StreamService.open(str(message_id))
         
-        return {
-            'success': True,
-            'message': 'Message created successfully',
-            'batch_id': str(batch_id),
-            'message_id': str(message_id)
-        }
+        # Queue message for processing by priority and deadline
+        tracing.set_attribute('batch.id', str(batch_id))
+        with tracing.span('broker.publish', kind='producer', attributes={'message.count': 1}):
+            SchedulerService.submit(queue_id, [(message_id, priority, deadline)], stream=stream)
+        
+        return result
     
     @staticmethod
-    def create_batch_messages(batch_data: Dict[str, Any]) -> Dict[str, Any]:
+    def create_batch_messages(batch_data: Dict[str, Any],
+                              before_commit: Optional[Callable[[Any, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
         """Create batch of messages with same batch_id but different message_ids"""
         queue_id = batch_data.get('queue_id')
         messages = batch_data.get('messages', [])
@@ -80,6 +126,19 @@ class MessageService:
         if not queue:
             raise QueueNotFoundError(f"Queue {queue_id} not registered please register it first")
         
+        # Batch-level priority, deadline and run_after, each message may override them
+        batch_priority = SchedulerService.parse_priority(batch_data.get('priority'), Config.DEFAULT_MESSAGE_PRIORITY)
+        batch_deadline = SchedulerService.parse_deadline(batch_data.get('deadline'))
+        batch_run_after = DeferredService.parse_run_after(batch_data)
+        fill_idle = DeferredService.parse_fill_idle(batch_data.get('fill_idle_quota'))
+        
+        # Large batches on provider_batch queues go to the provider's Batch API and are never deferred,
+        # everything else is queued for real-time processing using Celery tasks
+        offload_provider = ProviderBatchService.get_offload_provider(queue_id, len(messages))
+        if not DeferredService.is_deferred(batch_run_after, fill_idle):
+            AdmissionService.admit(queue, len(messages))
+        backlog_ahead = AdmissionService.backlog(queue_id)
+        
         # Generate single batch_id for all messages in the batch
         batch_id = uuid.uuid4()
         
@@ -97,49 +156,141 @@ class MessageService:
         
         # Create messages with same batch_id but different message_ids
         created_messages = []
+        deferred_entries = []
+        message_ids = []
+        system_prompts = {}  # each distinct system prompt is hashed and stored once
         for msg_data in messages:
             message_id = uuid.uuid4()  # Generate unique message_id for each message
             
+            system_prompt = msg_data.get('system_prompt')
+            if system_prompt not in system_prompts:
+                system_prompts[system_prompt] = BlobService.externalize(system_prompt)
+            inline_system_prompt, system_prompt_hash = system_prompts[system_prompt]
+            inline_prompt, prompt_hash = BlobService.externalize(msg_data.get('prompt'))
+            run_after = DeferredService.parse_run_after(msg_data) or batch_run_after
+            deferred = not offload_provider and DeferredService.is_deferred(run_after, fill_idle)
+            
             message = Message(
                 message_id=message_id,
                 batch_id=batch_id,  # Same batch_id for all messages in batch
                 queue_id=queue_id,
-                prompt=msg_data.get('prompt'),
-                system_prompt=msg_data.get('system_prompt'),
+                prompt=inline_prompt,
+                prompt_hash=prompt_hash,
+                system_prompt=inline_system_prompt,
+                system_prompt_hash=system_prompt_hash,
                 supportive_variable=msg_data.get('supportive_variable', {}),
-                status='pending'
+                priority=SchedulerService.parse_priority(msg_data.get('priority'), batch_priority),
+                deadline=SchedulerService.parse_deadline(msg_data.get('deadline')) or batch_deadline,
+                run_after=run_after,
+                status='deferred' if deferred else 'pending'
             )
             db.session.add(message)
-            created_messages.append(message)
+            message_ids.append(str(message_id))
+            if deferred:
+                deferred_entries.append((message_id, message.priority, message.deadline, run_after))
+            else:
+                created_messages.append(message)
         
+        result = {
+            'success': True,
+            'message': 'Batch created successfully',
+            'batch_id': str(batch_id),
+            'processing_mode': 'provider_batch' if offload_provider else 'realtime',
+            'message_count': len(messages),
+            'message_ids': message_ids
+        }
+        
+        if before_commit:
+            before_commit(batch_id, result)
         db.session.commit()
         
         # Initialize Redis counters for this batch
-        RedisService.init_batch_counters(str(batch_id), len(messages))
+        RedisService.init_batch_counters(str(batch_id), len(messages), queue_id, backlog_ahead)
+        AdmissionService.accepted(queue_id, len(created_messages))
+        if deferred_entries:
+            DeferredService.defer(queue_id, deferred_entries, fill_idle)
+        
+        from app.tasks.worker_tasks import submit_provider_batch
+        tracing.set_attribute('batch.id', str(batch_id))
+        if offload_provider:
+            submit_provider_batch.delay(str(batch_id), str(offload_provider.provider_id))
+        elif created_messages:
+            with tracing.span('broker.publish', kind='producer', attributes={'message.count': len(created_messages)}):
+                SchedulerService.submit(queue_id, [
+                    (message.message_id, message.priority, message.deadline) for message in created_messages
+                ])
+        
+        return result
+    
+    @staticmethod
+    def redispatch(batch_id: str) -> int:
+        """Enqueue a committed batch's waiting messages, after the request that created it failed to"""
+        batch = Batch.query.filter_by(batch_id=batch_id).first()
+        messages = Message.query.filter(
+            Message.batch_id == batch_id,
+            Message.status.in_(('pending', 'deferred'))
+        ).order_by(Message.id).all()
+        if not batch or not messages:
+            return 0
+        queue_id = str(messages[0].queue_id)
+        if not RedisService.get_batch_counters(batch_id)['request_count']:
+            RedisService.init_batch_counters(batch_id, batch.request_count, queue_id,
+                                             AdmissionService.backlog(queue_id))
         
-        # Queue messages for processing using Celery tasks
-        from app.tasks.worker_tasks import process_message
-        for message in created_messages:
-            process_message.delay(str(message.message_id))
+        from app.tasks.worker_tasks import submit_provider_batch
+        offload_provider = ProviderBatchService.get_offload_provider(queue_id, batch.request_count)
+        if offload_provider:
+            submit_provider_batch.delay(batch_id, str(offload_provider.provider_id))
+            return len(messages)
+        
+        # Deferral is idempotent, and a deferred message without run_after was waiting for idle quota
+        for fill_idle in (False, True):
+            entries = [
+                (message.message_id, message.priority, message.deadline, message.run_after)
+                for message in messages if message.status == 'deferred' and (message.run_after is None) == fill_idle
+            ]
+            if entries:
+                DeferredService.defer(queue_id, entries, fill_idle)
+        pending = [message for message in messages if message.status == 'pending']
+        if pending:
+            SchedulerService.submit(queue_id, [
+                (message.message_id, message.priority, message.deadline) for message in pending
+            ])
+        return len(messages)
+    
+    @staticmethod
+    def get_message(message_id: str) -> Dict[str, Any]:
+        """Get message by ID, from the Redis cache when it holds the message"""
+        data = RedisService.get_cached_messages([message_id]).get(message_id)
+        if data is None:
+            message = Message.query.options(undefer_group('content')).filter_by(message_id=message_id).first()
+            if not message:
+                raise MessageNotFoundError(f"Message {message_id} not found")
+            data = message.to_dict()
+            RedisService.cache_messages([data])
         
         return {
             'success': True,
-            'message': 'Batch created successfully',
-            'batch_id': str(batch_id),
-            'message_count': len(created_messages),
-            'message_ids': [str(msg.message_id) for msg in created_messages]
+            'data': data
         }
     
     @staticmethod
-    def get_message(message_id: str) -> Dict[str, Any]:
-        """Get message by ID"""
+    def get_message_status(message_id: str) -> Dict[str, Any]:
+        """Get message status without loading prompt or result"""
+        cached = RedisService.get_cached_messages([message_id]).get(message_id)
+        if cached is not None:
+            return {
+                'success': True,
+                'data': {key: value for key, value in cached.items() if key not in CONTENT_FIELDS}
+            }
+        
         message = Message.query.filter_by(message_id=message_id).first()
         if not message:
             raise MessageNotFoundError(f"Message {message_id} not found")
         
         return {
             'success': True,
-            'data': message.to_dict()
+            'data': message.to_status_dict()
         }
     
     @staticmethod
@@ -149,8 +300,12 @@ class MessageService:
         if not message:
             raise MessageNotFoundError(f"Message {message_id} not found")
         
+        waiting = message.status in BACKLOG_STATUSES
         db.session.delete(message)
         db.session.commit()
+        RedisService.invalidate_messages([str(message.message_id)])
+        if waiting:
+            AdmissionService.finished(message.queue_id)
         
         return {
             'success': True,
@@ -159,12 +314,35 @@ class MessageService:
     
     @staticmethod
     def get_batch_messages(batch_id: str) -> Dict[str, Any]:
-        """Get all messages for a batch"""
-        messages = Message.query.filter_by(batch_id=batch_id).all()
+        """Get all messages for a batch, loading only the ones missing from the Redis cache"""
+        message_ids = RedisService.get_batch_message_ids(batch_id)
+        if message_ids is None:
+            message_ids = [
+                str(message_id) for (message_id,) in
+                db.session.query(Message.message_id).filter_by(batch_id=batch_id).order_by(Message.id)
+            ]
+            # An upload may still be ingesting, only a complete list is cached
+            if message_ids and len(message_ids) >= RedisService.get_batch_counters(batch_id)['request_count']:
+                RedisService.cache_batch_message_ids(batch_id, message_ids)
+        
+        cached = RedisService.get_cached_messages(message_ids)
+        missing = [message_id for message_id in message_ids if message_id not in cached]
+        if missing:
+            query = Message.query.options(undefer_group('content'))
+            if len(missing) == len(message_ids):
+                messages = query.filter_by(batch_id=batch_id).all()
+            else:
+                messages = []
+                for start in range(0, len(missing), CACHE_FILL_CHUNK):
+                    messages.extend(query.filter(Message.message_id.in_(missing[start:start + CACHE_FILL_CHUNK])).all())
+            BlobService.prefetch(messages)
+            loaded = [msg.to_dict() for msg in messages]
+            RedisService.cache_messages(loaded)
+            cached.update((data['message_id'], data) for data in loaded)
         
         return {
             'success': True,
-            'data': [msg.to_dict() for msg in messages]
+            'data': [cached[message_id] for message_id in message_ids if message_id in cached]
         }
     
     @staticmethod
@@ -174,7 +352,8 @@ class MessageService:
         if message:
             message.status = status
             if result:
-                message.result = result
+                message.result_text = result
             if error_message:
                 message.error_message = error_message
-            db.session.commit() 
\ No newline at end of file
+            db.session.commit()
+            RedisService.invalidate_messages([str(message.message_id)]) 
\ No newline at end of file
@@ -0,0 +1,235 @@
+"""
+Provider adapters translating chat completion requests and responses
+
+Workers build OpenAI-style chat requests. Each adapter turns one into the
+provider's native request, knows the provider's direct API URL (which its
+generated gateway route proxies to), and turns the provider's response back
+into an OpenAI-style completion with the text under 'content'.
+"""
+from typing import Any, Dict, List
+from app.config.config import Config
+from app.utils.exceptions import APISIXError
+
+def completion(content: str, model: str = None, completion_id: str = None,
+               finish_reason: str = None, usage: Dict[str, Any] = None) -> Dict[str, Any]:
+    """OpenAI-style chat completion with the text also under 'content'"""
+    return {
+        'id': completion_id,
+        'object': 'chat.completion',
+        'model': model,
+        'content': content,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': finish_reason
+        }],
+        'usage': usage
+    }
+
+class ProviderAdapter:
+    """OpenAI chat completions, also the base for compatible APIs"""
+
+    provider_type = 'openai'
+    streams_openai_chunks = True
+
+    @classmethod
+    def api_key(cls, provider) -> str:
+        return provider.config_dict.get('api_key') or provider.api_key
+
+    @classmethod
+    def base_url(cls, provider) -> str:
+        return (provider.config_dict.get('base_url') or Config.OPENAI_API_URL).rstrip('/')
+
+    @classmethod
+    def gateway_url(cls, provider) -> str:
+        return f"{Config.APISIX_GATEWAY_URL}/v1/providers/{provider.provider_id}"
+
+    @classmethod
+    def direct_url(cls, provider) -> str:
+        return f"{cls.base_url(provider)}/chat/completions"
+
+    @classmethod
+    def headers(cls, provider) -> Dict[str, str]:
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': f"Bearer {cls.api_key(provider)}"
+        }
+
+    @classmethod
+    def build_request(cls, provider, request_data: Dict[str, Any]) -> Dict[str, Any]:
+        return request_data
+
+    @classmethod
+    def parse_response(cls, body: Dict[str, Any]) -> Dict[str, Any]:
+        choices = body.get('choices') or [{}]
+        body['content'] = (choices[0].get('message') or {}).get('content') or ''
+        return body
+
+class DeepSeekAdapter(ProviderAdapter):
+    """DeepSeek chat completions, OpenAI compatible"""
+
+    provider_type = 'deepseek'
+
+    @classmethod
+    def base_url(cls, provider) -> str:
+        return (provider.config_dict.get('base_url') or Config.DEEPSEEK_API_URL).rstrip('/')
+
+class AzureOpenAIAdapter(ProviderAdapter):
+    """Azure OpenAI deployments"""
+
+    provider_type = 'azure'
+
+    @classmethod
+    def direct_url(cls, provider) -> str:
+        config = provider.config_dict
+        endpoint = (config.get('endpoint') or Config.AZURE_OPENAI_ENDPOINT or '').rstrip('/')
+        deployment = config.get('deployment') or config.get('model')
+        if not endpoint or not deployment:
+            raise APISIXError("Azure providers need config.endpoint (or AZURE_OPENAI_ENDPOINT) and config.deployment")
+        api_version = config.get('api_version') or Config.AZURE_OPENAI_API_VERSION
+        return f"{endpoint}/openai/deployments/{deployment}/chat/completions?api-version={api_version}"
+
+    @classmethod
+    def headers(cls, provider) -> Dict[str, str]:
+        return {
+            'Content-Type': 'application/json',
+            'api-key': cls.api_key(provider)
+        }
+
+    @classmethod
+    def build_request(cls, provider, request_data: Dict[str, Any]) -> Dict[str, Any]:
+        # The deployment picks the model
+        return {key: value for key, value in request_data.items() if key != 'model'}
+
+class AnthropicAdapter(ProviderAdapter):
+    """Anthropic Messages API"""
+
+    provider_type = 'anthropic'
+    streams_openai_chunks = False
+
+    STOP_REASONS = {'end_turn': 'stop', 'stop_sequence': 'stop', 'max_tokens': 'length', 'tool_use': 'tool_calls'}
+
+    @classmethod
+    def base_url(cls, provider) -> str:
+        return (provider.config_dict.get('base_url') or Config.ANTHROPIC_API_URL).rstrip('/')
+
+    @classmethod
+    def direct_url(cls, provider) -> str:
+        return f"{cls.base_url(provider)}/messages"
+
+    @classmethod
+    def headers(cls, provider) -> Dict[str, str]:
+        return {
+            'Content-Type': 'application/json',
+            'x-api-key': cls.api_key(provider),
+            'anthropic-version': Config.ANTHROPIC_VERSION
+        }
+
+    @classmethod
+    def build_request(cls, provider, request_data: Dict[str, Any]) -> Dict[str, Any]:
+        system = [m['content'] for m in request_data['messages'] if m['role'] == 'system']
+        body = {
+            'model': request_data.get('model'),
+            'max_tokens': request_data.get('max_tokens') or provider.config_dict.get('max_tokens') or Config.ANTHROPIC_MAX_TOKENS,
+            'messages': [
+                {'role': m['role'], 'content': m['content']}
+                for m in request_data['messages'] if m['role'] != 'system'
+            ]
+        }
+        if system:
+            body['system'] = '\n\n'.join(system)
+        if 'temperature' in request_data:
+            body['temperature'] = request_data['temperature']
+        return body
+
+    @classmethod
+    def parse_response(cls, body: Dict[str, Any]) -> Dict[str, Any]:
+        content = ''.join(block.get('text', '') for block in body.get('content') or [] if block.get('type') == 'text')
+        usage = body.get('usage') or {}
+        prompt_tokens = usage.get('input_tokens', 0)
+        completion_tokens = usage.get('output_tokens', 0)
+        return completion(
+            content,
+            model=body.get('model'),
+            completion_id=body.get('id'),
+            finish_reason=cls.STOP_REASONS.get(body.get('stop_reason'), body.get('stop_reason')),
+            usage={
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens
+            }
+        )
+
+class GoogleAdapter(ProviderAdapter):
+    """Google Gemini generateContent API"""
+
+    provider_type = 'google'
+    streams_openai_chunks = False
+
+    FINISH_REASONS = {'STOP': 'stop', 'MAX_TOKENS': 'length', 'SAFETY': 'content_filter', 'RECITATION': 'content_filter'}
+
+    @classmethod
+    def base_url(cls, provider) -> str:
+        return (provider.config_dict.get('base_url') or Config.GOOGLE_API_URL).rstrip('/')
+
+    @classmethod
+    def direct_url(cls, provider) -> str:
+        return f"{cls.base_url(provider)}/models/{provider.config_dict.get('model')}:generateContent"
+
+    @classmethod
+    def headers(cls, provider) -> Dict[str, str]:
+        return {
+            'Content-Type': 'application/json',
+            'x-goog-api-key': cls.api_key(provider)
+        }
+
+    @classmethod
+    def build_request(cls, provider, request_data: Dict[str, Any]) -> Dict[str, Any]:
+        contents: List[Dict[str, Any]] = []
+        system = []
+        for m in request_data['messages']:
+            if m['role'] == 'system':
+                system.append({'text': m['content']})
+            else:
+                role = 'model' if m['role'] == 'assistant' else 'user'
+                contents.append({'role': role, 'parts': [{'text': m['content']}]})
+
+        body = {'contents': contents}
+        if system:
+            body['systemInstruction'] = {'parts': system}
+        if 'temperature' in request_data or 'max_tokens' in request_data:
+            body['generationConfig'] = {}
+            if 'temperature' in request_data:
+                body['generationConfig']['temperature'] = request_data['temperature']
+            if 'max_tokens' in request_data:
+                body['generationConfig']['maxOutputTokens'] = request_data['max_tokens']
+        return body
+
+    @classmethod
+    def parse_response(cls, body: Dict[str, Any]) -> Dict[str, Any]:
+        candidate = (body.get('candidates') or [{}])[0]
+        parts = (candidate.get('content') or {}).get('parts') or []
+        usage = body.get('usageMetadata') or {}
+        return completion(
+            ''.join(part.get('text', '') for part in parts),
+            model=body.get('modelVersion'),
+            completion_id=body.get('responseId'),
+            finish_reason=cls.FINISH_REASONS.get(candidate.get('finishReason'), candidate.get('finishReason')),
+            usage={
+                'prompt_tokens': usage.get('promptTokenCount', 0),
+                'completion_tokens': usage.get('candidatesTokenCount', 0),
+                'total_tokens': usage.get('totalTokenCount', 0)
+            }
+        )
+
+ADAPTERS = {
+    adapter.provider_type: adapter
+    for adapter in (ProviderAdapter, AzureOpenAIAdapter, AnthropicAdapter, DeepSeekAdapter, GoogleAdapter)
+}
+
+def get_adapter(provider_type: str):
+    """Adapter class for a provider type"""
+    adapter = ADAPTERS.get(provider_type)
+    if adapter is None:
+        raise APISIXError(f"Provider type {provider_type} is not supported, expected one of {', '.join(ADAPTERS)}")
+    return adapter
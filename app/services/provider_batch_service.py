@@ -0,0 +1,353 @@
+"""
+Provider batch service for offloading large batches to a provider's Batch API
+
+A batch's messages are written to JSONL job files, uploaded and submitted as
+provider batch jobs, which are then polled until the provider finishes them.
+The results are written back to the messages and the batch goes through the
+usual aggregator and webhook flow, without using the gateway's real-time quota.
+"""
+import json
+import tempfile
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import requests
+from sqlalchemy.orm import undefer_group
+from app import db
+from app.config.config import Config
+from app.models.batch import Batch
+from app.models.message import Message
+from app.models.provider import Provider
+from app.models.provider_batch_job import ProviderBatchJob
+from app.models.queue import Queue
+from app.services.blob_service import BlobService
+from app.services.rabbitmq_service import RabbitMQService
+from app.services.redis_service import RedisService
+from app.utils.exceptions import BatchNotFoundError, ProviderBatchError, ProviderNotFoundError
+
+SUPPORTED_PROVIDER_TYPES = ('openai',)
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+COMPLETION_ENDPOINT = '/v1/chat/completions'
+PAGE_SIZE = 500
+
+class ProviderBatchService:
+    """Service for provider-side batch jobs"""
+
+    @staticmethod
+    def get_offload_provider(queue_id: str, message_count: int) -> Optional[Provider]:
+        """Provider to offload a batch to, or None to process it in real time"""
+        if message_count < Config.PROVIDER_BATCH_MIN_SIZE:
+            return None
+
+        queue = Queue.query.filter_by(queue_id=queue_id).first()
+        if not queue or queue.processing_mode != 'provider_batch':
+            return None
+
+        provider = Provider.query.filter_by(queue_id=queue_id).first()
+        if not provider or provider.provider_type not in SUPPORTED_PROVIDER_TYPES:
+            return None
+        return provider
+
+    @staticmethod
+    def _api(provider: Provider):
+        """Base URL and auth headers for a provider's Batch API"""
+        config = provider.config_dict
+        base_url = (config.get('batch_api_url') or Config.PROVIDER_BATCH_API_URL).rstrip('/')
+        headers = {'Authorization': f"Bearer {config.get('api_key') or provider.api_key}"}
+        return base_url, headers
+
+    @staticmethod
+    def _call(method: str, url: str, **kwargs) -> requests.Response:
+        """Call the Batch API and raise ProviderBatchError on failure"""
+        try:
+            response = requests.request(method, url, timeout=kwargs.pop('timeout', 120), **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise ProviderBatchError(f"Provider batch request failed: {e}")
+        if response.status_code not in (200, 201):
+            raise ProviderBatchError(f"Provider batch request failed: {response.status_code} - {response.text}")
+        return response
+
+    @staticmethod
+    def build_request_body(provider: Provider, message: Message) -> Dict[str, Any]:
+        """Chat completion request for a message, as the real-time worker builds it"""
+        request_data = {
+            'model': provider.config_dict.get('model'),
+            'messages': [
+                {
+                    'role': 'user',
+                    'content': message.prompt_text
+                }
+            ]
+        }
+
+        system_prompt = message.system_prompt_text
+        if system_prompt:
+            request_data['messages'].insert(0, {
+                'role': 'system',
+                'content': system_prompt
+            })
+        return request_data
+
+    @staticmethod
+    def submit(batch_id: str, provider_id: str, on_submitted: Callable[[str], None] = None) -> List[str]:
+        """Submit a batch's pending messages as provider jobs and return their job ids
+
+        on_submitted is called with each job id as soon as the job is committed,
+        so jobs are followed up even if a later job cannot be submitted.
+        """
+        batch = Batch.query.filter_by(batch_id=batch_id).first()
+        if not batch:
+            raise BatchNotFoundError(f"Batch {batch_id} not found")
+        provider = Provider.query.filter_by(provider_id=provider_id).first()
+        if not provider:
+            raise ProviderNotFoundError(f"Provider {provider_id} not found")
+
+        # Pages are read by id so commits between jobs never invalidate a cursor,
+        # and a retried submit only picks up messages that are still pending
+        pending = Message.query.options(undefer_group('content')).filter_by(batch_id=batch_id, status='pending')
+        job_ids = []
+        last_id = 0
+        while True:
+            with tempfile.TemporaryFile() as job_file:
+                message_ids = []
+                while len(message_ids) < Config.PROVIDER_BATCH_MAX_REQUESTS:
+                    limit = min(PAGE_SIZE, Config.PROVIDER_BATCH_MAX_REQUESTS - len(message_ids))
+                    page = pending.filter(Message.id > last_id).order_by(Message.id).limit(limit).all()
+                    if not page:
+                        break
+                    BlobService.prefetch(page)
+                    for message in page:
+                        job_file.write(json.dumps({
+                            'custom_id': str(message.message_id),
+                            'method': 'POST',
+                            'url': COMPLETION_ENDPOINT,
+                            'body': ProviderBatchService.build_request_body(provider, message)
+                        }).encode('utf-8') + b'\n')
+                        message_ids.append(message.message_id)
+                    last_id = page[-1].id
+
+                if not message_ids:
+                    break
+
+                job_file.seek(0)
+                job = ProviderBatchService._create_job(batch, provider, job_file, len(message_ids))
+                # The job and its messages are committed together
+                Message.query.filter(Message.message_id.in_(message_ids)).update(
+                    {'status': 'processing', 'provider_id': provider.provider_id, 'started_at': datetime.utcnow()},
+                    synchronize_session=False
+                )
+                db.session.commit()
+                RedisService.invalidate_messages([str(message_id) for message_id in message_ids])
+                job_ids.append(str(job.job_id))
+                if on_submitted:
+                    on_submitted(str(job.job_id))
+                print(f"📦 Submitted provider batch {job.external_batch_id} with {len(message_ids)} messages "
+                      f"for batch {batch_id}")
+
+        return job_ids
+
+    @staticmethod
+    def _create_job(batch: Batch, provider: Provider, job_file, message_count: int) -> ProviderBatchJob:
+        """Upload a job file and create the provider batch for it"""
+        base_url, headers = ProviderBatchService._api(provider)
+
+        upload = ProviderBatchService._call(
+            'post', f"{base_url}/files",
+            headers=headers,
+            data={'purpose': 'batch'},
+            files={'file': (f"batch_{batch.batch_id}.jsonl", job_file, 'application/jsonl')}
+        ).json()
+
+        created = ProviderBatchService._call(
+            'post', f"{base_url}/batches",
+            headers=headers,
+            json={
+                'input_file_id': upload['id'],
+                'endpoint': COMPLETION_ENDPOINT,
+                'completion_window': Config.PROVIDER_BATCH_COMPLETION_WINDOW,
+                'metadata': {'batch_id': str(batch.batch_id)}
+            }
+        ).json()
+
+        job = ProviderBatchJob(
+            batch_id=batch.batch_id,
+            provider_id=provider.provider_id,
+            external_batch_id=created['id'],
+            input_file_id=upload['id'],
+            status=created.get('status', 'validating'),
+            message_count=message_count
+        )
+        db.session.add(job)
+        db.session.flush()
+        return job
+
+    @staticmethod
+    def poll(job_id: str) -> bool:
+        """Refresh a job's status and apply its results once it ends, True when done"""
+        job = ProviderBatchJob.query.filter_by(job_id=job_id).first()
+        if not job or job.applied_at:
+            return True
+
+        provider = Provider.query.filter_by(provider_id=job.provider_id).first()
+        if not provider:
+            raise ProviderNotFoundError(f"Provider {job.provider_id} not found")
+        base_url, headers = ProviderBatchService._api(provider)
+
+        remote = ProviderBatchService._call(
+            'get', f"{base_url}/batches/{job.external_batch_id}", headers=headers
+        ).json()
+        job.status = remote.get('status', job.status)
+        job.output_file_id = remote.get('output_file_id')
+        job.error_file_id = remote.get('error_file_id')
+        db.session.commit()
+
+        if job.status not in TERMINAL_STATUSES:
+            return False
+
+        for file_id in (job.output_file_id, job.error_file_id):
+            if file_id:
+                ProviderBatchService._apply_results_file(str(job.batch_id), base_url, headers, file_id)
+
+        if job.status != 'completed':
+            errors = remote.get('errors')
+            job.error_message = json.dumps(errors) if errors else f"Provider batch {job.status}"
+        job.applied_at = datetime.utcnow()
+        db.session.commit()
+        ProviderBatchService.finish_batch_if_done(str(job.batch_id))
+        return True
+
+    @staticmethod
+    def abandon(job_id: str, error_message: str) -> None:
+        """Give up on a job that cannot be polled, failing its unanswered messages once the batch is done"""
+        job = ProviderBatchJob.query.filter_by(job_id=job_id).first()
+        if not job or job.applied_at:
+            return
+        job.status = 'failed'
+        job.error_message = error_message
+        job.applied_at = datetime.utcnow()
+        db.session.commit()
+        ProviderBatchService.finish_batch_if_done(str(job.batch_id))
+
+    @staticmethod
+    def _apply_results_file(batch_id: str, base_url: str, headers: Dict[str, str], file_id: str) -> Tuple[int, int]:
+        """Stream a result file and write its results to the messages, returning (applied, failed)"""
+        response = ProviderBatchService._call(
+            'get', f"{base_url}/files/{file_id}/content", headers=headers, stream=True
+        )
+
+        applied = failed = 0
+        records = {}
+        for line in response.iter_lines():
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                records[uuid.UUID(record['custom_id'])] = record
+            except (ValueError, KeyError, TypeError):
+                continue
+            if len(records) >= PAGE_SIZE:
+                page_applied, page_failed = ProviderBatchService._apply_results(batch_id, records)
+                applied, failed = applied + page_applied, failed + page_failed
+                records = {}
+        if records:
+            page_applied, page_failed = ProviderBatchService._apply_results(batch_id, records)
+            applied, failed = applied + page_applied, failed + page_failed
+        return applied, failed
+
+    @staticmethod
+    def _apply_results(batch_id: str, records: Dict[uuid.UUID, Dict[str, Any]]) -> Tuple[int, int]:
+        """Write one page of result records to their messages, returning (applied, failed)
+
+        Each page is counted in Redis as soon as it is committed. A retried apply
+        skips the messages an earlier attempt already wrote, so every message is
+        counted once however many attempts the apply takes.
+        """
+        messages = Message.query.filter(
+            Message.message_id.in_(list(records)),
+            Message.status == 'processing'
+        ).all()
+
+        failed = 0
+        finished_at = datetime.utcnow()
+        for message in messages:
+            message.finished_at = finished_at
+            record = records[message.message_id]
+            response = record.get('response') or {}
+            body = response.get('body') or {}
+            error = record.get('error') or body.get('error')
+
+            if response.get('status_code') == 200 and not error:
+                choices = body.get('choices') or [{}]
+                message.status = 'completed'
+                message.result_text = (choices[0].get('message') or {}).get('content', '')
+            else:
+                message.status = 'failed'
+                failed += 1
+                if isinstance(error, dict):
+                    message.error_message = error.get('message') or json.dumps(error)
+                else:
+                    message.error_message = str(error or f"Provider returned {response.get('status_code')}")
+
+        db.session.commit()
+        RedisService.invalidate_messages([str(message.message_id) for message in messages])
+        if messages:
+            ProviderBatchService._finish_backlog(batch_id, len(messages))
+
+        if len(messages) > failed:
+            RedisService.increment_batch_response(batch_id, len(messages) - failed)
+        if failed:
+            RedisService.increment_batch_response(batch_id, failed, failed=True)
+        return len(messages), failed
+
+    @staticmethod
+    def _finish_backlog(batch_id: str, message_count: int) -> None:
+        """Take finished messages of a batch off its queue's backlog"""
+        from app.services.admission_service import AdmissionService
+        queue_id = Message.query.with_entities(Message.queue_id).filter_by(batch_id=batch_id).limit(1).scalar()
+        if queue_id:
+            AdmissionService.finished(queue_id, message_count)
+
+    @staticmethod
+    def _message_ids(batch_id: str, status: str) -> List[str]:
+        """IDs of a batch's messages in a status, to drop from the cache after a bulk update"""
+        rows = Message.query.with_entities(Message.message_id).filter_by(batch_id=batch_id, status=status).all()
+        return [str(row.message_id) for row in rows]
+
+    @staticmethod
+    def fail_pending(batch_id: str, error_message: str) -> int:
+        """Fail the messages of a batch that could not be submitted"""
+        message_ids = ProviderBatchService._message_ids(batch_id, 'pending')
+        failed = Message.query.filter_by(batch_id=batch_id, status='pending').update(
+            {'status': 'failed', 'error_message': error_message, 'finished_at': datetime.utcnow()},
+            synchronize_session=False
+        )
+        db.session.commit()
+        RedisService.invalidate_messages(message_ids)
+        if failed:
+            ProviderBatchService._finish_backlog(batch_id, failed)
+            RedisService.increment_batch_response(batch_id, failed, failed=True)
+        return failed
+
+    @staticmethod
+    def finish_batch_if_done(batch_id: str) -> bool:
+        """Hand the batch to the aggregator once every provider job is applied"""
+        if ProviderBatchJob.query.filter_by(batch_id=batch_id, applied_at=None).first():
+            return False
+        if Message.query.filter_by(batch_id=batch_id, status='pending').first():
+            return False
+
+        # Anything the provider never answered is failed rather than left hanging
+        message_ids = ProviderBatchService._message_ids(batch_id, 'processing')
+        missing = Message.query.filter_by(batch_id=batch_id, status='processing').update(
+            {'status': 'failed', 'error_message': 'No result returned by the provider batch job',
+             'finished_at': datetime.utcnow()},
+            synchronize_session=False
+        )
+        db.session.commit()
+        RedisService.invalidate_messages(message_ids)
+        if missing:
+            ProviderBatchService._finish_backlog(batch_id, missing)
+            RedisService.increment_batch_response(batch_id, missing, failed=True)
+
+        RabbitMQService.publish_batch_complete(batch_id)
+        return True
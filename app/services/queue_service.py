@@ -6,13 +6,17 @@ from typing import List, Optional, Dict, Any
 from app import db
 from app.models.queue import Queue
 from app.models.provider import Provider
+from app.models.message import Message
+from app.services.admission_service import AdmissionService
+from app.services.redis_service import RedisService
 from app.utils.exceptions import QueueNotFoundError, QueueAlreadyExistsError
 
 class QueueService:
     """Service for managing queues"""
     
     @staticmethod
-    def create_queue(queue_id: str, providers: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def create_queue(queue_id: str, providers: List[Dict[str, Any]], processing_mode: str = 'realtime',
+                     hedging: bool = False, weight: int = 1) -> Dict[str, Any]:
         """Create a new queue with providers"""
         try:
             # Convert string queue_id to UUID
@@ -27,7 +31,7 @@ class QueueService:
                 raise QueueAlreadyExistsError(f"Queue {queue_id} already exists")
             
             # Create queue
-            queue = Queue(queue_id=queue_uuid)
+            queue = Queue(queue_id=queue_uuid, processing_mode=processing_mode, hedging=hedging, weight=weight)
             db.session.add(queue)
             db.session.flush()  # Get the queue ID
             
@@ -48,6 +52,10 @@ class QueueService:
             
             db.session.commit()
             
+            from app.tasks.worker_tasks import sync_gateway_route
+            for provider in created_providers:
+                sync_gateway_route.delay(str(provider.provider_id))
+            
             return {
                 'success': True,
                 'message': 'Queue and providers created successfully',
@@ -97,6 +105,11 @@ class QueueService:
             'data': result
         }
     
+    @staticmethod
+    def _message_ids(queue_id: uuid.UUID) -> List[str]:
+        """IDs of a queue's messages, to drop them from the read cache"""
+        return [str(message_id) for (message_id,) in db.session.query(Message.message_id).filter_by(queue_id=queue_id)]
+    
     @staticmethod
     def delete_queue(queue_id: str) -> Dict[str, Any]:
         """Delete a queue and all its associated data"""
@@ -109,8 +122,17 @@ class QueueService:
         if not queue:
             raise QueueNotFoundError(f"Queue {queue_id} not found")
         
+        provider_ids = [str(provider.provider_id) for provider in queue.providers]
+        message_ids = QueueService._message_ids(queue_uuid)
         db.session.delete(queue)
         db.session.commit()
+        RedisService.invalidate_messages(message_ids)
+        AdmissionService.reset(queue_uuid)
+        AdmissionService.forget_providers(queue_uuid)
+        
+        from app.tasks.worker_tasks import sync_gateway_route
+        for provider_id in provider_ids:
+            sync_gateway_route.delay(provider_id)
         
         return {
             'success': True,
@@ -130,7 +152,7 @@ class QueueService:
             raise QueueNotFoundError(f"Queue {queue_id} not found")
         
         # Delete all messages
-        from app.models.message import Message
+        message_ids = QueueService._message_ids(queue_uuid)
         messages_deleted = Message.query.filter_by(queue_id=queue_uuid).delete()
         
         # Stop all workers
@@ -138,6 +160,8 @@ class QueueService:
         workers_stopped = Worker.query.filter_by(queue_id=queue_uuid).delete()
         
         db.session.commit()
+        RedisService.invalidate_messages(message_ids)
+        AdmissionService.reset(queue_uuid)
         
         return {
             'success': True,
@@ -0,0 +1,145 @@
+"""
+Concurrent RabbitMQ consumer with prefetch and batched acknowledgements
+
+The connection thread only moves messages. Deliveries are handed to a
+bounded pool of handler threads, and results come back through the
+connection's thread-safe callback queue. At most ``prefetch`` messages are
+unacked at once, so when handlers fall behind the broker stops delivering
+instead of work piling up in memory. Finished deliveries are acked with
+``multiple=True`` every ``ack_batch_size`` completions or ``ack_interval``
+seconds, whichever comes first.
+"""
+import functools
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+import pika
+from app.config.config import Config
+from app.utils import serialization, tracing
+
+class RabbitMQConsumer:
+    """Consume one queue with a bounded pool of handler threads"""
+
+    def __init__(self, queue_name: str, handler: Callable[[Dict[str, Any]], Any], workers: int = None,
+                 prefetch: int = None, ack_batch_size: int = None, ack_interval: float = None):
+        self.queue_name = queue_name
+        self.handler = handler
+        self.workers = workers or Config.RABBITMQ_CONSUMER_WORKERS
+        self.prefetch = prefetch or Config.RABBITMQ_PREFETCH_COUNT
+        self.ack_batch_size = min(ack_batch_size or Config.RABBITMQ_ACK_BATCH_SIZE, self.prefetch)
+        self.ack_interval = ack_interval or Config.RABBITMQ_ACK_INTERVAL
+
+        # Only touched on the connection thread
+        self._outstanding = deque()  # delivery tags in delivery order
+        self._finished = {}  # delivery tag -> (succeeded, redelivered)
+        self._finished_since_flush = 0
+
+        self._connection = None
+        self._channel = None
+        self._executor = None
+
+    def run(self) -> None:
+        """Consume until stop() is called or the connection fails"""
+        self._connection = pika.BlockingConnection(pika.URLParameters(Config.RABBITMQ_URL))
+        self._channel = self._connection.channel()
+        self._channel.queue_declare(queue=self.queue_name, durable=True)
+        self._channel.basic_qos(prefetch_count=self.prefetch)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"consumer-{self.queue_name}")
+
+        self._channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_message, auto_ack=False)
+        self._connection.call_later(self.ack_interval, self._on_ack_timer)
+
+        print(f"Starting to consume messages from {self.queue_name} "
+              f"(workers={self.workers}, prefetch={self.prefetch})")
+        try:
+            self._channel.start_consuming()
+        finally:
+            # Let running handlers finish and ack them before closing
+            self._executor.shutdown(wait=True)
+            if self._connection.is_open:
+                self._connection.process_data_events(time_limit=0)
+                self._flush_acks(force=True)
+                self._connection.close()
+
+    def stop(self) -> None:
+        """Stop consuming, safe to call from any thread or a signal handler"""
+        if self._connection is not None and self._connection.is_open:
+            self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def install_signal_handlers(self) -> None:
+        """Stop gracefully on SIGTERM and SIGINT"""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: self.stop())
+
+    def _on_message(self, channel, method, properties, body) -> None:
+        self._outstanding.append(method.delivery_tag)
+        self._executor.submit(self._handle, method.delivery_tag, method.redelivered, properties, body)
+
+    def _handle(self, delivery_tag: int, redelivered: bool, properties, body: bytes) -> None:
+        """Run the handler on a pool thread and report back to the connection thread"""
+        succeeded = False
+        handle = tracing.start_span(
+            f"rabbitmq.consume {self.queue_name}",
+            carrier=properties.headers,
+            kind='consumer'
+        )
+        error = None
+        try:
+            self.handler(serialization.loads(body))
+            succeeded = True
+        except Exception as e:
+            error = e
+            print(f"❌ Handler failed for message from {self.queue_name}: {e}")
+        finally:
+            tracing.end_span(handle, error)
+
+        self._connection.add_callback_threadsafe(
+            functools.partial(self._on_finished, delivery_tag, succeeded, redelivered)
+        )
+
+    def _on_finished(self, delivery_tag: int, succeeded: bool, redelivered: bool) -> None:
+        self._finished[delivery_tag] = (succeeded, redelivered)
+        self._finished_since_flush += 1
+        if self._finished_since_flush >= self.ack_batch_size:
+            self._flush_acks()
+
+    def _on_ack_timer(self) -> None:
+        self._flush_acks(force=True)
+        self._connection.call_later(self.ack_interval, self._on_ack_timer)
+
+    def _settle_failed(self, delivery_tag: int, redelivered: bool) -> None:
+        # Retry a failed message once, then drop it
+        self._channel.basic_nack(delivery_tag, multiple=False, requeue=not redelivered)
+        if redelivered:
+            print(f"⚠️  Dropping message {delivery_tag} from {self.queue_name} after a failed retry")
+
+    def _flush_acks(self, force: bool = False) -> None:
+        """Ack the longest run of finished deliveries with one multi-ack"""
+        self._finished_since_flush = 0
+        ack_upto = None
+        while self._outstanding and self._outstanding[0] in self._finished:
+            delivery_tag = self._outstanding.popleft()
+            succeeded, redelivered = self._finished.pop(delivery_tag)
+            if succeeded:
+                ack_upto = delivery_tag
+                continue
+            if ack_upto is not None:
+                self._channel.basic_ack(ack_upto, multiple=True)
+                ack_upto = None
+            self._settle_failed(delivery_tag, redelivered)
+        if ack_upto is not None:
+            self._channel.basic_ack(ack_upto, multiple=True)
+
+        if force and self._finished:
+            # A slow message is holding back the run, settle the rest one by one
+            for delivery_tag, (succeeded, redelivered) in self._finished.items():
+                if succeeded:
+                    self._channel.basic_ack(delivery_tag, multiple=False)
+                else:
+                    self._settle_failed(delivery_tag, redelivered)
+            self._outstanding = deque(tag for tag in self._outstanding if tag not in self._finished)
+            self._finished = {}
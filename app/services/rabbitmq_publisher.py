@@ -0,0 +1,294 @@
+"""
+Asynchronous RabbitMQ publisher with pooled confirm-mode channels
+
+One background thread per process owns a SelectConnection and a small pool
+of channels in publisher-confirm mode. Callers only append to an outbox, so
+pika objects are never shared between threads. The broker acknowledges
+publishes asynchronously, usually many at a time. Messages that are still
+unconfirmed when a channel or the connection drops go back to the front of
+the outbox and are published again after the automatic reconnect, so
+delivery is at-least-once.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional
+import pika
+from pika.exceptions import AMQPError
+from app.config.config import Config
+from app.utils.exceptions import RabbitMQError
+
+# Messages published per ioloop callback before yielding to confirms and I/O
+DRAIN_BATCH_SIZE = 500
+
+class RabbitMQPublisher:
+    """Per-process publisher, use RabbitMQPublisher.instance()"""
+
+    _instance = None
+    _instance_pid = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, url: str = None, channel_count: int = None, max_pending: int = None):
+        self.parameters = pika.URLParameters(url or Config.RABBITMQ_URL)
+        self.channel_count = channel_count or Config.RABBITMQ_PUBLISHER_CHANNELS
+        self.max_pending = max_pending or Config.RABBITMQ_PUBLISHER_MAX_PENDING
+
+        # Shared with caller threads, guarded by _cond
+        self._cond = threading.Condition()
+        self._outbox = deque()
+        self._pending = 0  # queued plus published but not yet confirmed
+        self._drain_scheduled = False
+
+        # Owned by the publisher thread
+        self._connection = None
+        self._channels = []
+        self._next_channel = 0
+        self._unconfirmed = {}  # channel number -> OrderedDict(delivery tag -> envelope)
+        self._delivery_tags = {}  # channel number -> last delivery tag used
+        self._declared = set()
+        self._declaring = {}  # queue name -> channel its declare was sent on
+        self._reconnect_delay = 0
+
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='rabbitmq-publisher', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def instance(cls) -> 'RabbitMQPublisher':
+        """Get the publisher for this process, starting it on first use"""
+        pid = os.getpid()
+        if cls._instance is None or cls._instance_pid != pid:
+            with cls._instance_lock:
+                if cls._instance is None or cls._instance_pid != pid:
+                    cls._instance = cls()
+                    cls._instance_pid = pid
+        return cls._instance
+
+    @classmethod
+    def shutdown(cls, timeout: float = None) -> None:
+        """Flush and close this process's publisher if one was started"""
+        if cls._instance is not None and cls._instance_pid == os.getpid():
+            cls._instance.close(timeout)
+            cls._instance = None
+
+    @property
+    def pending(self) -> int:
+        """Messages queued or awaiting a broker confirm"""
+        with self._cond:
+            return self._pending
+
+    def publish(self, queue_name: str, body: bytes, headers: Optional[Dict[str, Any]] = None,
+                timeout: float = None) -> None:
+        """Queue a persistent message, blocking while the backlog is full"""
+        if timeout is None:
+            timeout = Config.RABBITMQ_PUBLISH_TIMEOUT
+
+        with self._cond:
+            if self._stopping:
+                raise RabbitMQError("Publisher is closed")
+            if not self._cond.wait_for(lambda: self._pending < self.max_pending, timeout):
+                raise RabbitMQError(
+                    f"Publisher backlog full ({self._pending} messages awaiting the broker)"
+                )
+            self._outbox.append((queue_name, body, headers))
+            self._pending += 1
+            schedule = not self._drain_scheduled
+            self._drain_scheduled = True
+
+        if schedule:
+            self._schedule_drain()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until the broker has confirmed every queued message"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, timeout: float = None) -> None:
+        """Wait for outstanding confirms, then stop the publisher thread"""
+        if timeout is None:
+            timeout = Config.RABBITMQ_PUBLISH_TIMEOUT
+        if not self.flush(timeout):
+            print(f"⚠️  Closing RabbitMQ publisher with {self.pending} unconfirmed messages")
+
+        self._stopping = True
+        connection = self._connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._close_connection)
+            except Exception:
+                pass
+        self._thread.join(timeout)
+
+    # Everything below runs on the publisher thread
+
+    def _run(self) -> None:
+        while not self._stopping:
+            if self._reconnect_delay:
+                time.sleep(self._reconnect_delay)
+            self._connection = pika.SelectConnection(
+                self.parameters,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_open_error,
+                on_close_callback=self._on_connection_closed
+            )
+            self._connection.ioloop.start()
+            self._reconnect_delay = min(max(self._reconnect_delay * 2, 1), Config.RABBITMQ_RECONNECT_MAX_DELAY)
+
+    def _schedule_drain(self) -> None:
+        connection = self._connection
+        if connection is None:
+            return
+        try:
+            connection.ioloop.add_callback_threadsafe(self._drain)
+        except Exception:
+            # The loop is restarting, the outbox is drained once channels reopen
+            with self._cond:
+                self._drain_scheduled = False
+
+    def _close_connection(self) -> None:
+        if self._connection.is_open:
+            self._connection.close()
+        elif not self._connection.is_closing:
+            self._connection.ioloop.stop()
+
+    def _on_connection_open(self, connection) -> None:
+        self._reconnect_delay = 0
+        for _ in range(self.channel_count):
+            connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error) -> None:
+        print(f"⚠️  RabbitMQ publisher could not connect: {error}")
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason) -> None:
+        for number in list(self._unconfirmed):
+            self._requeue_channel(number)
+        self._channels = []
+        self._declared.clear()
+        self._declaring.clear()
+        if not self._stopping:
+            print(f"⚠️  RabbitMQ publisher connection closed, reconnecting: {reason}")
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel) -> None:
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(
+            self._on_delivery_confirmation,
+            callback=lambda _frame: self._on_confirm_select_ok(channel)
+        )
+
+    def _on_confirm_select_ok(self, channel) -> None:
+        self._unconfirmed[channel.channel_number] = OrderedDict()
+        self._delivery_tags[channel.channel_number] = 0
+        self._channels.append(channel)
+        self._drain()
+
+    def _on_channel_closed(self, channel, reason) -> None:
+        if channel in self._channels:
+            self._channels.remove(channel)
+        for queue_name, declaring_channel in list(self._declaring.items()):
+            if declaring_channel is channel:
+                del self._declaring[queue_name]
+        self._requeue_channel(channel.channel_number)
+
+        connection = self._connection
+        if not self._stopping and connection is not None and connection.is_open:
+            print(f"⚠️  RabbitMQ publisher channel {channel.channel_number} closed: {reason}")
+            connection.channel(on_open_callback=self._on_channel_open)
+
+    def _requeue_channel(self, number: int) -> None:
+        """Put a lost channel's unconfirmed messages back at the front of the outbox"""
+        unconfirmed = self._unconfirmed.pop(number, None)
+        self._delivery_tags.pop(number, None)
+        if unconfirmed:
+            with self._cond:
+                self._outbox.extendleft(reversed(list(unconfirmed.values())))
+
+    def _on_queue_declared(self, queue_name: str) -> None:
+        self._declared.add(queue_name)
+        self._declaring.pop(queue_name, None)
+
+    def _channel_for(self, queue_name: str):
+        """Pick a channel, declaring the queue on it first if needed"""
+        channel = self._declaring.get(queue_name)
+        if channel is not None:
+            # Same channel as the declare, so the publish is ordered after it
+            return channel
+
+        channel = self._channels[self._next_channel % len(self._channels)]
+        self._next_channel += 1
+        if queue_name not in self._declared:
+            channel.queue_declare(
+                queue=queue_name,
+                durable=True,
+                callback=lambda _frame: self._on_queue_declared(queue_name)
+            )
+            self._declaring[queue_name] = channel
+        return channel
+
+    def _drain(self) -> None:
+        with self._cond:
+            self._drain_scheduled = False
+            if not self._channels:
+                return
+            batch = [self._outbox.popleft() for _ in range(min(len(self._outbox), DRAIN_BATCH_SIZE))]
+
+        for index, envelope in enumerate(batch):
+            queue_name, body, headers = envelope
+            try:
+                channel = self._channel_for(queue_name)
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=queue_name,
+                    body=body,
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # make message persistent
+                        content_type='application/json',
+                        headers=headers
+                    )
+                )
+            except AMQPError:
+                # Channel is going away, its close callback reopens it and drains again
+                with self._cond:
+                    self._outbox.extendleft(reversed(batch[index:]))
+                return
+
+            number = channel.channel_number
+            self._delivery_tags[number] += 1
+            self._unconfirmed[number][self._delivery_tags[number]] = envelope
+
+        with self._cond:
+            more = bool(self._outbox) and not self._drain_scheduled
+            self._drain_scheduled = self._drain_scheduled or more
+        if more:
+            self._connection.ioloop.add_callback_threadsafe(self._drain)
+
+    def _on_delivery_confirmation(self, frame) -> None:
+        method = frame.method
+        unconfirmed = self._unconfirmed.get(frame.channel_number)
+        if unconfirmed is None:
+            return
+
+        if method.multiple:
+            tags = []
+            for tag in unconfirmed:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in unconfirmed else []
+        envelopes = [unconfirmed.pop(tag) for tag in tags]
+
+        if isinstance(method, pika.spec.Basic.Nack):
+            with self._cond:
+                self._outbox.extendleft(reversed(envelopes))
+                schedule = not self._drain_scheduled
+                self._drain_scheduled = True
+            if schedule:
+                self._connection.ioloop.add_callback_threadsafe(self._drain)
+            return
+
+        with self._cond:
+            self._pending -= len(envelopes)
+            self._cond.notify_all()
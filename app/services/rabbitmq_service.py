@@ -2,32 +2,45 @@
 RabbitMQ service for message queuing
 """
 import json
+import threading
 import pika
 from typing import Dict, Any, Callable
 from app.config.config import Config
+from app.services.rabbitmq_consumer import RabbitMQConsumer
+from app.services.rabbitmq_publisher import RabbitMQPublisher
+from app.utils import tracing
 
 class RabbitMQService:
-    """Service for RabbitMQ operations"""
+    """Service for RabbitMQ operations
     
-    _connection = None
-    _channel = None
+    Publishing goes through the per-process RabbitMQPublisher. Consumers get
+    a blocking connection per thread, since pika connections are not
+    thread-safe.
+    """
+    
+    _local = threading.local()
     
     @classmethod
     def get_connection(cls):
-        """Get RabbitMQ connection"""
-        if cls._connection is None or cls._connection.is_closed:
-            cls._connection = pika.BlockingConnection(
+        """Get this thread's RabbitMQ connection"""
+        connection = getattr(cls._local, 'connection', None)
+        if connection is None or connection.is_closed:
+            connection = pika.BlockingConnection(
                 pika.URLParameters(Config.RABBITMQ_URL)
             )
-        return cls._connection
+            cls._local.connection = connection
+            cls._local.channel = None
+        return connection
     
     @classmethod
     def get_channel(cls):
-        """Get RabbitMQ channel"""
-        if cls._channel is None or cls._channel.is_closed:
-            connection = cls.get_connection()
-            cls._channel = connection.channel()
-        return cls._channel
+        """Get this thread's RabbitMQ channel"""
+        connection = cls.get_connection()
+        channel = getattr(cls._local, 'channel', None)
+        if channel is None or channel.is_closed:
+            channel = connection.channel()
+            cls._local.channel = channel
+        return channel
     
     @classmethod
     def declare_queue(cls, queue_name: str) -> None:
@@ -38,52 +51,43 @@ class RabbitMQService:
     @classmethod
     def publish_message(cls, message_id: str, queue_name: str, message_data: Dict[str, Any] = None) -> None:
         """Publish message to queue"""
-        channel = cls.get_channel()
-        
-        # Declare queue if it doesn't exist
-        cls.declare_queue(queue_name)
-        
-        # Prepare message
         message = {
             'message_id': message_id,
             'queue_name': queue_name,
             'data': message_data or {}
         }
         
-        # Publish message
-        channel.basic_publish(
-            exchange='',
-            routing_key=queue_name,
-            body=json.dumps(message),
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # make message persistent
-            )
+        RabbitMQPublisher.instance().publish(
+            queue_name,
+            json.dumps(message).encode('utf-8'),
+            headers=tracing.inject_headers()
         )
     
     @classmethod
     def publish_batch_complete(cls, batch_id: str) -> None:
         """Publish batch completion to aggregator queue"""
-        channel = cls.get_channel()
+        if Config.EMBEDDED_MODE:
+            # No RabbitMQ in embedded mode, the batch is aggregated in this process
+            from app.embedded import aggregate_batch
+            aggregate_batch(batch_id)
+            return
         
-        # Declare aggregator queue
-        aggregator_queue = 'batch_aggregator'
-        cls.declare_queue(aggregator_queue)
-        
-        # Publish batch completion
         message = {
             'batch_id': batch_id,
             'event': 'batch_complete'
         }
         
-        channel.basic_publish(
-            exchange='',
-            routing_key=aggregator_queue,
-            body=json.dumps(message),
-            properties=pika.BasicProperties(
-                delivery_mode=2,
-            )
+        RabbitMQPublisher.instance().publish(
+            'batch_aggregator',
+            json.dumps(message).encode('utf-8'),
+            headers=tracing.inject_headers()
         )
     
+    @classmethod
+    def flush(cls, timeout: float = None) -> bool:
+        """Wait until the broker has confirmed everything published so far"""
+        return RabbitMQPublisher.instance().flush(timeout)
+    
     @classmethod
     def consume_messages(cls, queue_name: str, callback: Callable) -> None:
         """Consume messages from queue"""
@@ -92,6 +96,9 @@ class RabbitMQService:
         # Declare queue
         cls.declare_queue(queue_name)
         
+        # Bound the unacked messages the broker pushes to this consumer
+        channel.basic_qos(prefetch_count=Config.RABBITMQ_PREFETCH_COUNT)
+        
         # Set up consumer
         channel.basic_consume(
             queue=queue_name,
@@ -103,14 +110,25 @@ class RabbitMQService:
         channel.start_consuming()
     
     @classmethod
-    def consume_batch_aggregator(cls, callback: Callable) -> None:
-        """Consume batch completion messages"""
-        cls.consume_messages('batch_aggregator', callback)
+    def consume_concurrent(cls, queue_name: str, handler: Callable[[Dict[str, Any]], Any],
+                           workers: int = None) -> None:
+        """Consume decoded messages with a pool of handler threads and batched acks"""
+        consumer = RabbitMQConsumer(queue_name, handler, workers=workers)
+        consumer.install_signal_handlers()
+        consumer.run()
+    
+    @classmethod
+    def consume_batch_aggregator(cls, handler: Callable[[Dict[str, Any]], Any]) -> None:
+        """Consume batch completion messages concurrently"""
+        cls.consume_concurrent('batch_aggregator', handler, workers=Config.AGGREGATOR_CONSUMER_WORKERS)
     
     @classmethod
     def close_connection(cls) -> None:
-        """Close RabbitMQ connection"""
-        if cls._channel and not cls._channel.is_closed:
-            cls._channel.close()
-        if cls._connection and not cls._connection.is_closed:
-            cls._connection.close() 
\ No newline at end of file
+        """Close this thread's RabbitMQ connection and the process publisher"""
+        channel = getattr(cls._local, 'channel', None)
+        connection = getattr(cls._local, 'connection', None)
+        if channel and not channel.is_closed:
+            channel.close()
+        if connection and not connection.is_closed:
+            connection.close()
+        RabbitMQPublisher.shutdown() 
\ No newline at end of file
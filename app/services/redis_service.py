@@ -1,10 +1,21 @@
 """
 Redis service for caching and batch tracking
 """
-import json
+import time
 import redis
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from app.config.config import Config
+from app.utils import serialization
+from app.utils.exceptions import RedisError
+from app.utils.metrics import redis_timed
+
+try:
+    import fakeredis
+except ImportError:  # pragma: no cover - optional dependency
+    fakeredis = None
+
+IN_PROCESS_URL = 'memory://'
+FINISHED_STATUSES = ('completed', 'failed')
 
 class RedisService:
     """Service for Redis operations"""
@@ -15,23 +26,53 @@ class RedisService:
     def get_client(cls):
         """Get Redis client"""
         if cls._redis_client is None:
-            cls._redis_client = redis.from_url(Config.REDIS_URL)
+            if Config.REDIS_URL == IN_PROCESS_URL:
+                if fakeredis is None:
+                    raise RedisError("REDIS_URL=memory:// needs the fakeredis package")
+                cls._redis_client = fakeredis.FakeRedis()
+            else:
+                cls._redis_client = redis.from_url(Config.REDIS_URL)
         return cls._redis_client
     
     @classmethod
-    def init_batch_counters(cls, batch_id: str, message_count: int) -> None:
-        """Initialize batch counters in Redis"""
+    @redis_timed
+    def init_batch_counters(cls, batch_id: str, message_count: int, queue_id: str = None,
+                            backlog_ahead: int = None) -> None:
+        """Initialize batch counters in Redis, with the queue's backlog ahead of the batch"""
         client = cls.get_client()
-        client.hset(f"batch:{batch_id}", "req.count", message_count)
-        client.hset(f"batch:{batch_id}", "res.count", 0)
+        fields = {"req.count": message_count, "res.count": 0, "fail.count": 0, "created.at": time.time()}
+        if queue_id:
+            fields["queue"] = str(queue_id)
+        if backlog_ahead is not None:
+            fields["ahead"] = backlog_ahead
+        client.hset(f"batch:{batch_id}", mapping=fields)
+    
+    @staticmethod
+    def batch_rate_key(batch_id: str, bucket: int) -> str:
+        return f"batch_rate:{batch_id}:{bucket}"
     
     @classmethod
-    def increment_batch_response(cls, batch_id: str) -> int:
-        """Increment batch response counter"""
+    @redis_timed
+    def increment_batch_response(cls, batch_id: str, amount: int = 1, failed: bool = False) -> int:
+        """Count finished messages of a batch, failed ones also under fail.count, and return res.count"""
+        key = cls.batch_rate_key(batch_id, int(time.time() // Config.BATCH_RATE_BUCKET_SECONDS))
+        pipe = cls.get_client().pipeline(transaction=False)
+        pipe.hincrby(f"batch:{batch_id}", "res.count", amount)
+        if failed:
+            pipe.hincrby(f"batch:{batch_id}", "fail.count", amount)
+        pipe.incrby(key, amount)
+        pipe.expire(key, Config.BATCH_RATE_WINDOW + Config.BATCH_RATE_BUCKET_SECONDS)
+        return pipe.execute()[0]
+    
+    @classmethod
+    @redis_timed
+    def set_batch_request_count(cls, batch_id: str, message_count: int) -> None:
+        """Update the expected response count of a batch"""
         client = cls.get_client()
-        return client.hincrby(f"batch:{batch_id}", "res.count", 1)
+        client.hset(f"batch:{batch_id}", "req.count", message_count)
     
     @classmethod
+    @redis_timed
     def get_batch_counters(cls, batch_id: str) -> Dict[str, int]:
         """Get batch counters"""
         client = cls.get_client()
@@ -41,28 +82,122 @@ class RedisService:
             'response_count': int(data.get(b'res.count', 0))
         }
     
+    @staticmethod
+    def _message_ttl(message: Dict[str, Any]) -> int:
+        """Finished messages no longer change and are kept long, others only briefly"""
+        if message['status'] in FINISHED_STATUSES:
+            return Config.MESSAGE_CACHE_TTL
+        return Config.MESSAGE_CACHE_ACTIVE_TTL
+    
     @classmethod
-    def store_message_result(cls, message_id: str, result: Dict[str, Any]) -> None:
-        """Store message result in Redis"""
-        client = cls.get_client()
-        client.setex(f"message:{message_id}", 3600, json.dumps(result))  # 1 hour TTL
+    @redis_timed
+    def cache_messages(cls, messages: List[Dict[str, Any]]) -> None:
+        """Cache message dicts for the read endpoints"""
+        pipe = cls.get_client().pipeline(transaction=False)
+        for message in messages:
+            ttl = cls._message_ttl(message)
+            if ttl > 0:
+                pipe.setex(f"message:{message['message_id']}", ttl, serialization.dumps(message))
+        pipe.execute()
     
     @classmethod
-    def get_message_result(cls, message_id: str) -> Optional[Dict[str, Any]]:
-        """Get message result from Redis"""
+    @redis_timed
+    def get_cached_messages(cls, message_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Cached message dicts by message ID, leaving out the ones not in the cache"""
+        if not message_ids:
+            return {}
+        values = cls.get_client().mget([f"message:{message_id}" for message_id in message_ids])
+        return {
+            message_id: serialization.loads(value)
+            for message_id, value in zip(message_ids, values) if value
+        }
+    
+    @classmethod
+    @redis_timed
+    def invalidate_messages(cls, message_ids: List[str], chunk_size: int = 1000) -> None:
+        """Drop messages from the cache"""
         client = cls.get_client()
-        data = client.get(f"message:{message_id}")
-        return json.loads(data) if data else None
+        for start in range(0, len(message_ids), chunk_size):
+            client.delete(*[f"message:{message_id}" for message_id in message_ids[start:start + chunk_size]])
+    
+    @classmethod
+    @redis_timed
+    def cache_batch_message_ids(cls, batch_id: str, message_ids: List[str]) -> None:
+        """Cache the message IDs of a batch whose messages have all been created"""
+        if Config.MESSAGE_CACHE_TTL > 0:
+            cls.get_client().setex(f"batch_messages:{batch_id}", Config.MESSAGE_CACHE_TTL,
+                                   serialization.dumps(message_ids))
     
     @classmethod
+    @redis_timed
+    def get_batch_message_ids(cls, batch_id: str) -> Optional[List[str]]:
+        """Cached message IDs of a batch"""
+        data = cls.get_client().get(f"batch_messages:{batch_id}")
+        return serialization.loads(data) if data else None
+    
+    @classmethod
+    @redis_timed
     def store_batch_results(cls, batch_id: str, results: Dict[str, Any]) -> None:
         """Store batch results in Redis"""
         client = cls.get_client()
-        client.setex(f"batch_results:{batch_id}", 86400, json.dumps(results))  # 24 hours TTL
+        client.setex(f"batch_results:{batch_id}", 86400, serialization.dumps(results))  # 24 hours TTL
     
     @classmethod
+    @redis_timed
     def get_batch_results(cls, batch_id: str) -> Optional[Dict[str, Any]]:
         """Get batch results from Redis"""
         client = cls.get_client()
         data = client.get(f"batch_results:{batch_id}")
-        return json.loads(data) if data else None 
\ No newline at end of file
+        return serialization.loads(data) if data else None 
+    
+    @staticmethod
+    def provider_requests_key(provider_id: str, window: int, now: float) -> str:
+        return f"provider_requests:{provider_id}:{int(now // window)}"
+    
+    @classmethod
+    @redis_timed
+    def get_provider_quota(cls, providers: List[Any], now: float) -> List[Tuple[int, float, int, int]]:
+        """(requests left, seconds to window reset, limit, time_window) of each provider with a limit"""
+        providers = [provider for provider in providers if provider.limit and provider.time_window]
+        if not providers:
+            return []
+        used = cls.get_client().mget([
+            cls.provider_requests_key(str(provider.provider_id), provider.time_window, now) for provider in providers
+        ])
+        return [
+            (max(provider.limit - int(count or 0), 0), provider.time_window - now % provider.time_window,
+             provider.limit, provider.time_window)
+            for provider, count in zip(providers, used)
+        ]
+    
+    @classmethod
+    @redis_timed
+    def count_provider_request(cls, provider_id: str, window: int) -> int:
+        """Count a request in the provider's current fixed window and return the window's total"""
+        key = cls.provider_requests_key(provider_id, window, time.time())
+        pipe = cls.get_client().pipeline(transaction=False)
+        pipe.incr(key)
+        pipe.expire(key, window)
+        return pipe.execute()[0]
+    
+    @classmethod
+    @redis_timed
+    def refund_provider_request(cls, provider_id: str, window: int, counted_at: float) -> None:
+        """Take back a request counted at counted_at, unless its window has already rolled over"""
+        now = time.time()
+        if int(now // window) == int(counted_at // window):
+            cls.get_client().decr(cls.provider_requests_key(provider_id, window, now))
+    
+    @classmethod
+    @redis_timed
+    def claim_batch_aggregation(cls, batch_id: str, ttl: int) -> bool:
+        """Claim a batch for aggregation, False if another consumer holds it"""
+        client = cls.get_client()
+        return bool(client.set(f"batch_aggregating:{batch_id}", 1, nx=True, ex=ttl))
+    
+    @classmethod
+    @redis_timed
+    def release_batch_aggregation(cls, batch_id: str) -> None:
+        """Release a batch aggregation claim"""
+        client = cls.get_client()
+        client.delete(f"batch_aggregating:{batch_id}")
\ No newline at end of file
@@ -0,0 +1,180 @@
+"""
+Scheduler service for message priorities and deadlines
+
+Messages are sent to a RabbitMQ priority queue, so higher priority work
+overtakes a backlog of bulk messages. Messages due within
+URGENT_DEADLINE_SLACK seconds go at the top priority.
+
+With SCHEDULER_ENABLED, messages are held in one Redis sorted set per queue,
+scored by deadline. Messages without a deadline get a virtual one of
+SCHEDULER_PRIORITY_SLACK seconds per priority step below 9. The dispatcher
+(app.tasks.scheduler) takes the earliest deadline of each queue, shares
+dispatches between queues by weight, and keeps at most
+SCHEDULER_MAX_IN_FLIGHT messages on the workers, so the ordering happens
+here rather than in a long broker queue.
+"""
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from app.config.config import Config
+from app.services.redis_service import RedisService
+from app.utils.metrics import redis_timed
+
+MAX_PRIORITY = 9
+QUEUES_KEY = 'schedule:queues'
+IN_FLIGHT_KEY = 'schedule:in_flight'
+RETRIES_TTL = 24 * 3600  # seconds a parked message's retry count is kept
+
+class SchedulerService:
+    """Service for priority and deadline scheduling of messages"""
+
+    @staticmethod
+    def parse_priority(value, default: int) -> int:
+        """Message priority from a request, raising ValueError when it is not 0-9"""
+        if value is None:
+            return default
+        if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= MAX_PRIORITY:
+            raise ValueError(f"priority must be an integer from 0 to {MAX_PRIORITY}")
+        return value
+
+    @staticmethod
+    def parse_time(value, name: str) -> Optional[datetime]:
+        """UTC time from an ISO 8601 timestamp or a number of seconds from now"""
+        if value is None:
+            return None
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return datetime.utcnow() + timedelta(seconds=value)
+        try:
+            parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f"{name} must be an ISO 8601 timestamp or seconds from now")
+        if parsed.tzinfo is not None:
+            parsed = (parsed - parsed.utcoffset()).replace(tzinfo=None)
+        return parsed
+
+    @staticmethod
+    def parse_deadline(value) -> Optional[datetime]:
+        """UTC deadline from an ISO 8601 timestamp or a number of seconds from now"""
+        return SchedulerService.parse_time(value, 'deadline')
+
+    @staticmethod
+    def broker_priority(priority: int, deadline: Optional[datetime]) -> int:
+        """Broker priority for a message, raised to the top when its deadline is close"""
+        if deadline and (deadline - datetime.utcnow()).total_seconds() <= Config.URGENT_DEADLINE_SLACK:
+            return MAX_PRIORITY
+        return priority
+
+    @staticmethod
+    def virtual_deadline(priority: int, deadline: Optional[datetime]) -> float:
+        """Epoch seconds a message is due by, real or derived from its priority"""
+        if deadline:
+            return (deadline - datetime(1970, 1, 1)).total_seconds()
+        return time.time() + (MAX_PRIORITY - priority) * Config.SCHEDULER_PRIORITY_SLACK
+
+    @staticmethod
+    def submit(queue_id: str, entries: Iterable[Tuple[str, int, Optional[datetime]]], stream: bool = False) -> None:
+        """Queue (message_id, priority, deadline) entries for processing
+
+        Streamed messages are interactive and always go straight to the broker.
+        """
+        from app.tasks.worker_tasks import process_message
+        if Config.SCHEDULER_ENABLED and not stream:
+            SchedulerService.enqueue(queue_id, entries)
+            return
+        for message_id, priority, deadline in entries:
+            kwargs = {'stream': True} if stream else {}
+            process_message.apply_async(
+                (str(message_id),), kwargs,
+                priority=SchedulerService.broker_priority(priority, deadline)
+            )
+
+    @classmethod
+    @redis_timed
+    def enqueue(cls, queue_id: str, entries: Iterable[Tuple[str, int, Optional[datetime]]]) -> None:
+        """Hold messages in the queue's schedule until the dispatcher sends them"""
+        scores = {
+            str(message_id): cls.virtual_deadline(priority, deadline)
+            for message_id, priority, deadline in entries
+        }
+        if not scores:
+            return
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        pipe.zadd(f"schedule:{queue_id}", scores)
+        pipe.sadd(QUEUES_KEY, str(queue_id))
+        pipe.execute()
+
+    @classmethod
+    @redis_timed
+    def peek(cls, count: int) -> Dict[str, List[Tuple[str, float]]]:
+        """Earliest-deadline messages of every queue with scheduled work"""
+        client = RedisService.get_client()
+        queue_ids = [queue_id.decode() for queue_id in client.smembers(QUEUES_KEY)]
+        pipe = client.pipeline(transaction=False)
+        for queue_id in queue_ids:
+            pipe.zrange(f"schedule:{queue_id}", 0, count - 1, withscores=True)
+        heads = {}
+        for queue_id, members in zip(queue_ids, pipe.execute()):
+            if members:
+                heads[queue_id] = [(member.decode(), score) for member, score in members]
+            else:
+                cls._forget_queue(queue_id)
+        return heads
+
+    @staticmethod
+    def _forget_queue(queue_id: str) -> None:
+        client = RedisService.get_client()
+        client.srem(QUEUES_KEY, queue_id)
+        # A message scheduled between the read and the removal keeps the queue listed
+        if client.zcard(f"schedule:{queue_id}"):
+            client.sadd(QUEUES_KEY, queue_id)
+
+    @classmethod
+    @redis_timed
+    def capacity(cls) -> int:
+        """How many more messages can be dispatched right now"""
+        client = RedisService.get_client()
+        # Entries older than the task time limit belong to workers that died
+        client.zremrangebyscore(IN_FLIGHT_KEY, 0, time.time() - Config.CELERY_TASK_TIME_LIMIT)
+        return Config.SCHEDULER_MAX_IN_FLIGHT - client.zcard(IN_FLIGHT_KEY)
+
+    @classmethod
+    @redis_timed
+    def claim(cls, picks: List[Tuple[str, str]]) -> List[str]:
+        """Take (queue_id, message_id) picks off their schedules, returning the ones this dispatcher won"""
+        client = RedisService.get_client()
+        pipe = client.pipeline(transaction=False)
+        for queue_id, message_id in picks:
+            pipe.zrem(f"schedule:{queue_id}", message_id)
+        claimed = [message_id for (_, message_id), removed in zip(picks, pipe.execute()) if removed]
+        if claimed:
+            now = time.time()
+            client.zadd(IN_FLIGHT_KEY, {message_id: now for message_id in claimed})
+        return claimed
+
+    @classmethod
+    @redis_timed
+    def finish(cls, message_id: str, parked: bool = False) -> None:
+        """Free a dispatched message's in-flight slot, and forget its retries unless it is parked for another"""
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        pipe.zrem(IN_FLIGHT_KEY, message_id)
+        if not parked:
+            pipe.delete(f"schedule:retries:{message_id}")
+        pipe.execute()
+
+    @classmethod
+    @redis_timed
+    def count_retry(cls, message_id: str) -> int:
+        """Count another retry of a dispatched message and return how many it has had"""
+        key = f"schedule:retries:{message_id}"
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        pipe.incr(key)
+        pipe.expire(key, RETRIES_TTL)
+        return pipe.execute()[0]
+
+    @staticmethod
+    def dispatch_priority(score: float) -> int:
+        """Broker priority for a scheduled message from the time left to its deadline"""
+        slack = score - time.time()
+        if slack <= Config.URGENT_DEADLINE_SLACK:
+            return MAX_PRIORITY
+        return max(MAX_PRIORITY - round(slack / Config.SCHEDULER_PRIORITY_SLACK), 0)
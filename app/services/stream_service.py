@@ -0,0 +1,118 @@
+"""
+Stream service relaying token-by-token message output through Redis
+
+The worker appends every event to a per-message Redis list and publishes it
+on a per-message channel in one round trip. Readers subscribe first, replay
+the list, then follow the channel, skipping anything they already replayed,
+so a client that connects late still sees the whole stream in order.
+"""
+import json
+import time
+from typing import Any, Dict, Iterator, Optional
+from app.config.config import Config
+from app.services.redis_service import RedisService
+from app.utils.metrics import redis_timed
+
+TERMINAL_EVENTS = ('done', 'error')
+
+class MessageStream:
+    """Producer side of one message's stream, used by a single worker"""
+
+    def __init__(self, message_id: str, seq: int = 0):
+        self.message_id = message_id
+        self.seq = seq
+
+    def emit(self, event_type: str, **data) -> None:
+        """Append an event to the replay buffer and publish it"""
+        self.seq += 1
+        StreamService.publish(self.message_id, {'seq': self.seq, 'type': event_type, **data})
+
+    def delta(self, content: str) -> None:
+        self.emit('delta', content=content)
+
+    def done(self, content: str, usage: Optional[Dict[str, Any]] = None) -> None:
+        self.emit('done', content=content, usage=usage)
+
+    def error(self, message: str) -> None:
+        self.emit('error', error=message)
+
+class StreamService:
+    """Service for streaming message output over Redis pub/sub"""
+
+    @staticmethod
+    def channel(message_id: str) -> str:
+        return f"message_stream:{message_id}"
+
+    @staticmethod
+    def buffer_key(message_id: str) -> str:
+        return f"message_stream_events:{message_id}"
+
+    @classmethod
+    @redis_timed
+    def open(cls, message_id: str) -> None:
+        """Mark a message as streamed so readers know events will follow"""
+        client = RedisService.get_client()
+        pipe = client.pipeline(transaction=False)
+        pipe.delete(cls.buffer_key(message_id))
+        pipe.rpush(cls.buffer_key(message_id), json.dumps({'seq': 0, 'type': 'queued'}))
+        pipe.expire(cls.buffer_key(message_id), Config.STREAM_BUFFER_TTL)
+        pipe.execute()
+
+    @classmethod
+    @redis_timed
+    def is_streamed(cls, message_id: str) -> bool:
+        """True if the message was created for streaming and its events are still kept"""
+        return bool(RedisService.get_client().exists(cls.buffer_key(message_id)))
+
+    @classmethod
+    def producer(cls, message_id: str) -> MessageStream:
+        """Producer for a message, continuing after any events already sent"""
+        client = RedisService.get_client()
+        return MessageStream(message_id, seq=max(client.llen(cls.buffer_key(message_id)) - 1, 0))
+
+    @classmethod
+    @redis_timed
+    def publish(cls, message_id: str, event: Dict[str, Any]) -> None:
+        """Buffer and publish one event"""
+        payload = json.dumps(event)
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        pipe.rpush(cls.buffer_key(message_id), payload)
+        pipe.expire(cls.buffer_key(message_id), Config.STREAM_BUFFER_TTL)
+        pipe.publish(cls.channel(message_id), payload)
+        pipe.execute()
+
+    @classmethod
+    def events(cls, message_id: str, max_duration: int = None) -> Iterator[Optional[Dict[str, Any]]]:
+        """Yield a message's events from the start, or None as a keep-alive tick
+
+        Stops after a done or error event, or after max_duration seconds.
+        """
+        max_duration = max_duration or Config.STREAM_MAX_DURATION
+        deadline = time.monotonic() + max_duration
+        client = RedisService.get_client()
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(cls.channel(message_id))
+        try:
+            last_seq = -1
+            # Subscribed before replaying, so nothing published in between is lost
+            for raw in client.lrange(cls.buffer_key(message_id), 0, -1):
+                event = json.loads(raw)
+                last_seq = event['seq']
+                yield event
+                if event['type'] in TERMINAL_EVENTS:
+                    return
+
+            while time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=Config.STREAM_HEARTBEAT_INTERVAL)
+                if message is None:
+                    yield None
+                    continue
+                event = json.loads(message['data'])
+                if event['seq'] <= last_seq:
+                    continue
+                last_seq = event['seq']
+                yield event
+                if event['type'] in TERMINAL_EVENTS:
+                    return
+        finally:
+            pubsub.close()
@@ -0,0 +1,192 @@
+"""
+Usage service for token, error and cost accounting
+
+Workers add every provider call to per-minute Redis hash counters for its
+provider, queue and batch. The flush_usage beat task moves finished minutes
+into usage_rollups at minute and hour granularity, so usage queries read a
+few rollup rows instead of scanning messages.
+
+Cost comes from the provider's config.prompt_price and
+config.completion_price, in dollars per million tokens.
+"""
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from app import db
+from app.config.config import Config
+from app.models.usage_rollup import UsageRollup
+from app.services.redis_service import RedisService
+from app.utils.metrics import redis_timed
+
+SCOPES = ('provider', 'queue', 'batch')
+GRANULARITIES = {'minute': 60, 'hour': 3600}
+FIELDS = ('requests', 'errors', 'prompt_tokens', 'completion_tokens', 'latency_ms', 'cost_microusd')
+PENDING_KEY = 'usage:pending'
+FLUSH_LOCK_KEY = 'usage:flush_lock'
+
+class UsageService:
+    """Service for recording and querying provider usage"""
+
+    @staticmethod
+    def _key(scope: str, scope_id, minute: int) -> str:
+        return f"usage:{scope}:{scope_id}:{minute}"
+
+    @staticmethod
+    def cost_microusd(provider, prompt_tokens: int, completion_tokens: int) -> int:
+        """Cost of a call in millionths of a dollar"""
+        config = provider.config_dict
+        return round(prompt_tokens * float(config.get('prompt_price') or 0)
+                     + completion_tokens * float(config.get('completion_price') or 0))
+
+    @classmethod
+    @redis_timed
+    def record(cls, queue_id, batch_id=None, provider=None, usage: Optional[Dict[str, Any]] = None,
+               latency: float = 0.0, succeeded: bool = True) -> None:
+        """Count one provider call against its provider, queue and batch"""
+        usage = usage or {}
+        prompt_tokens = int(usage.get('prompt_tokens') or 0)
+        completion_tokens = int(usage.get('completion_tokens') or 0)
+        counts = {
+            'requests': 1,
+            'errors': 0 if succeeded else 1,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'latency_ms': round(latency * 1000),
+            'cost_microusd': cls.cost_microusd(provider, prompt_tokens, completion_tokens) if provider else 0
+        }
+        minute = int(time.time() // 60)
+        scopes = (('provider', provider.provider_id if provider else None), ('queue', queue_id), ('batch', batch_id))
+
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        for scope, scope_id in scopes:
+            if scope_id is None:
+                continue
+            key = cls._key(scope, scope_id, minute)
+            for field, value in counts.items():
+                if value:
+                    pipe.hincrby(key, field, value)
+            pipe.expire(key, Config.USAGE_COUNTER_TTL)
+            pipe.sadd(PENDING_KEY, key)
+        pipe.execute()
+
+    @classmethod
+    def flush(cls) -> int:
+        """Move finished minutes from Redis into the rollup tables, returning the counters flushed"""
+        client = RedisService.get_client()
+        if not client.set(FLUSH_LOCK_KEY, 1, nx=True, ex=Config.USAGE_FLUSH_LOCK_TTL):
+            return 0
+        try:
+            current_minute = int(time.time() // 60)
+            keys = [key.decode() for key in client.smembers(PENDING_KEY)]
+            keys = [key for key in keys if int(key.rsplit(':', 1)[1]) < current_minute]
+            if not keys:
+                return 0
+
+            # Read and remove in one transaction, so a late increment starts a new counter
+            pipe = client.pipeline(transaction=True)
+            for key in keys:
+                pipe.hgetall(key)
+                pipe.delete(key)
+            pipe.srem(PENDING_KEY, *keys)
+            counters = [
+                (key, {field.decode(): int(value) for field, value in data.items()})
+                for key, data in zip(keys, pipe.execute()[0:-1:2]) if data
+            ]
+
+            try:
+                cls._apply(counters)
+            except Exception:
+                db.session.rollback()
+                cls._restore(counters)
+                raise
+            cls._prune()
+            return len(counters)
+        finally:
+            client.delete(FLUSH_LOCK_KEY)
+
+    @staticmethod
+    def _apply(counters: List[Tuple[str, Dict[str, int]]]) -> None:
+        """Add minute counters to their minute and hour rollups"""
+        totals = {}
+        for key, counts in counters:
+            _, scope, scope_id, minute = key.split(':')
+            for granularity, seconds in GRANULARITIES.items():
+                bucket_start = datetime.utcfromtimestamp(int(minute) * 60 // seconds * seconds)
+                bucket = totals.setdefault((scope, scope_id, granularity, bucket_start), dict.fromkeys(FIELDS, 0))
+                for field in FIELDS:
+                    bucket[field] += counts.get(field, 0)
+
+        existing = {
+            (rollup.scope, rollup.scope_id, rollup.granularity, rollup.bucket_start): rollup
+            for rollup in UsageRollup.query.filter(
+                UsageRollup.scope_id.in_({scope_id for _, scope_id, _, _ in totals}),
+                UsageRollup.bucket_start.in_({bucket_start for _, _, _, bucket_start in totals})
+            ).with_for_update()
+        }
+        for (scope, scope_id, granularity, bucket_start), counts in totals.items():
+            rollup = existing.get((scope, scope_id, granularity, bucket_start))
+            if rollup is None:
+                db.session.add(UsageRollup(
+                    scope=scope, scope_id=scope_id, granularity=granularity, bucket_start=bucket_start, **counts
+                ))
+                continue
+            for field, value in counts.items():
+                setattr(rollup, field, getattr(rollup, field) + value)
+        db.session.commit()
+
+    @classmethod
+    def _restore(cls, counters: List[Tuple[str, Dict[str, int]]]) -> None:
+        """Put counters back in Redis after a failed flush"""
+        pipe = RedisService.get_client().pipeline(transaction=False)
+        for key, counts in counters:
+            for field, value in counts.items():
+                pipe.hincrby(key, field, value)
+            pipe.expire(key, Config.USAGE_COUNTER_TTL)
+            pipe.sadd(PENDING_KEY, key)
+        pipe.execute()
+
+    @staticmethod
+    def _prune() -> None:
+        """Delete minute rollups older than USAGE_MINUTE_RETENTION days"""
+        cutoff = datetime.utcnow() - timedelta(days=Config.USAGE_MINUTE_RETENTION)
+        UsageRollup.query.filter(
+            UsageRollup.granularity == 'minute', UsageRollup.bucket_start < cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def get_usage(scope: str, scope_id: str, granularity: str = 'hour',
+                  start: Optional[datetime] = None, end: Optional[datetime] = None) -> Dict[str, Any]:
+        """Usage of a provider, queue or batch per bucket and in total"""
+        if scope not in SCOPES:
+            raise ValueError(f"scope must be one of {', '.join(SCOPES)}")
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+        end = end or datetime.utcnow()
+        start = start or end - timedelta(seconds=GRANULARITIES[granularity] * Config.USAGE_DEFAULT_BUCKETS)
+
+        rollups = UsageRollup.query.filter(
+            UsageRollup.scope == scope,
+            UsageRollup.scope_id == scope_id,
+            UsageRollup.granularity == granularity,
+            UsageRollup.bucket_start >= start,
+            UsageRollup.bucket_start < end
+        ).order_by(UsageRollup.bucket_start).all()
+
+        totals = UsageRollup(**dict.fromkeys(FIELDS, 0), bucket_start=start)
+        for rollup in rollups:
+            for field in FIELDS:
+                setattr(totals, field, getattr(totals, field) + getattr(rollup, field))
+        totals = totals.to_dict()
+        totals.pop('bucket_start')
+
+        return {
+            'success': True,
+            'scope': scope,
+            'scope_id': scope_id,
+            'granularity': granularity,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'totals': totals,
+            'buckets': [rollup.to_dict() for rollup in rollups]
+        }
@@ -0,0 +1,299 @@
+"""
+Worker registry with heartbeats and per-worker throughput
+
+Every worker process counts the messages it runs in memory, from Celery
+signals, and a background thread publishes them to Redis every
+WORKER_HEARTBEAT_INTERVAL seconds: in flight, processed and failed, the
+throughput and error rate over the last WORKER_STATS_WINDOW seconds and the
+queue it last worked for. Processes are grouped into workers by machine and
+Celery main process, so a prefork worker is one entry however many pool
+processes it has.
+
+The sync_worker_registry task writes the workers to the workers table and
+marks those without a heartbeat for WORKER_DEAD_AFTER seconds as dead.
+"""
+import os
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List
+from app import db
+from app.config.config import Config
+from app.models.queue import Queue
+from app.models.worker import Worker
+from app.services.redis_service import RedisService
+
+PROCESSES_KEY = 'workers:processes'
+SUCCESS = 'SUCCESS'
+FAILURE = 'FAILURE'
+
+class WorkerRegistry:
+    """Service for worker heartbeats, live stats and the workers table"""
+
+    _lock = threading.Lock()
+    _pid = None
+    _state = None
+    _stop = None
+
+    @classmethod
+    def _after_fork(cls) -> None:
+        """Give a forked process its own lock, the parent's may be held by a thread that was not forked"""
+        cls._lock = threading.Lock()
+
+    @staticmethod
+    def _process_key(member: str) -> str:
+        return f"worker_process:{member}"
+
+    @classmethod
+    def _local(cls) -> Dict[str, Any]:
+        """This process's counters, started afresh in a forked pool process"""
+        if cls._pid != os.getpid():
+            cls._pid = os.getpid()
+            cls._stop = threading.Event()
+            cls._state = {
+                'name': None,
+                'main_pid': os.getpid(),
+                'started_at': time.time(),
+                'in_flight': 0,
+                'processed': 0,
+                'failed': 0,
+                'queue': None,
+                'queue_at': 0.0,
+                'finished': deque(),  # (time, failed) of recent messages
+                'running': False
+            }
+        return cls._state
+
+    @classmethod
+    def start(cls, name: str = None, main_pid: int = None) -> None:
+        """Start publishing this process's heartbeats"""
+        with cls._lock:
+            state = cls._local()
+            if name:
+                state['name'] = name
+            if main_pid:
+                state['main_pid'] = main_pid
+            if state['running']:
+                return
+            state['running'] = True
+        threading.Thread(target=cls._heartbeat_loop, name='worker-heartbeat', daemon=True).start()
+
+    @classmethod
+    def stop(cls) -> None:
+        """Publish a last heartbeat marking this process stopped"""
+        state = cls._local()
+        if state['running']:
+            cls._stop.set()
+            cls.publish(status='stopped')
+
+    @classmethod
+    def task_started(cls, name: str = None) -> None:
+        with cls._lock:
+            state = cls._local()
+            state['in_flight'] += 1
+            if name:
+                state['name'] = name
+        if not state['running']:
+            cls.start()
+
+    @classmethod
+    def task_finished(cls, state_name: str) -> None:
+        with cls._lock:
+            state = cls._local()
+            state['in_flight'] = max(state['in_flight'] - 1, 0)
+            # Retries are neither, the message is counted when it finally ends
+            if state_name in (SUCCESS, FAILURE):
+                state['processed' if state_name == SUCCESS else 'failed'] += 1
+                state['finished'].append((time.time(), state_name == FAILURE))
+
+    @classmethod
+    def set_queue(cls, queue_id) -> None:
+        """Record the queue this process is working for"""
+        with cls._lock:
+            state = cls._local()
+            state['queue'] = str(queue_id)
+            state['queue_at'] = time.time()
+
+    @classmethod
+    def _heartbeat_loop(cls) -> None:
+        stop = cls._stop
+        while True:
+            cls.publish()
+            if stop.wait(Config.WORKER_HEARTBEAT_INTERVAL):
+                return
+
+    @classmethod
+    def publish(cls, status: str = 'running') -> None:
+        """Write this process's heartbeat and stats to Redis"""
+        now = time.time()
+        with cls._lock:
+            state = cls._local()
+            finished = state['finished']
+            while finished and finished[0][0] < now - Config.WORKER_STATS_WINDOW:
+                finished.popleft()
+            recent_failed = sum(1 for _, failed in finished if failed)
+            fields = {
+                'node': f"{socket.gethostname()}:{state['main_pid']}",
+                'name': state['name'] or socket.gethostname(),
+                'pid': os.getpid(),
+                'main_pid': state['main_pid'],
+                'status': status,
+                'queue': state['queue'] or '',
+                'queue_at': state['queue_at'],
+                'in_flight': state['in_flight'],
+                'processed': state['processed'],
+                'failed': state['failed'],
+                'recent': len(finished),
+                'recent_failed': recent_failed,
+                'window': min(Config.WORKER_STATS_WINDOW, now - state['started_at']),
+                'started_at': state['started_at'],
+                'heartbeat': now
+            }
+        member = f"{fields['node']}/{fields['pid']}"
+        try:
+            pipe = RedisService.get_client().pipeline(transaction=False)
+            pipe.hset(cls._process_key(member), mapping=fields)
+            pipe.expire(cls._process_key(member), Config.WORKER_DEAD_AFTER * 2)
+            pipe.zadd(PROCESSES_KEY, {member: now})
+            pipe.execute()
+        except Exception as e:
+            print(f"⚠️  Worker heartbeat failed: {e}")
+
+    @classmethod
+    def live(cls) -> List[Dict[str, Any]]:
+        """Workers seen in the last 2 * WORKER_DEAD_AFTER seconds, their processes summed"""
+        client = RedisService.get_client()
+        now = time.time()
+        client.zremrangebyscore(PROCESSES_KEY, '-inf', now - Config.WORKER_DEAD_AFTER * 2)
+        members = [member.decode() for member in client.zrange(PROCESSES_KEY, 0, -1)]
+        pipe = client.pipeline(transaction=False)
+        for member in members:
+            pipe.hgetall(cls._process_key(member))
+
+        workers = {}
+        for data in pipe.execute():
+            if not data:
+                continue
+            process = {key.decode(): value.decode() for key, value in data.items()}
+            worker = workers.setdefault(process['node'], {
+                'node': process['node'],
+                'name': process['name'],
+                'pid': int(process['main_pid']),
+                'processes': 0,
+                'queue': None,
+                'in_flight': 0,
+                'processed': 0,
+                'failed': 0,
+                'throughput': 0.0,
+                'recent': 0,
+                'recent_failed': 0,
+                'started_at': float(process['started_at']),
+                'last_heartbeat': 0.0,
+                'stopped': True,
+                '_queue_at': 0.0
+            })
+            heartbeat = float(process['heartbeat'])
+            worker['processes'] += 1
+            worker['name'] = process['name'] if '@' in process['name'] else worker['name']
+            worker['in_flight'] += int(process['in_flight'])
+            worker['processed'] += int(process['processed'])
+            worker['failed'] += int(process['failed'])
+            worker['recent'] += int(process['recent'])
+            worker['recent_failed'] += int(process['recent_failed'])
+            window = float(process['window'])
+            if window > 0:
+                worker['throughput'] += int(process['recent']) / window
+            worker['started_at'] = min(worker['started_at'], float(process['started_at']))
+            worker['last_heartbeat'] = max(worker['last_heartbeat'], heartbeat)
+            worker['stopped'] = worker['stopped'] and process['status'] == 'stopped'
+            if process['queue'] and float(process['queue_at']) > worker['_queue_at']:
+                worker['queue'], worker['_queue_at'] = process['queue'], float(process['queue_at'])
+
+        result = []
+        for worker in workers.values():
+            del worker['_queue_at']
+            if worker.pop('stopped'):
+                worker['status'] = 'stopped'
+            elif now - worker['last_heartbeat'] > Config.WORKER_DEAD_AFTER:
+                worker['status'] = 'dead'
+            else:
+                worker['status'] = 'running'
+            worker['throughput'] = round(worker['throughput'], 3)
+            worker['error_rate'] = round(worker['recent_failed'] / worker['recent'], 4) if worker['recent'] else 0.0
+            result.append(worker)
+        return sorted(result, key=lambda worker: worker['node'])
+
+    @classmethod
+    def fleet(cls) -> Dict[str, Any]:
+        """Live workers with fleet and per-queue throughput"""
+        workers = cls.live()
+        running = [worker for worker in workers if worker['status'] == 'running']
+        recent = sum(worker['recent'] for worker in running)
+        queues = {}
+        for worker in running:
+            if worker['queue']:
+                queue = queues.setdefault(worker['queue'], {'workers': 0, 'in_flight': 0, 'throughput': 0.0})
+                queue['workers'] += 1
+                queue['in_flight'] += worker['in_flight']
+                queue['throughput'] = round(queue['throughput'] + worker['throughput'], 3)
+        for worker in workers:
+            worker['started_at'] = datetime.utcfromtimestamp(worker['started_at']).isoformat()
+            worker['last_heartbeat'] = datetime.utcfromtimestamp(worker['last_heartbeat']).isoformat()
+        return {
+            'fleet': {
+                'workers': len(running),
+                'processes': sum(worker['processes'] for worker in running),
+                'in_flight': sum(worker['in_flight'] for worker in running),
+                'throughput': round(sum(worker['throughput'] for worker in running), 3),
+                'error_rate': round(sum(worker['recent_failed'] for worker in running) / recent, 4) if recent else 0.0,
+                'window': Config.WORKER_STATS_WINDOW
+            },
+            'queues': queues,
+            'workers': workers
+        }
+
+    @classmethod
+    def sync(cls) -> Dict[str, int]:
+        """Write live workers to the workers table and mark silent ones dead"""
+        workers = cls.live()
+        queue_ids = {worker['queue'] for worker in workers if worker['queue']}
+        known_queues = {
+            str(queue.queue_id) for queue in Queue.query.filter(Queue.queue_id.in_(queue_ids)).all()
+        } if queue_ids else set()
+
+        updated = 0
+        for live in workers:
+            queue_id = live['queue'] if live['queue'] in known_queues else None
+            worker = Worker.query.filter_by(hostname=live['node']).first()
+            if worker is None:
+                # Workers started through the API are known by the PID they were launched with
+                worker = Worker.query.filter_by(pid=live['pid'], hostname=None).first()
+            if worker is None:
+                if not queue_id:
+                    continue  # listed once it has worked for a queue
+                worker = Worker(pid=live['pid'], started_at=datetime.utcfromtimestamp(live['started_at']))
+                db.session.add(worker)
+            worker.hostname = live['node']
+            worker.pid = live['pid']
+            worker.status = live['status']
+            if queue_id:
+                worker.queue_id = queue_id
+            worker.in_flight = live['in_flight']
+            worker.processed_count = live['processed']
+            worker.failed_count = live['failed']
+            worker.throughput = live['throughput']
+            worker.error_rate = live['error_rate']
+            worker.last_heartbeat = datetime.utcfromtimestamp(live['last_heartbeat'])
+            updated += 1
+
+        cutoff = datetime.utcfromtimestamp(time.time() - Config.WORKER_DEAD_AFTER)
+        dead = Worker.query.filter(Worker.status == 'running', Worker.last_heartbeat < cutoff).update(
+            {'status': 'dead', 'in_flight': 0, 'throughput': 0.0}, synchronize_session=False
+        )
+        db.session.commit()
+        return {'updated': updated, 'marked_dead': dead}
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=WorkerRegistry._after_fork)
@@ -0,0 +1,36 @@
+"""
+Consumer for batch completion events on the batch_aggregator queue
+
+Run with: python -m app.tasks.aggregator_consumer
+"""
+from typing import Any, Dict
+from app.config.config import Config
+from app.services.rabbitmq_service import RabbitMQService
+from app.services.redis_service import RedisService
+from app.tasks.worker_tasks import process_batch_aggregator
+
+def handle_batch_complete(message: Dict[str, Any]) -> None:
+    """Aggregate a completed batch unless another consumer is already on it"""
+    batch_id = message.get('batch_id')
+    if not batch_id:
+        print(f"⚠️  Ignoring aggregator message without batch_id: {message}")
+        return
+
+    # Duplicate completion events can arrive on different consumer threads, and
+    # once the claim is released process_batch_aggregator skips completed batches
+    if not RedisService.claim_batch_aggregation(batch_id, Config.AGGREGATOR_CLAIM_TTL):
+        print(f"Batch {batch_id} is already being aggregated, skipping")
+        return
+
+    try:
+        result = process_batch_aggregator(batch_id)
+        if not result.get('success'):
+            print(f"⚠️  Aggregation skipped for batch {batch_id}: {result.get('error')}")
+    finally:
+        RedisService.release_batch_aggregation(batch_id)
+
+def main():
+    RabbitMQService.consume_batch_aggregator(handle_batch_complete)
+
+if __name__ == '__main__':
+    main()
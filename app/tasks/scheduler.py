@@ -0,0 +1,93 @@
+"""
+Dispatcher sending scheduled messages to the workers
+
+Each round it fills the free in-flight slots. The next slot goes to the queue
+that has received the least work for its weight (a virtual clock advanced by
+1/weight per message), and within a queue to the earliest deadline.
+Queues that go idle rejoin at the current clock, so they cannot claim a burst.
+
+Run with: python -m app.tasks.scheduler
+"""
+import signal
+import time
+from typing import Dict
+from app import create_app, db
+from app.config.config import Config
+from app.models.queue import Queue
+from app.services.scheduler_service import SchedulerService
+from app.tasks.worker_tasks import process_message
+
+class MessageDispatcher:
+    """Weighted fair-share, earliest-deadline-first dispatcher"""
+
+    def __init__(self):
+        self.running = True
+        self.clock: Dict[str, float] = {}  # queue_id -> virtual time
+        self.weights: Dict[str, int] = {}
+        self.weights_loaded_at = 0.0
+
+    def stop(self, *_):
+        self.running = False
+
+    def _load_weights(self) -> None:
+        if time.monotonic() - self.weights_loaded_at < Config.SCHEDULER_WEIGHT_REFRESH:
+            return
+        self.weights = {str(queue.queue_id): max(queue.weight or 1, 1) for queue in Queue.query.all()}
+        self.weights_loaded_at = time.monotonic()
+        db.session.remove()
+
+    def run_once(self) -> int:
+        """Dispatch one round and return how many messages were sent"""
+        capacity = SchedulerService.capacity()
+        if capacity <= 0:
+            return 0
+        heads = SchedulerService.peek(min(capacity, Config.SCHEDULER_PEEK_SIZE))
+        if not heads:
+            return 0
+        self._load_weights()
+
+        # Forget idle queues and start new ones at the lowest clock
+        self.clock = {queue_id: self.clock[queue_id] for queue_id in heads if queue_id in self.clock}
+        floor = min(self.clock.values(), default=0.0)
+        for queue_id in heads:
+            self.clock.setdefault(queue_id, floor)
+
+        picks = []
+        scores = {}
+        while len(picks) < capacity and heads:
+            queue_id = min(heads, key=lambda q: (self.clock[q], heads[q][0][1]))
+            message_id, score = heads[queue_id].pop(0)
+            picks.append((queue_id, message_id))
+            scores[message_id] = score
+            self.clock[queue_id] += 1.0 / self.weights.get(queue_id, 1)
+            if not heads[queue_id]:
+                del heads[queue_id]
+
+        claimed = SchedulerService.claim(picks)
+        for message_id in claimed:
+            process_message.apply_async(
+                (message_id,), {'scheduled': True},
+                priority=SchedulerService.dispatch_priority(scores[message_id])
+            )
+        return len(claimed)
+
+    def run(self) -> None:
+        print(f"Starting message dispatcher (max in flight {Config.SCHEDULER_MAX_IN_FLIGHT})")
+        while self.running:
+            try:
+                if not self.run_once():
+                    time.sleep(Config.SCHEDULER_POLL_INTERVAL)
+            except Exception as e:
+                print(f"❌ Dispatch round failed: {e}")
+                time.sleep(1)
+
+def main():
+    app = create_app()
+    dispatcher = MessageDispatcher()
+    signal.signal(signal.SIGTERM, dispatcher.stop)
+    signal.signal(signal.SIGINT, dispatcher.stop)
+    with app.app_context():
+        dispatcher.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Celery signal handlers for worker-side metrics and trace propagation
+"""
+import os
+from celery.signals import (
+    before_task_publish, task_failure, task_postrun, task_prerun,
+    worker_process_init, worker_process_shutdown, worker_ready, worker_shutdown
+)
+from celery.concurrency import prefork
+from app.config.config import Config
+from app.services.rabbitmq_publisher import RabbitMQPublisher
+from app.services.worker_registry import WorkerRegistry
+from app.utils import metrics, tracing
+
+# task_id -> span handle for tasks running in this process
+_task_spans = {}
+
+# Only message processing counts towards worker throughput
+REGISTRY_TASKS = ('app.tasks.worker_tasks.process_message',)
+
+@worker_ready.connect
+def start_metrics_exporter(sender=None, **kwargs):
+    """Expose worker metrics once the worker is up"""
+    if Config.EMBEDDED_MODE:
+        return  # the API's /metrics already serves this process
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR') and isinstance(getattr(sender, 'pool', None), prefork.TaskPool):
+        # Tasks run in the pool processes, this process's registry would never see them
+        print("⚠️  Worker metrics exporter not started: prefork pools need PROMETHEUS_MULTIPROC_DIR")
+        return
+    try:
+        metrics.start_worker_exporter()
+    except OSError as e:
+        print(f"⚠️  Worker metrics exporter not started: {e}")
+
+@worker_ready.connect
+def start_worker_heartbeat(sender=None, **kwargs):
+    """Register the worker's main process in the worker registry"""
+    WorkerRegistry.start(name=getattr(sender, 'hostname', None))
+
+@worker_process_init.connect
+def start_process_heartbeat(**kwargs):
+    """Register a pool process under its parent worker"""
+    WorkerRegistry.start(main_pid=os.getppid())
+
+@worker_process_shutdown.connect
+def stop_process_heartbeat(**kwargs):
+    """Mark a pool process that is exiting as stopped"""
+    WorkerRegistry.stop()
+
+@worker_shutdown.connect
+def stop_worker_heartbeat(**kwargs):
+    """Mark the worker's main process as stopped"""
+    WorkerRegistry.stop()
+
+@task_prerun.connect
+def count_task_started(task=None, **kwargs):
+    """Count a message in flight in this process"""
+    if task.name in REGISTRY_TASKS:
+        WorkerRegistry.task_started()
+
+@task_postrun.connect
+def count_task_finished(task=None, state=None, **kwargs):
+    """Count a message this process finished, by its final state"""
+    if task.name in REGISTRY_TASKS:
+        WorkerRegistry.task_finished(state)
+
+@worker_process_shutdown.connect
+def cleanup_process_metrics(pid=None, **kwargs):
+    """Drop live gauges of a pool process that is exiting"""
+    metrics.mark_process_dead(pid or os.getpid())
+
+@worker_process_shutdown.connect
+def flush_rabbitmq_publisher(**kwargs):
+    """Wait for broker confirms of anything this pool process published"""
+    RabbitMQPublisher.shutdown()
+
+@before_task_publish.connect
+def inject_trace_context(headers=None, **kwargs):
+    """Carry the publisher's trace context in the Celery message headers"""
+    if headers is not None:
+        tracing.inject_headers(headers)
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, **kwargs):
+    """Continue the publisher's trace while the task runs"""
+    tracing.init_tracing(Config.TRACING_SERVICE_NAME)
+    handle = tracing.start_span(
+        f"celery.task {task.name}",
+        carrier=task.request,
+        kind='consumer',
+        attributes={'celery.task_id': task_id}
+    )
+    if handle is not None:
+        _task_spans[task_id] = handle
+
+@task_failure.connect
+def mark_task_span_failed(task_id=None, exception=None, **kwargs):
+    """End the task span with an error status"""
+    tracing.end_span(_task_spans.pop(task_id, None), exception)
+
+@task_postrun.connect
+def end_task_span(task_id=None, **kwargs):
+    """End the task span once the task returns"""
+    tracing.end_span(_task_spans.pop(task_id, None))
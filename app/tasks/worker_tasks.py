@@ -2,85 +2,217 @@
 Celery tasks for processing messages
 """
 import json
+import math
 import requests
 import time
+from datetime import datetime, timedelta
 from typing import Dict, Any
+from celery.exceptions import Retry
+from sqlalchemy.orm import undefer_group
 from app import celery, db
 from app.models.message import Message
 from app.models.provider import Provider
 from app.models.batch import Batch
 from app.services.redis_service import RedisService
+from app.services.admission_service import AdmissionService
 from app.services.rabbitmq_service import RabbitMQService
 from app.services.apisix_service import APISIXService
-from app.utils.exceptions import MessageNotFoundError, ProviderNotFoundError
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.gateway_route_service import GatewayRouteService
+from app.services.hedging_service import HedgingService
+from app.services.deferred_service import DeferredService
+from app.services.idempotency_service import IdempotencyService
+from app.services.blob_service import BlobService
+from app.services.scheduler_service import SchedulerService
+from app.services.stream_service import StreamService
+from app.services.usage_service import UsageService
+from app.services.worker_registry import WorkerRegistry
+from app.config.config import Config
+from app.utils.exceptions import APISIXError, CircuitOpenError, ConcurrencyLimitError, MessageNotFoundError, ProviderBatchError, ProviderNotFoundError, RateLimitExceededError
 from app.utils.celery_context import with_app_context
+from app.utils.profiling import phase
+from app.utils import metrics, tracing
+
+def _count_batch_response(batch_id: str, failed: bool = False) -> None:
+    """Count a finished message of a batch and hand the batch to the aggregator once all are finished"""
+    with phase('redis_increment_batch'):
+        response_count = RedisService.increment_batch_response(batch_id, failed=failed)
+    
+    # Check if batch is complete
+    with phase('batch_completion_check'):
+        batch = Batch.query.filter_by(batch_id=batch_id).first()
+        if batch and response_count >= batch.request_count:
+            # Batch is complete, publish to aggregator queue
+            RabbitMQService.publish_batch_complete(batch_id)
+
+def _retry_later(task, message: Message, exc: Exception, countdown: float, max_retries, scheduled: bool):
+    """Retry a message after countdown seconds, returning a result when it was parked instead of retried
+    
+    Dispatched messages are parked on the deferred timer wheel rather than retried in
+    the broker, so their in-flight slot is free for other queues while they wait and
+    they go back into their queue's schedule, deadline and all, once the wait is over.
+    """
+    if not scheduled:
+        message.status = 'pending'
+        db.session.commit()
+        raise task.retry(exc=exc, countdown=countdown, max_retries=max_retries)
+    
+    if max_retries is not None and SchedulerService.count_retry(str(message.message_id)) > max_retries:
+        raise exc
+    message.status = 'deferred'
+    db.session.commit()
+    # Counted back in when the wait is over and it is released
+    AdmissionService.finished(message.queue_id)
+    DeferredService.defer(message.queue_id, [(
+        message.message_id, message.priority, message.deadline,
+        datetime.utcnow() + timedelta(seconds=countdown)
+    )])
+    return {
+        'success': True,
+        'message_id': str(message.message_id),
+        'deferred_for': countdown
+    }
 
 @celery.task(bind=True)
 @with_app_context
-def process_message(self, message_id: str) -> Dict[str, Any]:
-    """Process a single message through APISIX"""
+def process_message(self, message_id: str, stream: bool = False, scheduled: bool = False) -> Dict[str, Any]:
+    """Process a single message through APISIX, streaming tokens to Redis if asked"""
+    started = time.perf_counter()
+    provider = request_started = None
+    in_flight = None
+    parked = False
+    message_stream = StreamService.producer(message_id) if stream else None
     try:
         # Get message from database
-        message = Message.query.filter_by(message_id=message_id).first()
+        with phase('load_message'):
+            message = Message.query.options(undefer_group('content')).filter_by(message_id=message_id).first()
         if not message:
             raise MessageNotFoundError(f"Message {message_id} not found")
         
+        tracing.set_attribute('message.id', message_id)
+        tracing.set_attribute('batch.id', message.batch_id)
+        WorkerRegistry.set_queue(message.queue_id)
+        in_flight = metrics.QUEUE_IN_FLIGHT.labels(queue=metrics.bounded('queue', message.queue_id))
+        in_flight.inc()
+        
         # Update status to processing
-        message.status = 'processing'
-        db.session.commit()
+        with phase('commit_processing'):
+            message.status = 'processing'
+            message.started_at = datetime.utcnow()
+            db.session.commit()
         
-        # Get provider for the queue
-        provider = Provider.query.filter_by(queue_id=message.queue_id).first()
-        if not provider:
+        # Get the queue's providers, healthiest first
+        with phase('load_provider'):
+            providers = CircuitBreaker.rank(Provider.query.filter_by(queue_id=message.queue_id).all())
+        if not providers:
             raise ProviderNotFoundError(f"No provider found for queue {message.queue_id}")
         
         # Prepare request for APISIX
-        request_data = {
-            'model': provider.config_dict.get('model'),
-            'messages': [
+        with phase('build_request'):
+            messages = [
                 {
                     'role': 'user',
-                    'content': message.prompt
+                    'content': message.prompt_text
                 }
             ]
-        }
+            
+            system_prompt = message.system_prompt_text
+            if system_prompt:
+                messages.insert(0, {
+                    'role': 'system',
+                    'content': system_prompt
+                })
+        
+        def build_request(provider):
+            return {
+                'model': provider.config_dict.get('model'),
+                'messages': messages
+            }
         
-        if message.system_prompt:
-            request_data['messages'].insert(0, {
-                'role': 'system',
-                'content': message.system_prompt
-            })
-        
-        # Send request to APISIX
-        try:
-            response = APISIXService.send_request(
-                provider=provider,
-                request_data=request_data
-            )
-        except Exception as apisix_error:
-            # If APISIX fails, try direct API call as fallback
-            print(f"APISIX failed: {apisix_error}. Trying direct API call...")
-            # For now, just raise the error - we can implement direct API calls later
-            raise apisix_error
+        # Hedging needs a second provider, and streamed tokens can only come from one
+        hedging = not message_stream and len(providers) > 1 and providers[0].queue.hedging
+        
+        # Send request to APISIX, which calls the provider directly if the gateway is down.
+        # Each request first waits for one of the provider's concurrency slots.
+        # Providers with an open circuit, or no free slot in time, are skipped
+        response = None
+        waits = []  # seconds until each rate-limited provider's window resets
+        request_started = time.perf_counter()
+        for index, provider in enumerate(providers):
+            try:
+                with phase('send_request'):
+                    if message_stream:
+                        response = APISIXService.send_streaming_request(
+                            provider=provider,
+                            request_data=build_request(provider),
+                            on_delta=message_stream.delta
+                        )
+                    elif hedging and index + 1 < len(providers):
+                        response, provider = HedgingService.send_request(
+                            message.queue_id, provider, providers[index + 1], build_request
+                        )
+                    else:
+                        response = APISIXService.send_request(
+                            provider=provider,
+                            request_data=build_request(provider)
+                        )
+                break
+            except CircuitOpenError as circuit_error:
+                if provider is providers[-1]:
+                    # Every circuit is open, wait for a half-open probe instead of failing
+                    result = _retry_later(self, message, circuit_error, Config.CIRCUIT_OPEN_SECONDS,
+                                          Config.CIRCUIT_MAX_DEFERRALS, scheduled)
+                    parked = True
+                    return result
+            except ConcurrencyLimitError as concurrency_error:
+                if provider is providers[-1]:
+                    # Every provider is at its concurrency cap, try again once slots free up
+                    result = _retry_later(self, message, concurrency_error, Config.CONCURRENCY_RETRY_DELAY,
+                                          Config.CONCURRENCY_MAX_DEFERRALS, scheduled)
+                    parked = True
+                    return result
+            except RateLimitExceededError as rate_limit_error:
+                waits.append(rate_limit_error.retry_after or Config.CONCURRENCY_RETRY_DELAY)
+                if provider is providers[-1]:
+                    # Every provider has used its quota, wait for the first window to reset
+                    result = _retry_later(self, message, rate_limit_error, math.ceil(min(waits)),
+                                          Config.RATE_LIMIT_MAX_DEFERRALS or None, scheduled)
+                    parked = True
+                    return result
         
         # Update message with result
-        message.status = 'completed'
-        message.result = response.get('content', '')
-        message.provider_id = provider.provider_id
-        db.session.commit()
+        with phase('commit_result'):
+            message.status = 'completed'
+            message.finished_at = datetime.utcnow()
+            message.result_text = response.get('content', '')
+            message.provider_id = provider.provider_id
+            db.session.commit()
+        
+        # Cache the finished message for the read endpoints
+        with phase('redis_store_result'):
+            RedisService.cache_messages([message.to_dict()])
+        
+        with phase('redis_record_usage'):
+            UsageService.record(message.queue_id, message.batch_id, provider, response.get('usage'),
+                                time.perf_counter() - request_started)
+        
+        with phase('redis_count_backlog'):
+            AdmissionService.finished(message.queue_id)
         
-        # Store result in Redis
-        RedisService.store_message_result(str(message.message_id), response)
+        # Tell stream readers the result is persisted
+        if message_stream:
+            message_stream.done(message.result_text, response.get('usage'))
         
         # If this is part of a batch, increment batch counter
         if message.batch_id:
-            response_count = RedisService.increment_batch_response(str(message.batch_id))
-            
-            # Check if batch is complete
-            batch = Batch.query.filter_by(batch_id=message.batch_id).first()
-            if batch and response_count >= batch.request_count:
-                # Batch is complete, publish to aggregator queue
-                RabbitMQService.publish_batch_complete(str(message.batch_id))
+            _count_batch_response(str(message.batch_id))
+        
+        metrics.record_message_processed(message.queue_id, 'completed', started)
+        if message.deadline:
+            metrics.MESSAGE_DEADLINES.labels(
+                queue=metrics.bounded('queue', message.queue_id),
+                outcome='missed' if datetime.utcnow() > message.deadline else 'met'
+            ).inc()
         
         return {
             'success': True,
@@ -88,15 +220,33 @@ def process_message(self, message_id: str) -> Dict[str, Any]:
             'result': response
         }
         
+    except Retry:
+        raise
     except Exception as e:
         # Update message status to failed
-        if 'message' in locals():
+        if 'message' in locals() and message:
             message.status = 'failed'
+            message.finished_at = datetime.utcnow()
             message.error_message = str(e)
             db.session.commit()
+            AdmissionService.finished(message.queue_id)
+            metrics.record_message_processed(message.queue_id, 'failed', started)
+            if request_started is not None:
+                UsageService.record(message.queue_id, message.batch_id, provider,
+                                    latency=time.perf_counter() - request_started, succeeded=False)
+            # A failed message is finished too, or its batch would never complete
+            if message.batch_id:
+                _count_batch_response(str(message.batch_id), failed=True)
+        if message_stream:
+            message_stream.error(str(e))
         
         # Re-raise the exception
         raise e
+    finally:
+        if in_flight is not None:
+            in_flight.dec()
+        if scheduled:
+            SchedulerService.finish(message_id, parked=parked)
 
 @celery.task(bind=True)
 @with_app_context
@@ -107,9 +257,13 @@ def process_batch_aggregator(self, batch_id: str) -> Dict[str, Any]:
         batch = Batch.query.filter_by(batch_id=batch_id).first()
         if not batch:
             return {'success': False, 'error': 'Batch not found'}
+        # Duplicate completion events must not aggregate again or resend the webhook
+        if batch.status == 'completed':
+            return {'success': False, 'error': 'Batch already aggregated'}
         
         # Get all messages for the batch
-        messages = Message.query.filter_by(batch_id=batch_id).all()
+        messages = Message.query.options(undefer_group('content')).filter_by(batch_id=batch_id).all()
+        BlobService.prefetch(messages)
         
         # Aggregate results
         results = []
@@ -117,8 +271,8 @@ def process_batch_aggregator(self, batch_id: str) -> Dict[str, Any]:
             result = {
                 'message_id': str(message.message_id),
                 'status': message.status,
-                'prompt': message.prompt,
-                'result': message.result,
+                'prompt': message.prompt_text,
+                'result': message.result_text,
                 'error_message': message.error_message
             }
             results.append(result)
@@ -138,6 +292,9 @@ def process_batch_aggregator(self, batch_id: str) -> Dict[str, Any]:
         batch.response_count = len([r for r in results if r['status'] == 'completed'])
         db.session.commit()
         
+        if batch.created_at:
+            metrics.BATCH_COMPLETION_TIME.observe((datetime.utcnow() - batch.created_at).total_seconds())
+        
         # Send webhook if configured
         if batch.webhook_url:
             try:
@@ -149,22 +306,32 @@ def process_batch_aggregator(self, batch_id: str) -> Dict[str, Any]:
                     'results': results
                 }
                 
-                response = requests.post(
-                    batch.webhook_url,
-                    json=webhook_data,
-                    timeout=30
-                )
+                webhook_started = time.perf_counter()
+                with tracing.span('http.post webhook', kind='client', attributes={'batch.id': str(batch.batch_id)}):
+                    response = requests.post(
+                        batch.webhook_url,
+                        json=webhook_data,
+                        headers=tracing.inject_headers(),
+                        timeout=30
+                    )
+                    tracing.set_attribute('http.status_code', response.status_code)
                 
                 if response.status_code == 200:
                     batch.webhook_status = 'success'
                 else:
                     batch.webhook_status = 'failed'
+                metrics.WEBHOOK_DELIVERY_LATENCY.labels(outcome=batch.webhook_status).observe(
+                    time.perf_counter() - webhook_started
+                )
                 
                 batch.webhook_last_called_at = time.time()
                 db.session.commit()
                 
             except Exception as e:
                 batch.webhook_status = 'failed'
+                metrics.WEBHOOK_DELIVERY_LATENCY.labels(outcome='error').observe(
+                    time.perf_counter() - webhook_started
+                )
                 db.session.commit()
         
         return {
@@ -176,6 +343,77 @@ def process_batch_aggregator(self, batch_id: str) -> Dict[str, Any]:
     except Exception as e:
         raise e
 
+@celery.task(bind=True)
+@with_app_context
+def ingest_batch_upload(self, batch_id: str, queue_id: str, path: str) -> Dict[str, Any]:
+    """Insert and enqueue the messages of a spooled JSONL upload"""
+    from app.services.ingest_service import IngestService
+    
+    tracing.set_attribute('batch.id', batch_id)
+    counts = IngestService.ingest_file(batch_id, queue_id, path)
+    return {
+        'success': True,
+        'batch_id': batch_id,
+        'inserted': counts['inserted'],
+        'invalid': counts['invalid']
+    }
+
+@celery.task(bind=True, max_retries=3)
+@with_app_context
+def submit_provider_batch(self, batch_id: str, provider_id: str) -> Dict[str, Any]:
+    """Submit a batch to the provider's Batch API and start polling it"""
+    from app.services.provider_batch_service import ProviderBatchService
+    
+    tracing.set_attribute('batch.id', batch_id)
+    
+    def poll_job(job_id):
+        poll_provider_batch.apply_async(args=[job_id], countdown=Config.PROVIDER_BATCH_POLL_INTERVAL)
+    
+    try:
+        job_ids = ProviderBatchService.submit(batch_id, provider_id, on_submitted=poll_job)
+    except ProviderBatchError as e:
+        # Submission resumes with the messages that are still pending
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=Config.PROVIDER_BATCH_POLL_INTERVAL)
+        ProviderBatchService.fail_pending(batch_id, str(e))
+        ProviderBatchService.finish_batch_if_done(batch_id)
+        raise e
+    
+    return {
+        'success': True,
+        'batch_id': batch_id,
+        'job_ids': job_ids
+    }
+
+@celery.task(bind=True)
+@with_app_context
+def poll_provider_batch(self, job_id: str, failures: int = 0) -> Dict[str, Any]:
+    """Poll a provider batch job, rescheduling itself until the job is applied"""
+    from app.services.provider_batch_service import ProviderBatchService
+    
+    try:
+        done = ProviderBatchService.poll(job_id)
+        failures = 0
+    except (ProviderBatchError, ProviderNotFoundError) as e:
+        failures += 1
+        done = False
+        if isinstance(e, ProviderNotFoundError) or failures >= Config.PROVIDER_BATCH_MAX_POLL_FAILURES:
+            print(f"❌ Giving up on provider batch job {job_id} after {failures} failed polls: {e}")
+            ProviderBatchService.abandon(job_id, str(e))
+            done = True
+        else:
+            print(f"⚠️  Polling provider batch job {job_id} failed, will retry: {e}")
+    
+    if not done:
+        poll_provider_batch.apply_async(args=[job_id], kwargs={'failures': failures},
+                                        countdown=Config.PROVIDER_BATCH_POLL_INTERVAL)
+    
+    return {
+        'success': True,
+        'job_id': job_id,
+        'done': done
+    }
+
 @celery.task(bind=True)
 @with_app_context
 def cleanup_expired_data(self) -> Dict[str, Any]:
@@ -183,6 +421,56 @@ def cleanup_expired_data(self) -> Dict[str, Any]:
     try:
         # This task can be scheduled to run periodically
         # to clean up old message results and batch data
-        return {'success': True, 'message': 'Cleanup completed'}
+        blobs_deleted = BlobService.delete_unreferenced()
+        return {'success': True, 'message': 'Cleanup completed', 'blobs_deleted': blobs_deleted}
     except Exception as e:
-        raise e 
\ No newline at end of file
+        raise e 
+
+@celery.task(bind=True)
+@with_app_context
+def flush_usage(self) -> Dict[str, Any]:
+    """Roll finished minutes of Redis usage counters up into usage_rollups"""
+    flushed = UsageService.flush()
+    return {'success': True, 'counters_flushed': flushed}
+
+@celery.task(bind=True)
+@with_app_context
+def prune_idempotency_keys(self) -> Dict[str, Any]:
+    """Delete idempotency keys older than IDEMPOTENCY_RETENTION"""
+    deleted = IdempotencyService.prune()
+    return {'success': True, 'keys_deleted': deleted}
+
+@celery.task(bind=True)
+@with_app_context
+def release_deferred_messages(self) -> Dict[str, Any]:
+    """Release due run_after messages and fill idle provider quota with deferred ones"""
+    released = DeferredService.release_due() + DeferredService.fill_idle_quota()
+    return {'success': True, 'messages_released': released}
+
+@celery.task(bind=True)
+@with_app_context
+def sync_worker_registry(self) -> Dict[str, Any]:
+    """Write worker heartbeats and stats to the workers table and mark silent workers dead"""
+    return {'success': True, **WorkerRegistry.sync()}
+
+@celery.task(bind=True, max_retries=3)
+@with_app_context
+def sync_gateway_route(self, provider_id: str) -> Dict[str, Any]:
+    """Write or delete a provider's APISIX route after the provider changed"""
+    if not Config.GATEWAY_ENABLED:
+        return {'success': True, 'provider_id': provider_id, 'action': 'skipped'}
+    try:
+        action = GatewayRouteService.sync_provider(provider_id)
+    except APISIXError as e:
+        # The periodic reconcile catches up if APISIX stays down
+        raise self.retry(exc=e, countdown=10)
+    return {'success': True, 'provider_id': provider_id, 'action': action}
+
+@celery.task(bind=True)
+@with_app_context
+def reconcile_gateway_routes(self) -> Dict[str, Any]:
+    """Bring the per-provider APISIX routes in line with the providers table"""
+    if not Config.GATEWAY_ENABLED:
+        return {'success': True, 'skipped': True}
+    changes = GatewayRouteService.reconcile()
+    return {'success': True, **changes}
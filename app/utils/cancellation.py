@@ -0,0 +1,87 @@
+"""
+Cancellation of in-flight provider requests
+
+A hedged request that loses the race is cancelled. Whatever the request holds
+registers a callback to give it back, such as its concurrency slot, and the
+sockets of its HTTP session are shut down, so a read blocked on the provider
+returns at once and the provider sees the client go away.
+"""
+import socket
+import threading
+from typing import Callable, List
+import requests
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+class Cancellation:
+    """Cancel signal for one request, shared with the thread running it"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self._session = None
+        self.cancelled = False
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        """Run callback once the request is cancelled, right away if it already is"""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self) -> None:
+        """Cancel the request, running every registered callback"""
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️  Cancelling request failed: {e}")
+
+    @property
+    def session(self) -> requests.Session:
+        """HTTP session for the request, its connections are shut down on cancel"""
+        with self._lock:
+            if self._session is None:
+                self._session = _abortable_session(self)
+            return self._session
+
+    def close(self) -> None:
+        """Close the request's HTTP session once it is done"""
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+def _abortable_session(cancellation: Cancellation) -> requests.Session:
+    """requests.Session whose connections register a socket shutdown with cancellation"""
+
+    def abortable(connection_cls):
+        class AbortableConnection(connection_cls):
+            def connect(self):
+                super().connect()
+                cancellation.on_cancel(self.abort)
+
+            def abort(self):
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except (AttributeError, OSError):
+                    pass  # already closed
+
+        return AbortableConnection
+
+    pool_classes = {
+        'http': type('AbortableHTTPConnectionPool', (HTTPConnectionPool,),
+                     {'ConnectionCls': abortable(HTTPConnection)}),
+        'https': type('AbortableHTTPSConnectionPool', (HTTPSConnectionPool,),
+                      {'ConnectionCls': abortable(HTTPSConnection)})
+    }
+    session = requests.Session()
+    for adapter in session.adapters.values():
+        adapter.poolmanager.pool_classes_by_scheme = pool_classes
+    return session
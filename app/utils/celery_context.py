@@ -1,14 +1,34 @@
 """
 Celery context utilities
 """
+import threading
 from functools import wraps
 from app import create_app
+from app.utils.profiling import phase
+
+_app = None
+_app_lock = threading.Lock()
+
+def set_app(app):
+    """Use an existing app for task contexts, e.g. the API app in embedded mode"""
+    global _app
+    _app = app
+
+def get_app():
+    """The process's Flask app, created on first use and reused by every task"""
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                _app = create_app()
+    return _app
 
 def with_app_context(func):
     """Decorator to add Flask app context to Celery tasks"""
     @wraps(func)
     def wrapper(*args, **kwargs):
-        app = create_app()
+        with phase('app_context'):
+            app = get_app()
         with app.app_context():
             return func(*args, **kwargs)
-    return wrapper 
\ No newline at end of file
+    return wrapper
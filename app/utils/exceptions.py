@@ -32,7 +32,10 @@ class BatchNotFoundError(AIRateLimiterError):
 
 class RateLimitExceededError(AIRateLimiterError):
     """Raised when rate limit is exceeded"""
-    pass
+    
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 class APISIXError(AIRateLimiterError):
     """Raised when APISIX operation fails"""
@@ -44,4 +47,36 @@ class RedisError(AIRateLimiterError):
 
 class RabbitMQError(AIRateLimiterError):
     """Raised when RabbitMQ operation fails"""
-    pass 
\ No newline at end of file
+    pass 
+
+class ProviderBatchError(AIRateLimiterError):
+    """Raised when a provider Batch API call fails"""
+    pass
+
+class UploadError(AIRateLimiterError):
+    """Raised when a bulk upload cannot be ingested"""
+    pass
+
+class CircuitOpenError(AIRateLimiterError):
+    """Raised when a provider's circuit breaker is open"""
+    pass
+
+class ConcurrencyLimitError(AIRateLimiterError):
+    """Raised when no provider concurrency slot frees up in time"""
+    pass
+
+class IdempotencyConflictError(AIRateLimiterError):
+    """Raised when an Idempotency-Key is in use or was used for a different request"""
+    pass
+
+class AdmissionRejectedError(AIRateLimiterError):
+    """Raised when a queue's backlog is too long to accept more messages"""
+    
+    def __init__(self, message: str, retry_after: float, estimated_start=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.estimated_start = estimated_start
+
+class RequestCancelledError(AIRateLimiterError):
+    """Raised when a provider request is cancelled, such as the losing request of a hedge"""
+    pass
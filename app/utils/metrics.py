@@ -0,0 +1,253 @@
+"""
+Prometheus metrics for queues, providers, workers and backing services
+
+Label values that grow with tenants (queues, providers) go through
+``bounded()``, which keeps the first METRICS_MAX_LABEL_VALUES distinct values
+per label and folds the rest into ``other`` so series counts stay bounded.
+
+When PROMETHEUS_MULTIPROC_DIR is set (gunicorn or Celery prefork), every
+process writes to that directory and the exporters aggregate it.
+"""
+import os
+import threading
+import time
+from functools import wraps
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST,
+    generate_latest, multiprocess, start_http_server
+)
+from app.config.config import Config
+from app.utils import tracing
+
+OTHER_LABEL = 'other'
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+BATCH_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 21600, 86400)
+
+_label_values = {}
+_label_lock = threading.Lock()
+
+def bounded(label: str, value) -> str:
+    """Return value as a label, or 'other' once the label has too many values"""
+    value = str(value) if value is not None else 'none'
+    with _label_lock:
+        seen = _label_values.setdefault(label, set())
+        if value in seen:
+            return value
+        if len(seen) < Config.METRICS_MAX_LABEL_VALUES:
+            seen.add(value)
+            return value
+    return OTHER_LABEL
+
+# Provider metrics
+PROVIDER_REQUEST_LATENCY = Histogram(
+    'ai_rate_limiter_provider_request_seconds',
+    'Latency of provider requests sent through the gateway or directly',
+    ['provider_type', 'provider', 'outcome'],
+    buckets=LATENCY_BUCKETS
+)
+PROVIDER_TIME_TO_FIRST_TOKEN = Histogram(
+    'ai_rate_limiter_provider_time_to_first_token_seconds',
+    'Time from sending a streaming provider request to its first content token',
+    ['provider_type', 'provider'],
+    buckets=LATENCY_BUCKETS
+)
+PROVIDER_RATE_LIMITED = Counter(
+    'ai_rate_limiter_provider_rate_limited_total',
+    'Provider requests rejected with HTTP 429',
+    ['provider_type', 'provider']
+)
+PROVIDER_DIRECT_FALLBACK = Counter(
+    'ai_rate_limiter_provider_direct_fallback_total',
+    'Provider requests sent directly because the gateway was unavailable or had no route',
+    ['provider_type', 'reason']
+)
+GATEWAY_ROUTE_CHANGES = Counter(
+    'ai_rate_limiter_gateway_route_changes_total',
+    'Per-provider APISIX routes written or deleted',
+    ['action']
+)
+PROVIDER_CIRCUIT_STATE = Gauge(
+    'ai_rate_limiter_provider_circuit_state',
+    'Provider circuit breaker state (0 closed, 1 half-open, 2 open)',
+    ['provider_type', 'provider'],
+    multiprocess_mode='mostrecent'
+)
+PROVIDER_CIRCUIT_OPENED = Counter(
+    'ai_rate_limiter_provider_circuit_opened_total',
+    'Times a provider circuit breaker opened',
+    ['provider_type']
+)
+PROVIDER_CIRCUIT_REJECTED = Counter(
+    'ai_rate_limiter_provider_circuit_rejected_total',
+    'Provider requests failed fast by an open circuit breaker',
+    ['provider_type']
+)
+PROVIDER_CONCURRENCY_WAIT = Histogram(
+    'ai_rate_limiter_provider_concurrency_wait_seconds',
+    'Time requests waited for a provider concurrency slot',
+    ['provider_type'],
+    buckets=LATENCY_BUCKETS
+)
+PROVIDER_CONCURRENCY_REJECTED = Counter(
+    'ai_rate_limiter_provider_concurrency_rejected_total',
+    'Provider requests that gave up waiting for a concurrency slot',
+    ['provider_type']
+)
+HEDGED_REQUESTS = Counter(
+    'ai_rate_limiter_hedged_requests_total',
+    'Hedging decisions for requests slower than the provider latency percentile',
+    ['outcome']  # primary_won, hedge_won, budget_exhausted
+)
+PROVIDER_QUOTA_REMAINING = Gauge(
+    'ai_rate_limiter_provider_quota_remaining',
+    'Remaining requests in the current window as reported by the provider or gateway',
+    ['provider_type', 'provider'],
+    multiprocess_mode='mostrecent'
+)
+
+# Queue metrics
+QUEUE_BACKLOG = Gauge(
+    'ai_rate_limiter_queue_backlog',
+    'Messages waiting to be processed',
+    ['queue'],
+    multiprocess_mode='mostrecent'
+)
+ADMISSION_REJECTED = Counter(
+    'ai_rate_limiter_admission_rejected_total',
+    'Create requests turned away because the queue backlog was too long',
+    ['queue', 'reason']  # backlog, drain_time
+)
+MESSAGE_DEADLINES = Counter(
+    'ai_rate_limiter_message_deadlines_total',
+    'Completed messages with a deadline, by whether it was met',
+    ['queue', 'outcome']
+)
+QUEUE_IN_FLIGHT = Gauge(
+    'ai_rate_limiter_queue_in_flight',
+    'Messages currently being processed by workers',
+    ['queue'],
+    multiprocess_mode='livesum'
+)
+MESSAGES_PROCESSED = Counter(
+    'ai_rate_limiter_messages_processed_total',
+    'Messages finished by workers',
+    ['queue', 'status']
+)
+MESSAGE_PROCESSING_LATENCY = Histogram(
+    'ai_rate_limiter_message_processing_seconds',
+    'Time spent in process_message',
+    ['status'],
+    buckets=LATENCY_BUCKETS
+)
+
+# Batch and webhook metrics
+BATCH_COMPLETION_TIME = Histogram(
+    'ai_rate_limiter_batch_completion_seconds',
+    'Time from batch creation to aggregation',
+    buckets=BATCH_BUCKETS
+)
+WEBHOOK_DELIVERY_LATENCY = Histogram(
+    'ai_rate_limiter_webhook_delivery_seconds',
+    'Latency of batch webhook deliveries',
+    ['outcome'],
+    buckets=LATENCY_BUCKETS
+)
+
+# Backing service metrics
+DB_QUERY_LATENCY = Histogram(
+    'ai_rate_limiter_db_query_seconds',
+    'Latency of database statements',
+    ['operation'],
+    buckets=FAST_BUCKETS
+)
+REDIS_COMMAND_LATENCY = Histogram(
+    'ai_rate_limiter_redis_command_seconds',
+    'Latency of RedisService operations',
+    ['operation'],
+    buckets=FAST_BUCKETS
+)
+
+def redis_timed(func):
+    """Decorator timing (and tracing) a RedisService operation under its function name"""
+    histogram = REDIS_COMMAND_LATENCY.labels(operation=func.__name__)
+    span_name = f"redis.{func.__name__}"
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with tracing.span(span_name, kind='client', attributes={'db.system': 'redis'}):
+                return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+def record_message_processed(queue_id, status: str, started: float) -> None:
+    """Count a finished message and its processing time"""
+    MESSAGES_PROCESSED.labels(queue=bounded('queue', queue_id), status=status).inc()
+    MESSAGE_PROCESSING_LATENCY.labels(status=status).observe(time.perf_counter() - started)
+
+def instrument_engine(engine) -> None:
+    """Time every statement executed on a SQLAlchemy engine"""
+    from sqlalchemy import event
+
+    if getattr(engine, '_ai_rate_limiter_instrumented', False):
+        return
+    engine._ai_rate_limiter_instrumented = True
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('query_start')
+        if not starts:
+            return
+        operation = statement.lstrip().split(' ', 1)[0].upper()
+        if operation not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+            operation = 'OTHER'
+        DB_QUERY_LATENCY.labels(operation=operation).observe(time.perf_counter() - starts.pop())
+
+def refresh_queue_backlog() -> None:
+    """Set backlog gauges from the database, keeping only the largest queues"""
+    from sqlalchemy import func
+    from app import db
+    from app.models.message import Message
+
+    rows = db.session.query(Message.queue_id, func.count(Message.id)).filter(
+        Message.status == 'pending'
+    ).group_by(Message.queue_id).all()
+    db.session.rollback()
+
+    rows.sort(key=lambda row: row[1], reverse=True)
+    limit = Config.METRICS_MAX_LABEL_VALUES
+    QUEUE_BACKLOG.clear()
+    for queue_id, count in rows[:limit]:
+        QUEUE_BACKLOG.labels(queue=str(queue_id)).set(count)
+    QUEUE_BACKLOG.labels(queue=OTHER_LABEL).set(sum(count for _, count in rows[limit:]))
+
+def get_registry():
+    """Registry to export: the multiprocess aggregate when enabled"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    from prometheus_client import REGISTRY
+    return REGISTRY
+
+def render_latest():
+    """Return (body, content_type) for a /metrics response"""
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
+
+def start_worker_exporter() -> None:
+    """Serve worker metrics on METRICS_WORKER_PORT"""
+    start_http_server(Config.METRICS_WORKER_PORT, registry=get_registry())
+    print(f"📈 Worker metrics exporter listening on :{Config.METRICS_WORKER_PORT}")
+
+def mark_process_dead(pid: int) -> None:
+    """Drop a dead process's live gauges in multiprocess mode"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,57 @@
+"""
+Phase timing utilities for measuring the worker hot path
+
+Code marks its phases with ``phase('name')``. Timings are only collected
+while a ``record_phases()`` block is active on the current thread, and each
+phase becomes a trace span when tracing is enabled. Otherwise the markers
+cost a thread-local lookup.
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from app.utils import tracing
+
+_local = threading.local()
+
+class PhaseRecorder:
+    """Accumulates elapsed seconds per phase name"""
+
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.counts = OrderedDict()
+
+    def add(self, name: str, elapsed: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    @property
+    def total(self) -> float:
+        return sum(self.timings.values())
+
+@contextmanager
+def phase(name: str):
+    """Time a block as the named phase if a recorder is active, and trace it"""
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None and not tracing.enabled():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        with tracing.span(name):
+            yield
+    finally:
+        if recorder is not None:
+            recorder.add(name, time.perf_counter() - start)
+
+@contextmanager
+def record_phases():
+    """Collect phase timings on this thread for the duration of the block"""
+    previous = getattr(_local, 'recorder', None)
+    recorder = PhaseRecorder()
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
@@ -0,0 +1,149 @@
+"""
+Payload serialization utilities for broker, Redis and result payloads
+
+Encoded payloads carry a small header so readers can tell how they were
+written:
+
+    b'\\x01' + <codec byte> + <compression byte> + body
+
+Codec bytes: ``j`` (stdlib json), ``o`` (orjson), ``m`` (msgpack).
+Compression bytes: ``-`` (none), ``z`` (zstd).
+
+Anything that does not start with the marker byte is treated as a legacy
+plain JSON payload, so keys written before this module existed stay readable.
+"""
+import json
+from typing import Any, Optional, Union
+from app.config.config import Config
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+MARKER = b'\x01'
+HEADER_SIZE = 3
+
+CODEC_BYTES = {'json': b'j', 'orjson': b'o', 'msgpack': b'm'}
+CODEC_NAMES = {v: k for k, v in CODEC_BYTES.items()}
+
+COMPRESSION_NONE = b'-'
+COMPRESSION_ZSTD = b'z'
+
+CONTENT_TYPE = 'application/x-airl'
+CELERY_SERIALIZER_NAME = 'airl'
+
+
+def _json_default(value):
+    """Fallback encoder for values json does not know about (UUID, datetime)"""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def available_codecs():
+    """Return the codecs usable in this process"""
+    codecs = ['json']
+    if orjson is not None:
+        codecs.append('orjson')
+    if msgpack is not None:
+        codecs.append('msgpack')
+    return codecs
+
+
+def _resolve_codec(codec: Optional[str]) -> str:
+    """Pick the requested codec, falling back to json when it is not installed"""
+    codec = (codec or Config.PAYLOAD_SERIALIZER).lower()
+    if codec not in CODEC_BYTES:
+        raise ValueError(f"Unknown payload serializer: {codec}")
+    if codec not in available_codecs():
+        return 'json'
+    return codec
+
+
+def _encode_body(obj: Any, codec: str) -> bytes:
+    if codec == 'orjson':
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    if codec == 'msgpack':
+        return msgpack.packb(obj, use_bin_type=True, default=_json_default)
+    return json.dumps(obj, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+
+def _decode_body(body: bytes, codec: str) -> Any:
+    if codec == 'orjson':
+        if orjson is None:
+            # orjson writes plain JSON, so a process without it can still read the payload
+            return json.loads(body)
+        return orjson.loads(body)
+    if codec == 'msgpack':
+        if msgpack is None:
+            raise ValueError("Payload is msgpack encoded but msgpack is not installed")
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+def dumps(obj: Any, codec: str = None, compression: str = None,
+          threshold: int = None) -> bytes:
+    """Serialize an object into a marked payload"""
+    codec = _resolve_codec(codec)
+    compression = (compression or Config.PAYLOAD_COMPRESSION).lower()
+    if threshold is None:
+        threshold = Config.PAYLOAD_COMPRESSION_THRESHOLD
+
+    body = _encode_body(obj, codec)
+    compression_byte = COMPRESSION_NONE
+
+    if compression == 'zstd' and zstandard is not None and len(body) >= threshold:
+        compressed = zstandard.ZstdCompressor(level=Config.PAYLOAD_COMPRESSION_LEVEL).compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            compression_byte = COMPRESSION_ZSTD
+
+    return MARKER + CODEC_BYTES[codec] + compression_byte + body
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str, None]) -> Any:
+    """Deserialize a marked payload, or a legacy plain JSON payload"""
+    if data is None:
+        return None
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    data = bytes(data)
+
+    if not data.startswith(MARKER):
+        return json.loads(data)
+
+    codec = CODEC_NAMES.get(data[1:2])
+    if codec is None:
+        raise ValueError(f"Unknown payload codec marker: {data[1:2]!r}")
+
+    body = data[HEADER_SIZE:]
+    if data[2:3] == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError("Payload is zstd compressed but zstandard is not installed")
+        body = zstandard.ZstdDecompressor().decompress(body)
+
+    return _decode_body(body, codec)
+
+
+def register_celery_serializer() -> None:
+    """Register the marked payload format with kombu so Celery can use it"""
+    from kombu.serialization import register
+
+    register(
+        CELERY_SERIALIZER_NAME,
+        dumps,
+        loads,
+        content_type=CONTENT_TYPE,
+        content_encoding='binary'
+    )
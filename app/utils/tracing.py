@@ -0,0 +1,185 @@
+"""
+Distributed tracing helpers built on OpenTelemetry
+
+Tracing is off unless TRACING_ENABLED is set. When off, or when the
+opentelemetry packages are missing, every helper here is a cheap no-op.
+When on, root spans are sampled at TRACING_SAMPLE_RATE and child spans
+follow their parent's decision, so unsampled requests cost a context lookup.
+
+Trace context travels as W3C ``traceparent`` headers on Celery messages,
+RabbitMQ messages and outbound HTTP requests.
+"""
+import json
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+from app.config.config import Config
+
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import propagate, trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SpanExporter, SpanExportResult
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+except ImportError:  # pragma: no cover - optional dependency
+    trace = None
+
+_initialized = False
+_init_lock = threading.Lock()
+
+if trace is not None:
+    class FileSpanExporter(SpanExporter):
+        """Write finished spans as JSON lines to a local file"""
+
+        def __init__(self, path: str):
+            self.path = path
+            self._lock = threading.Lock()
+
+        def export(self, spans):
+            lines = []
+            for span in spans:
+                lines.append(json.dumps({
+                    'trace_id': format(span.context.trace_id, '032x'),
+                    'span_id': format(span.context.span_id, '016x'),
+                    'parent_id': format(span.parent.span_id, '016x') if span.parent else None,
+                    'name': span.name,
+                    'kind': span.kind.name,
+                    'start_ns': span.start_time,
+                    'end_ns': span.end_time,
+                    'duration_ms': (span.end_time - span.start_time) / 1e6 if span.end_time else None,
+                    'status': span.status.status_code.name,
+                    'attributes': dict(span.attributes or {}),
+                    'service': span.resource.attributes.get('service.name')
+                }, default=str))
+            with self._lock, open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+            return SpanExportResult.SUCCESS
+
+        def shutdown(self):
+            pass
+
+def enabled() -> bool:
+    """True once tracing has been initialized in this process"""
+    return _initialized
+
+def _build_exporter():
+    exporter = Config.TRACING_EXPORTER.lower()
+    if exporter == 'file':
+        return FileSpanExporter(Config.TRACING_FILE)
+    if exporter == 'console':
+        return ConsoleSpanExporter()
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    return OTLPSpanExporter(endpoint=Config.TRACING_OTLP_ENDPOINT)
+
+def init_tracing(service_name: str) -> bool:
+    """Install the tracer provider once per process"""
+    global _initialized
+
+    if not Config.TRACING_ENABLED or trace is None:
+        return False
+
+    with _init_lock:
+        if _initialized:
+            return True
+        provider = TracerProvider(
+            resource=Resource.create({'service.name': service_name}),
+            sampler=ParentBased(TraceIdRatioBased(Config.TRACING_SAMPLE_RATE))
+        )
+        provider.add_span_processor(BatchSpanProcessor(_build_exporter()))
+        trace.set_tracer_provider(provider)
+        _initialized = True
+
+    print(f"🔭 Tracing enabled for {service_name} "
+          f"(exporter={Config.TRACING_EXPORTER}, sample_rate={Config.TRACING_SAMPLE_RATE})")
+    return True
+
+def get_tracer():
+    """Tracer used for every span this application creates"""
+    return trace.get_tracer('ai_rate_limiter')
+
+@contextmanager
+def span(name: str, kind: str = 'internal', attributes: Optional[Dict[str, Any]] = None):
+    """Run the block inside a child span of the current context"""
+    if not _initialized:
+        yield None
+        return
+
+    span_kind = getattr(SpanKind, kind.upper(), SpanKind.INTERNAL)
+    with get_tracer().start_as_current_span(name, kind=span_kind, attributes=attributes) as current:
+        yield current
+
+def start_span(name: str, carrier: Optional[Dict[str, Any]] = None, kind: str = 'server',
+               attributes: Optional[Dict[str, Any]] = None):
+    """Start a span continuing the context in carrier and make it current
+
+    Returns a handle for end_span(), or None when tracing is off.
+    """
+    if not _initialized:
+        return None
+
+    parent = propagate.extract(carrier) if carrier else None
+    span_kind = getattr(SpanKind, kind.upper(), SpanKind.SERVER)
+    current = get_tracer().start_span(name, context=parent, kind=span_kind, attributes=attributes)
+    token = otel_context.attach(trace.set_span_in_context(current))
+    return current, token
+
+def end_span(handle, error: Optional[BaseException] = None) -> None:
+    """End a span started with start_span() and restore the previous context"""
+    if handle is None:
+        return
+    current, token = handle
+    if error is not None:
+        current.record_exception(error)
+        current.set_status(Status(StatusCode.ERROR, str(error)))
+    current.end()
+    otel_context.detach(token)
+
+def inject_headers(headers: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Add the current trace context to a headers dict and return it"""
+    headers = headers if headers is not None else {}
+    if _initialized:
+        propagate.inject(headers)
+    return headers
+
+def set_attribute(key: str, value: Any) -> None:
+    """Set an attribute on the current span if there is one"""
+    if _initialized and value is not None:
+        trace.get_current_span().set_attribute(key, value if isinstance(value, (str, int, float, bool)) else str(value))
+
+def instrument_engine(engine) -> None:
+    """Open a client span for every statement executed on a SQLAlchemy engine"""
+    if not _initialized or getattr(engine, '_ai_rate_limiter_traced', False):
+        return
+    engine._ai_rate_limiter_traced = True
+
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Only trace statements issued inside a sampled request or task
+        if not trace.get_current_span().is_recording():
+            return
+        operation = statement.lstrip().split(' ', 1)[0].upper()
+        current = get_tracer().start_span(
+            f"db.{operation.lower()}",
+            kind=SpanKind.CLIENT,
+            attributes={'db.system': engine.dialect.name, 'db.statement': statement[:500]}
+        )
+        conn.info.setdefault('trace_spans', []).append(current)
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get('trace_spans')
+        if spans and trace.get_current_span().is_recording():
+            spans.pop().end()
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        spans = conn.info.get('trace_spans') if conn is not None else None
+        if spans:
+            current = spans.pop()
+            current.set_status(Status(StatusCode.ERROR, str(exception_context.original_exception)))
+            current.end()
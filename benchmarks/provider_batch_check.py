@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+End-to-end check of the provider Batch API offload against the stub provider
+
+Runs the API and workers in embedded mode (SQLite, in-process broker and
+Redis) with the stub's Batch API endpoints, sends a provider_batch batch that
+is split into several jobs and waits until every message is finished and the
+batch is completed. With --fail-after N, creating a job fails for good after
+N jobs, and the jobs already submitted must still be polled and applied.
+Exits with status 1 when the batch does not end as expected.
+
+Usage:
+    python benchmarks/provider_batch_check.py --messages 10 --job-size 4
+    python benchmarks/provider_batch_check.py --messages 10 --job-size 4 --fail-after 1
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from stub_provider import StubSettings, start_stub_server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10)
+    parser.add_argument('--job-size', type=int, default=4, help='PROVIDER_BATCH_MAX_REQUESTS')
+    parser.add_argument('--fail-after', type=int, default=None, help='jobs created before job creation fails')
+    parser.add_argument('--stub-port', type=int, default=9997)
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for the batch')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    database = os.path.join(tempfile.mkdtemp(), 'provider_batch_check.db')
+    os.environ.update({
+        'EMBEDDED_MODE': 'true',
+        'DATABASE_URL': f"sqlite:///{database}",
+        'PROVIDER_BATCH_MIN_SIZE': '1',
+        'PROVIDER_BATCH_MAX_REQUESTS': str(args.job_size),
+        'PROVIDER_BATCH_POLL_INTERVAL': '1'
+    })
+    start_stub_server('127.0.0.1', args.stub_port, StubSettings(latency_ms=0, jitter_ms=0, batch_delay=1.0))
+
+    from app import create_app, db
+    from app.embedded import EmbeddedRuntime
+    from app.models.batch import Batch
+    from app.models.message import Message
+    from app.services.provider_batch_service import ProviderBatchService
+    from app.utils.exceptions import ProviderBatchError
+
+    if args.fail_after is not None:
+        create_job = ProviderBatchService._create_job
+        created = []
+
+        def failing_create_job(*job_args):
+            if len(created) >= args.fail_after:
+                raise ProviderBatchError("Provider batch request failed: 500 - injected by provider_batch_check")
+            created.append(True)
+            return create_job(*job_args)
+
+        ProviderBatchService._create_job = staticmethod(failing_create_job)
+
+    app = create_app()
+    runtime = EmbeddedRuntime(app)
+    runtime.start()
+    client = app.test_client()
+
+    queue_id = str(uuid.uuid4())
+    client.post('/api/v1/queue/create', json={
+        'queue_id': queue_id,
+        'processing_mode': 'provider_batch',
+        'providers': [{
+            'provider_name': 'stub',
+            'provider_type': 'openai',
+            'api_key': 'stub',
+            'limit': 1000,
+            'time_window': 60,
+            'config': {
+                'model': 'stub-model',
+                'base_url': f"http://127.0.0.1:{args.stub_port}/v1",
+                'batch_api_url': f"http://127.0.0.1:{args.stub_port}/v1"
+            }
+        }]
+    })
+    response = client.post('/api/v1/message/create', json={
+        'queue_id': queue_id,
+        'messages': [{'prompt': f"Message {i}"} for i in range(args.messages)]
+    })
+    if response.status_code != 201:
+        print(f"❌ Batch not created: {response.status_code} {response.get_json()}")
+        return 1
+    batch_id = response.get_json()['batch_id']
+
+    deadline = time.time() + args.timeout
+    with app.app_context():
+        while time.time() < deadline:
+            db.session.expire_all()
+            batch = Batch.query.filter_by(batch_id=batch_id).first()
+            if batch.status == 'completed':
+                break
+            time.sleep(0.5)
+        statuses = [message.status for message in Message.query.filter_by(batch_id=batch_id).all()]
+        batch_status = Batch.query.filter_by(batch_id=batch_id).first().status
+
+    completed = statuses.count('completed')
+    failed = statuses.count('failed')
+    submitted = args.messages if args.fail_after is None else min(args.messages, args.fail_after * args.job_size)
+    print(f"Batch {batch_id}: {batch_status}, {completed} completed, {failed} failed, "
+          f"{len(statuses) - completed - failed} unfinished")
+
+    ok = batch_status == 'completed' and completed == submitted and completed + failed == args.messages
+    print("✅ Provider batch check passed" if ok else f"❌ Expected {submitted} completed and the rest failed")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark payload size and CPU cost per message for each serializer
+
+Usage:
+    python benchmarks/serialization_bench.py [--iterations 2000] [--batch-size 500]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.utils import serialization
+
+
+def sample_message_result():
+    """Shape of a provider response stored under message:{id}"""
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': 'gpt-4o',
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': 'The answer is 42. ' * 30},
+            'finish_reason': 'stop'
+        }],
+        'usage': {'prompt_tokens': 512, 'completion_tokens': 180, 'total_tokens': 692}
+    }
+
+
+def sample_batch_results(batch_size):
+    """Shape of the aggregate stored under batch_results:{id}"""
+    return {
+        'batch_id': str(uuid.uuid4()),
+        'request_count': batch_size,
+        'response_count': batch_size,
+        'results': [{
+            'message_id': str(uuid.uuid4()),
+            'status': 'completed',
+            'prompt': f"Summarise document number {i} in three sentences.",
+            'result': 'A short summary of the document. ' * 8,
+            'error_message': None
+        } for i in range(batch_size)],
+        'completed_at': time.time()
+    }
+
+
+def sample_task_body():
+    """Shape of a Celery process_message body"""
+    return [[str(uuid.uuid4())], {}, {'callbacks': None, 'errbacks': None, 'chain': None, 'chord': None}]
+
+
+def measure(payload, codec, compression, iterations):
+    """Return (bytes, encode_us, decode_us) for one payload"""
+    encoded = serialization.dumps(payload, codec=codec, compression=compression)
+
+    start = time.process_time()
+    for _ in range(iterations):
+        serialization.dumps(payload, codec=codec, compression=compression)
+    encode_us = (time.process_time() - start) / iterations * 1e6
+
+    start = time.process_time()
+    for _ in range(iterations):
+        serialization.loads(encoded)
+    decode_us = (time.process_time() - start) / iterations * 1e6
+
+    return len(encoded), encode_us, decode_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    payloads = [
+        ('celery task body', sample_task_body(), args.iterations),
+        ('message result', sample_message_result(), args.iterations),
+        (f'batch results ({args.batch_size})', sample_batch_results(args.batch_size), max(args.iterations // 100, 5)),
+    ]
+
+    print(f"Available codecs: {', '.join(serialization.available_codecs())}")
+    print(f"{'payload':<24}{'format':<18}{'bytes':>10}{'enc us':>12}{'dec us':>12}")
+    print("-" * 76)
+
+    for name, payload, iterations in payloads:
+        legacy = json.dumps(payload).encode('utf-8')
+        start = time.process_time()
+        for _ in range(iterations):
+            json.dumps(payload)
+        legacy_us = (time.process_time() - start) / iterations * 1e6
+        print(f"{name:<24}{'legacy json':<18}{len(legacy):>10}{legacy_us:>12.1f}{'':>12}")
+
+        for codec in serialization.available_codecs():
+            for compression in ('none', 'zstd'):
+                size, enc_us, dec_us = measure(payload, codec, compression, iterations)
+                label = f"{codec}+{compression}"
+                print(f"{'':<24}{label:<18}{size:>10}{enc_us:>12.1f}{dec_us:>12.1f}")
+        print()
+
+
+if __name__ == '__main__':
+    main()
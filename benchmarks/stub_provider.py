@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Local stub of an OpenAI-compatible chat completions provider
+
+Serves POST /v1/chat/completions (and the gateway-style
+/v1/providers/<provider_id> path) with configurable latency, error rate,
+429 rate and token usage. GET /stats returns request counters and
+GET /stats/reset clears them.
+
+It also stubs the Batch API used by provider_batch queues: POST /v1/files,
+POST /v1/batches, GET /v1/batches/<id> and GET /v1/files/<id>/content.
+A batch completes --batch-delay seconds after it is created, and each of
+its requests fails with probability --error-rate.
+
+Requests with "stream": true get SSE chunks, one per token, ending in
+`data: [DONE]`.
+
+Usage:
+    python benchmarks/stub_provider.py --port 9999 --latency-ms 200 --rate-429 0.02
+"""
+import argparse
+import email.parser
+import email.policy
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPLETION_PATH = '/v1/chat/completions'
+GATEWAY_PATH_PREFIX = '/v1/providers/'
+BATCH_PATH_PREFIX = '/v1/batches/'
+FILE_PATH_PREFIX = '/v1/files/'
+
+
+class StubSettings:
+    """Behaviour knobs shared by all handler threads"""
+
+    def __init__(self, latency_ms=200.0, jitter_ms=50.0, error_rate=0.0, rate_429=0.0,
+                 prompt_tokens=None, completion_tokens=64, retry_after=1, batch_delay=2.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.retry_after = retry_after
+        self.batch_delay = batch_delay
+
+
+class StubStats:
+    """Thread-safe request counters and served latencies"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.ok = 0
+            self.errors = 0
+            self.rate_limited = 0
+            self.latencies_ms = []
+
+    def record(self, outcome, latency_ms):
+        with self._lock:
+            self.requests += 1
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.latencies_ms.append(latency_ms)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'ok': self.ok,
+                'errors': self.errors,
+                'rate_limited': self.rate_limited,
+                'latencies_ms': list(self.latencies_ms)
+            }
+
+
+def make_handler(settings, stats, batches):
+    """Build a request handler bound to the given settings, stats and batch store"""
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(200, stats.snapshot())
+            elif self.path == '/stats/reset':
+                stats.reset()
+                self._send_json(200, {'success': True})
+            elif self.path.startswith(BATCH_PATH_PREFIX):
+                job = batches.get(self.path[len(BATCH_PATH_PREFIX):])
+                if job is None:
+                    self._send_json(404, {'error': {'message': 'No such batch', 'type': 'invalid_request_error'}})
+                else:
+                    self._send_json(200, job)
+            elif self.path.startswith(FILE_PATH_PREFIX) and self.path.endswith('/content'):
+                content = batches.files.get(self.path[len(FILE_PATH_PREFIX):-len('/content')])
+                if content is None:
+                    self._send_json(404, {'error': {'message': 'No such file', 'type': 'invalid_request_error'}})
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/jsonl')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            raw = self.rfile.read(length) if length else b'{}'
+
+            if self.path == '/v1/files':
+                self._handle_file_upload(raw)
+                return
+            if self.path == '/v1/batches':
+                self._handle_batch_create(raw)
+                return
+            if self.path != COMPLETION_PATH and not self.path.startswith(GATEWAY_PATH_PREFIX):
+                self._send_json(404, {'error': 'not found'})
+                return
+
+            start = time.perf_counter()
+            roll = random.random()
+
+            if roll < settings.rate_429:
+                stats.record('rate_limited', (time.perf_counter() - start) * 1000)
+                self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error'}},
+                                headers={'Retry-After': str(settings.retry_after)})
+                return
+
+            try:
+                request_data = json.loads(raw or b'{}')
+            except ValueError:
+                request_data = {}
+
+            delay = max(random.gauss(settings.latency_ms, settings.jitter_ms), 0) / 1000
+            if request_data.get('stream') and roll >= settings.rate_429 + settings.error_rate:
+                self._stream_completion(request_data, delay)
+                stats.record('ok', (time.perf_counter() - start) * 1000)
+                return
+            time.sleep(delay)
+
+            if roll < settings.rate_429 + settings.error_rate:
+                stats.record('errors', (time.perf_counter() - start) * 1000)
+                self._send_json(500, {'error': {'message': 'Stub upstream error', 'type': 'server_error'}})
+                return
+
+            stats.record('ok', (time.perf_counter() - start) * 1000)
+            self._send_json(200, build_completion(settings, request_data))
+
+        def _stream_completion(self, request_data, delay):
+            """Send the completion as SSE chunks, the first after a quarter of the latency"""
+            completion = build_completion(settings, request_data)
+            tokens = completion['choices'][0]['message']['content'].split(' ')[:-1]
+            base = {key: completion[key] for key in ('id', 'created', 'model')}
+            base['object'] = 'chat.completion.chunk'
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+
+            def send(payload):
+                self.wfile.write(f"data: {payload}\n\n".encode('utf-8'))
+                self.wfile.flush()
+
+            time.sleep(delay / 4)
+            for token in tokens:
+                send(json.dumps({**base, 'choices': [{'index': 0, 'delta': {'content': token + ' '}, 'finish_reason': None}]}))
+                time.sleep(delay * 3 / 4 / max(len(tokens), 1))
+            send(json.dumps({**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}))
+            if (request_data.get('stream_options') or {}).get('include_usage'):
+                send(json.dumps({**base, 'choices': [], 'usage': completion['usage']}))
+            send('[DONE]')
+
+        def _handle_file_upload(self, raw):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('utf-8') + raw
+            )
+            content = b''
+            for part in message.iter_parts():
+                if part.get_param('name', header='content-disposition') == 'file':
+                    content = part.get_payload(decode=True) or b''
+            self._send_json(200, batches.add_file(content, 'batch'))
+
+        def _handle_batch_create(self, raw):
+            try:
+                request_data = json.loads(raw or b'{}')
+            except ValueError:
+                request_data = {}
+            if request_data.get('input_file_id') not in batches.files:
+                self._send_json(400, {'error': {'message': 'Unknown input_file_id', 'type': 'invalid_request_error'}})
+                return
+            self._send_json(200, batches.create(request_data))
+
+    return StubHandler
+
+
+class StubBatches:
+    """In-memory files and batch jobs for the Batch API endpoints"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._lock = threading.Lock()
+        self.files = {}
+        self.jobs = {}
+
+    def add_file(self, content, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with self._lock:
+            self.files[file_id] = content
+        return {'id': file_id, 'object': 'file', 'bytes': len(content), 'purpose': purpose}
+
+    def create(self, request_data):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        job = {
+            'id': batch_id,
+            'object': 'batch',
+            'endpoint': request_data.get('endpoint'),
+            'input_file_id': request_data['input_file_id'],
+            'completion_window': request_data.get('completion_window', '24h'),
+            'status': 'in_progress',
+            'output_file_id': None,
+            'error_file_id': None,
+            'created_at': int(time.time()),
+            'metadata': request_data.get('metadata') or {},
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0}
+        }
+        with self._lock:
+            self.jobs[batch_id] = job
+        return dict(job)
+
+    def get(self, batch_id):
+        with self._lock:
+            job = self.jobs.get(batch_id)
+            if job is None:
+                return None
+            if job['status'] == 'in_progress' and time.time() - job['created_at'] >= self.settings.batch_delay:
+                self._complete(job)
+            return dict(job)
+
+    def _complete(self, job):
+        """Answer every request of a job, writing output and error files"""
+        output, errors = [], []
+        for line in self.files[job['input_file_id']].splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if random.random() < self.settings.error_rate:
+                errors.append({
+                    'id': f"batch_req_{uuid.uuid4().hex}",
+                    'custom_id': request.get('custom_id'),
+                    'response': {
+                        'status_code': 500,
+                        'body': {'error': {'message': 'Stub upstream error', 'type': 'server_error'}}
+                    },
+                    'error': None
+                })
+            else:
+                output.append({
+                    'id': f"batch_req_{uuid.uuid4().hex}",
+                    'custom_id': request.get('custom_id'),
+                    'response': {'status_code': 200, 'body': build_completion(self.settings, request.get('body') or {})},
+                    'error': None
+                })
+
+        for records, key in ((output, 'output_file_id'), (errors, 'error_file_id')):
+            if records:
+                file_id = f"file-{uuid.uuid4().hex}"
+                self.files[file_id] = ''.join(json.dumps(r) + '\n' for r in records).encode('utf-8')
+                job[key] = file_id
+        job['status'] = 'completed'
+        job['request_counts'] = {'total': len(output) + len(errors), 'completed': len(output), 'failed': len(errors)}
+
+
+def build_completion(settings, request_data):
+    """Build a chat completion response for a request body"""
+    prompt_chars = sum(len(str(m.get('content', ''))) for m in request_data.get('messages', []))
+    prompt_tokens = settings.prompt_tokens or max(prompt_chars // 4, 1)
+    completion_tokens = settings.completion_tokens
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': request_data.get('model') or 'stub-model',
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': 'stub ' * completion_tokens},
+            'finish_reason': 'stop'
+        }],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+    }
+
+
+def start_stub_server(host='127.0.0.1', port=9999, settings=None):
+    """Start the stub in a background thread and return (server, stats)"""
+    settings = settings or StubSettings()
+    stats = StubStats()
+    server = ThreadingHTTPServer((host, port), make_handler(settings, stats, StubBatches(settings)))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, stats
+
+
+def add_stub_arguments(parser):
+    """Register the stub's behaviour flags on an argument parser"""
+    parser.add_argument('--latency-ms', type=float, default=200.0, help='mean provider latency')
+    parser.add_argument('--jitter-ms', type=float, default=50.0, help='latency standard deviation')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 500 responses')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='fraction of 429 responses')
+    parser.add_argument('--prompt-tokens', type=int, default=None, help='fixed prompt tokens (default: chars/4)')
+    parser.add_argument('--completion-tokens', type=int, default=64)
+    parser.add_argument('--batch-delay', type=float, default=2.0, help='seconds until a stub batch job completes')
+
+
+def settings_from_args(args):
+    """Build StubSettings from parsed arguments"""
+    return StubSettings(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        rate_429=args.rate_429,
+        prompt_tokens=args.prompt_tokens,
+        completion_tokens=args.completion_tokens,
+        batch_delay=args.batch_delay
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9999)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server, _ = start_stub_server(args.host, args.port, settings_from_args(args))
+    print(f"Stub provider listening on http://{args.host}:{args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
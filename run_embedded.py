@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+AI Rate Limiter embedded entry point: API, workers, broker and limiter in one process
+"""
+import os
+
+os.environ.setdefault('EMBEDDED_MODE', 'true')
+
+from app import create_app
+from app.embedded import EmbeddedRuntime
+
+app = create_app()
+
+if __name__ == '__main__':
+    host = os.getenv('SERVER_HOST', '0.0.0.0')
+    port = int(os.getenv('SERVER_PORT', 8501))
+    
+    runtime = EmbeddedRuntime(app)
+    runtime.start()
+    try:
+        app.run(host=host, port=port, threaded=True, use_reloader=False)
+    finally:
+        runtime.stop()
@@ -0,0 +1,80 @@
+"""
+Shared fixtures: the app in embedded mode and the stub provider
+
+The app runs with an in-process Redis and a SQLite database, so the tests need
+no services. The stub provider from benchmarks/ stands in for the provider's
+real-time and Batch API endpoints.
+"""
+import os
+import socket
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+os.environ.update({
+    'EMBEDDED_MODE': 'true',
+    'DATABASE_URL': f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'tests.db')}",
+    'GATEWAY_ENABLED': 'false'
+})
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks')))
+
+from stub_provider import StubSettings, start_stub_server
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import create_app
+    return create_app()
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+
+
+@pytest.fixture(scope='session')
+def stub():
+    """Stub provider whose batch jobs complete on their first poll, yields (base_url, settings)"""
+    settings = StubSettings(latency_ms=0, jitter_ms=0, batch_delay=0)
+    port = _free_port()
+    server, _ = start_stub_server('127.0.0.1', port, settings)
+    yield f"http://127.0.0.1:{port}/v1", settings
+    server.shutdown()
+
+
+@pytest.fixture
+def stub_settings(stub):
+    """The stub's settings, put back to no errors after each test"""
+    _, settings = stub
+    yield settings
+    settings.error_rate = 0.0
+
+
+@pytest.fixture
+def provider_batch_queue(app, stub):
+    """A provider_batch queue whose one openai provider is the stub, returns its queue_id"""
+    base_url, _ = stub
+    queue_id = str(uuid.uuid4())
+    response = app.test_client().post('/api/v1/queue/create', json={
+        'queue_id': queue_id,
+        'processing_mode': 'provider_batch',
+        'providers': [{
+            'provider_name': 'stub',
+            'provider_type': 'openai',
+            'api_key': 'stub',
+            'limit': 1000,
+            'time_window': 60,
+            'config': {'model': 'stub-model', 'base_url': base_url, 'batch_api_url': base_url}
+        }]
+    })
+    assert response.status_code == 201, response.get_json()
+    return queue_id
@@ -0,0 +1,75 @@
+"""
+Queue backlog counter and the progress endpoint reading it
+"""
+import uuid
+
+import pytest
+from sqlalchemy import event
+
+from app import db
+from app.models.message import Message
+from app.services import apisix_service
+from app.services.admission_service import AdmissionService
+from app.services.rabbitmq_service import RabbitMQService
+from app.tasks.worker_tasks import process_message
+from worker_hot_path import make_stub_post
+
+
+@pytest.fixture
+def stubbed_provider(monkeypatch):
+    monkeypatch.setattr(apisix_service.requests, 'post', make_stub_post(0, 8))
+    monkeypatch.setattr(RabbitMQService, 'publish_batch_complete', classmethod(lambda cls, batch_id: None))
+
+
+@pytest.fixture
+def queue_id(app):
+    queue_id = str(uuid.uuid4())
+    response = app.test_client().post('/api/v1/queue/create', json={
+        'queue_id': queue_id,
+        'providers': [{
+            'provider_name': 'stub',
+            'provider_type': 'openai',
+            'api_key': 'stub',
+            'limit': 100,
+            'time_window': 60,
+            'config': {'model': 'stub-model'}
+        }]
+    })
+    assert response.status_code == 201, response.get_json()
+    return queue_id
+
+
+def test_backlog_is_counted_without_the_database(app, app_context, queue_id, stubbed_provider):
+    client = app.test_client()
+    response = client.post('/api/v1/message/create', json={
+        'queue_id': queue_id,
+        'messages': [{'prompt': f"Message {i}"} for i in range(10)]
+    })
+    batch_id = response.get_json()['batch_id']
+    message_ids = [str(message.message_id) for message in Message.query.filter_by(batch_id=uuid.UUID(batch_id))]
+    assert AdmissionService.backlog(queue_id) == 10
+
+    for message_id in message_ids[:4]:
+        process_message.apply(args=[message_id])
+    assert AdmissionService.backlog(queue_id) == 6
+
+    client.delete(f"/api/v1/message/delete/{message_ids[-1]}")
+    assert AdmissionService.backlog(queue_id) == 5
+
+    statements = []
+    record = lambda *args: statements.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        progress = client.get(f"/api/v1/batch/{batch_id}/progress").get_json()['data']
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert progress['remaining'] == 6
+    assert progress['quota_remaining'] == 96
+    assert statements == []
+
+
+def test_provider_changes_refresh_the_drain_rate(app, app_context, queue_id):
+    assert AdmissionService.drain_rate(queue_id) == 100 / 60
+    provider_id = AdmissionService.providers(queue_id)[0].provider_id
+    app.test_client().patch(f"/api/v1/provider/update/{provider_id}", json={'limit': 30})
+    assert AdmissionService.drain_rate(queue_id) == 30 / 60
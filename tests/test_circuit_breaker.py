@@ -0,0 +1,38 @@
+"""
+Circuit breaker request timeouts
+"""
+import uuid
+from types import SimpleNamespace
+
+from app.config.config import Config
+from app.services.circuit_breaker import TIMEOUT_REFRESH_EVERY, CircuitBreaker
+
+
+def make_provider():
+    return SimpleNamespace(provider_id=uuid.uuid4(), provider_type='openai')
+
+
+def test_timeout_follows_p99_of_successful_calls(app_context):
+    provider = make_provider()
+    for _ in range(TIMEOUT_REFRESH_EVERY):
+        CircuitBreaker.record(provider, succeeded=True, latency=4.0)
+    assert CircuitBreaker.before_request(provider) == 4.0 * Config.CIRCUIT_TIMEOUT_MULTIPLIER
+
+
+def test_timeout_grows_while_calls_time_out(app_context):
+    provider = make_provider()
+    for _ in range(TIMEOUT_REFRESH_EVERY):
+        CircuitBreaker.record(provider, succeeded=True, latency=1.0)
+    timeout = CircuitBreaker.before_request(provider)
+    assert timeout == Config.CIRCUIT_MIN_TIMEOUT
+
+    # Every call now takes longer than the timeout, each refresh lengthens it until the cap
+    timeouts = [timeout]
+    while timeout < Config.CIRCUIT_MAX_TIMEOUT:
+        for _ in range(TIMEOUT_REFRESH_EVERY):
+            CircuitBreaker.record(provider, succeeded=False, timeout=timeout)
+        CircuitBreaker._close(provider)
+        timeout = CircuitBreaker.before_request(provider)
+        timeouts.append(timeout)
+    assert timeouts == sorted(set(timeouts))
+    assert timeout == Config.CIRCUIT_MAX_TIMEOUT
@@ -0,0 +1,113 @@
+"""
+Provider Batch API offload: submit, poll and apply against the stub provider
+"""
+import uuid
+
+import pytest
+
+from app import db
+from app.config.config import Config
+from app.models.message import Message
+from app.models.provider import Provider
+from app.services import provider_batch_service
+from app.services.message_service import MessageService
+from app.services.provider_batch_service import ProviderBatchService
+from app.services.rabbitmq_service import RabbitMQService
+from app.services.redis_service import RedisService
+
+
+@pytest.fixture
+def finished_batches(monkeypatch):
+    """Batch ids handed to the aggregator, instead of aggregating them"""
+    finished = []
+    monkeypatch.setattr(RabbitMQService, 'publish_batch_complete',
+                        classmethod(lambda cls, batch_id: finished.append(batch_id)))
+    return finished
+
+
+@pytest.fixture(autouse=True)
+def offload_every_batch(monkeypatch):
+    monkeypatch.setattr(Config, 'PROVIDER_BATCH_MIN_SIZE', 1)
+    monkeypatch.setattr(Config, 'PROVIDER_BATCH_MAX_REQUESTS', 4)
+
+
+def create_batch(app, queue_id, message_count):
+    """Create a batch on the queue and return (batch_id, provider_id)"""
+    response = app.test_client().post('/api/v1/message/create', json={
+        'queue_id': queue_id,
+        'messages': [{'prompt': f"Message {i}"} for i in range(message_count)]
+    })
+    assert response.status_code == 201, response.get_json()
+    provider = Provider.query.filter_by(queue_id=uuid.UUID(queue_id)).first()
+    return response.get_json()['batch_id'], str(provider.provider_id)
+
+
+def statuses(batch_id):
+    db.session.expire_all()
+    return sorted(message.status for message in Message.query.filter_by(batch_id=uuid.UUID(batch_id)).all())
+
+
+def counters(batch_id):
+    data = RedisService.get_client().hgetall(f"batch:{batch_id}")
+    return int(data.get(b'res.count', 0)), int(data.get(b'fail.count', 0))
+
+
+def test_partial_failure_is_applied_and_counted(app, app_context, provider_batch_queue, stub_settings,
+                                                finished_batches):
+    batch_id, provider_id = create_batch(app, provider_batch_queue, 8)
+
+    job_ids = ProviderBatchService.submit(batch_id, provider_id)
+    assert len(job_ids) == 2
+    assert statuses(batch_id) == ['processing'] * 8
+
+    # Cache a message's processing status, as a client polling it would
+    message_id = str(Message.query.filter_by(batch_id=uuid.UUID(batch_id)).first().message_id)
+    assert MessageService.get_message(message_id)['data']['status'] == 'processing'
+
+    stub_settings.error_rate = 1.0
+    assert ProviderBatchService.poll(job_ids[0]) is True
+    assert finished_batches == []
+
+    stub_settings.error_rate = 0.0
+    assert ProviderBatchService.poll(job_ids[1]) is True
+
+    assert statuses(batch_id) == ['completed'] * 4 + ['failed'] * 4
+    assert counters(batch_id) == (8, 4)
+    for message in Message.query.filter_by(batch_id=uuid.UUID(batch_id)).all():
+        assert message.created_at <= message.started_at <= message.finished_at
+    assert finished_batches == [batch_id]
+    applied = Message.query.filter_by(message_id=uuid.UUID(message_id)).first().status
+    assert MessageService.get_message(message_id)['data']['status'] == applied
+
+    # A poll of an applied job changes nothing
+    assert ProviderBatchService.poll(job_ids[0]) is True
+    assert counters(batch_id) == (8, 4)
+
+
+def test_retried_apply_counts_every_message_once(app, app_context, provider_batch_queue, stub_settings,
+                                                 finished_batches, monkeypatch):
+    monkeypatch.setattr(provider_batch_service, 'PAGE_SIZE', 2)
+    batch_id, provider_id = create_batch(app, provider_batch_queue, 4)
+    job_ids = ProviderBatchService.submit(batch_id, provider_id)
+    assert len(job_ids) == 1
+
+    apply_results = ProviderBatchService._apply_results
+    calls = []
+
+    def crash_on_second_page(*args):
+        calls.append(True)
+        if len(calls) == 2:
+            raise RuntimeError("worker lost mid-apply")
+        return apply_results(*args)
+
+    monkeypatch.setattr(ProviderBatchService, '_apply_results', staticmethod(crash_on_second_page))
+    with pytest.raises(RuntimeError):
+        ProviderBatchService.poll(job_ids[0])
+    db.session.rollback()
+    assert statuses(batch_id) == ['completed'] * 2 + ['processing'] * 2
+    assert counters(batch_id) == (2, 0)
+
+    assert ProviderBatchService.poll(job_ids[0]) is True
+    assert statuses(batch_id) == ['completed'] * 4
+    assert counters(batch_id) == (4, 0)
+    assert finished_batches == [batch_id]
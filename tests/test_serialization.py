@@ -0,0 +1,25 @@
+"""
+Marked payloads read back in processes with fewer codecs installed
+"""
+import uuid
+
+import pytest
+
+from app.utils import serialization
+
+PAYLOAD = {'message_id': str(uuid.uuid4()), 'status': 'completed', 'result': 'x' * 2000, 'count': 3}
+
+
+@pytest.mark.parametrize('compression', ['none', 'zstd'])
+def test_orjson_payload_reads_without_orjson(monkeypatch, compression):
+    data = serialization.dumps(PAYLOAD, codec='orjson', compression=compression, threshold=0)
+    assert data[1:2] == b'o'
+    monkeypatch.setattr(serialization, 'orjson', None)
+    assert serialization.loads(data) == PAYLOAD
+
+
+def test_msgpack_payload_without_msgpack_is_an_error(monkeypatch):
+    data = serialization.dumps(PAYLOAD, codec='msgpack')
+    monkeypatch.setattr(serialization, 'msgpack', None)
+    with pytest.raises(ValueError):
+        serialization.loads(data)
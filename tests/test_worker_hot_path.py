@@ -0,0 +1,40 @@
+"""
+Overhead budget for the process_message hot path
+
+Runs benchmarks/worker_hot_path.py's loop with the provider call stubbed out,
+so what is measured is the worker's own cost per message: loading, rate
+limiting, Redis counters and committing the result. Budgets are loose enough
+for a shared CI runner and can be tightened with the environment variables.
+"""
+import os
+
+import pytest
+
+from app import db
+from app.services import apisix_service
+from app.services.rabbitmq_service import RabbitMQService
+from worker_hot_path import delete_seeded, make_stub_post, process_messages, seed_messages
+
+MESSAGES = int(os.getenv('HOT_PATH_MESSAGES', 100))
+MAX_P95_MS = float(os.getenv('HOT_PATH_MAX_P95_MS', 100))  # per message, provider call excluded
+
+
+@pytest.fixture
+def stubbed_provider(monkeypatch):
+    monkeypatch.setattr(apisix_service.requests, 'post', make_stub_post(0, 64))
+    monkeypatch.setattr(RabbitMQService, 'publish_batch_complete', classmethod(lambda cls, batch_id: None))
+
+
+def test_hot_path_stays_within_budget(app, stubbed_provider):
+    with app.app_context():
+        queue_id, batch_ids, message_ids = seed_messages(db, MESSAGES, 50, 200, 2000)
+    try:
+        report = process_messages(message_ids)
+    finally:
+        with app.app_context():
+            delete_seeded(db, queue_id, batch_ids)
+
+    total = report['phases']['total']
+    print(f"\n{report['messages_per_sec']} messages/sec, p50 {total['p50_ms']} ms, p95 {total['p95_ms']} ms")
+    assert report['failures'] == 0
+    assert total['p95_ms'] <= MAX_P95_MS, report['phases']